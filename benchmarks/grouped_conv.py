@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares the single conv2d of the grouped convolution of :class:`.ConvLayer`
+with the previous implementation, which convolved every group separately
+and concatenated the results. The shapes are the grouped layers of
+models/alexnet.yaml. See :mod:`bernet.conv` for the single conv2d.
+"""
+import time
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from bernet.conv import block_diagonal_filters, CONV2D_NUM_GROUPS
+from bernet.layer import ConvLayer
+
+# name, input_shape, num_feature_maps, kernel size
+ALEXNET_GROUPED_CONVS = [
+    ("conv2", (10, 96, 27, 27), 256, 5),
+    ("conv4", (10, 384, 13, 13), 384, 3),
+    ("conv5", (10, 384, 13, 13), 256, 3),
+]
+GROUP = 2
+REPEATS = 10
+
+
+def loop_conv(x, w, input_shape, kernel):
+    """The per group loop with a cropped `full` convolution."""
+    in_chan = input_shape[1] // GROUP
+    f = w.get_value().shape[0] // GROUP
+    filter_shape = (f, in_chan, kernel, kernel)
+    group_input_shape = input_shape[:1] + (in_chan,) + input_shape[2:]
+    outs = []
+    for i in range(GROUP):
+        out = T.nnet.conv2d(input=x[:, in_chan*i:in_chan*(i+1), :],
+                            image_shape=group_input_shape,
+                            filters=w[f*i:f*(i+1), :],
+                            filter_shape=filter_shape,
+                            border_mode='full')
+        border = (kernel - 1) // 2
+        outs.append(out[:, :, border:border+input_shape[2],
+                        border:border+input_shape[3]])
+    return T.concatenate(outs, axis=1)
+
+
+def fused_conv(x, w, input_shape, kernel):
+    padded = ConvLayer._pad(x, ((kernel // 2, (kernel - 1) // 2),) * 2)
+    if CONV2D_NUM_GROUPS:
+        return T.nnet.conv2d(padded, w, num_groups=GROUP)
+    return T.nnet.conv2d(padded, block_diagonal_filters(w, GROUP))
+
+
+def benchmark(fn, *args):
+    fn(*args)
+    start = time.time()
+    for _ in range(REPEATS):
+        fn(*args)
+    return (time.time() - start) / REPEATS
+
+
+def main():
+    floatX = theano.config.floatX
+    print("{:>6} | {:>8} | {:>12} | {:>12} | {:>8}".format(
+        "layer", "pass", "loop [ms]", "fused [ms]", "speedup"))
+    for name, input_shape, n_filters, kernel in ALEXNET_GROUPED_CONVS:
+        x_np = np.random.standard_normal(input_shape).astype(floatX)
+        w = theano.shared(np.random.standard_normal(
+            (n_filters, input_shape[1] // GROUP, kernel, kernel))
+            .astype(floatX), name='w')
+        x = T.tensor4('x')
+        times = {}
+        for impl_name, impl in [('loop', loop_conv), ('fused', fused_conv)]:
+            out = impl(x, w, input_shape, kernel)
+            forward = theano.function([x], out)
+            backward = theano.function([x], T.grad(out.sum(), w))
+            times[impl_name] = (benchmark(forward, x_np),
+                                benchmark(backward, x_np))
+
+        for i, pass_name in enumerate(['forward', 'backward']):
+            loop_t = times['loop'][i]
+            fused_t = times['fused'][i]
+            print("{:>6} | {:>8} | {:12.2f} | {:12.2f} | {:7.2f}x".format(
+                name, pass_name, 1000*loop_t, 1000*fused_t,
+                loop_t / fused_t))
+
+
+if __name__ == "__main__":
+    main()
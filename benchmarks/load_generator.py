@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Puts load on a running :class:`.InferenceServer`. Every client thread sends
+its requests one after another. Prints the client side latencies and
+throughput, and the statistics of the server.
+
+    python -m bernet.server models/shallow-net.yaml --port 8000 &
+    python benchmarks/load_generator.py --port 8000 --clients 16
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from bernet.server import InferenceClient
+
+
+def run_client(args, input, latencies):
+    client = InferenceClient(args.host, args.port, args.unix_socket)
+    try:
+        for _ in range(args.requests):
+            start = time.time()
+            client.predict(input)
+            latencies.append(time.time() - start)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="number of requests per client")
+    parser.add_argument("--examples", type=int, default=1,
+                        help="number of examples per request")
+    args = parser.parse_args()
+
+    client = InferenceClient(args.host, args.port, args.unix_socket)
+    info = client.info()
+    input = np.random.sample([args.examples] + info['input_shape'][1:]) \
+        .astype(np.float32)
+
+    latencies = []
+    threads = [threading.Thread(target=run_client,
+                                args=(args, input, latencies))
+               for _ in range(args.clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - start
+
+    n_requests = len(latencies)
+    print("network:     {}".format(info['name']))
+    print("requests:    {} in {:.2f}s, {:.1f} requests/s, {:.1f} examples/s"
+          .format(n_requests, duration, n_requests / duration,
+                  n_requests * args.examples / duration))
+    print("client p50:  {:.2f}ms".format(
+        1000 * np.percentile(latencies, 50)))
+    print("client p99:  {:.2f}ms".format(
+        1000 * np.percentile(latencies, 99)))
+    print("server:")
+    for key, value in sorted(client.stats().items()):
+        print("    {:>16}: {}".format(key, value))
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
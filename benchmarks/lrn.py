@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares the padded window sum of :class:`.LRNLayer` with the previous
+implementation, which summed the squares over neighbouring channels with a
+`full` convolution. The shapes are the inputs of norm1 and norm2 in
+models/alexnet.yaml.
+"""
+import time
+
+import numpy as np
+import theano
+import theano.tensor as T
+from theano.tensor.nnet import conv2d
+
+from bernet.layer import LRNLayer
+
+ALEXNET_LRNS = [
+    ("norm1", (10, 96, 55, 55)),
+    ("norm2", (10, 256, 27, 27)),
+]
+REPEATS = 10
+
+
+def conv_based(input, layer):
+    sq = T.sqr(input)
+    nb_chans = input.shape[1]
+    start = layer.n // 2
+    end = start + nb_chans
+    sq = sq.reshape((sq.shape[0], 1, sq.shape[1], -1))
+    filter = T.ones((1, 1, layer.n, 1))
+    conved = conv2d(input=sq, filters=filter, border_mode='full')
+    conved = conved.reshape((input.shape[0], -1, input.shape[2],
+                             input.shape[3]))
+    scaled = layer.k + (layer.alpha / layer.n) * conved[:, start:end, :, :]
+    return input / scaled ** layer.beta
+
+
+def window_sum(input, layer):
+    return layer.output(input)
+
+
+def benchmark(fn, *args):
+    fn(*args)
+    start = time.time()
+    for _ in range(REPEATS):
+        fn(*args)
+    return (time.time() - start) / REPEATS
+
+
+def main():
+    floatX = theano.config.floatX
+    print("{:>6} | {:>8} | {:>10} | {:>16} | {:>8}".format(
+        "layer", "pass", "conv [ms]", "window sum [ms]", "speedup"))
+    for name, input_shape in ALEXNET_LRNS:
+        layer = LRNLayer(name=name, n=5, alpha=0.0001, beta=0.75, k=1.)
+        x_np = np.random.standard_normal(input_shape).astype(floatX)
+        x = T.tensor4('x')
+        fns = {'forward': [], 'backward': []}
+        for impl in [conv_based, window_sum]:
+            out = impl(x, layer)
+            fns['forward'].append(theano.function([x], out))
+            fns['backward'].append(theano.function([x], T.grad(out.sum(), x)))
+        for pass_name in ['forward', 'backward']:
+            times = [benchmark(fn, x_np) for fn in fns[pass_name]]
+            print("{:>6} | {:>8} | {:10.2f} | {:16.2f} | {:7.2f}x".format(
+                name, pass_name, 1000*times[0], 1000*times[1],
+                times[0] / times[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares the zero padded `same` convolution of :class:`.ConvLayer` with the
+previous implementation, which computed a `full` convolution and cropped
+the border. The shapes are the `same` layers of models/alexnet.yaml without
+groups.
+"""
+import time
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from bernet.layer import ConvLayer, Parameter
+
+# name, input_shape, num_feature_maps, kernel size
+ALEXNET_SAME_CONVS = [
+    ("conv2", (10, 96, 27, 27), 256, 5),
+    ("conv3", (10, 256, 13, 13), 384, 3),
+]
+REPEATS = 10
+
+
+def full_and_crop(x, layer):
+    out = T.nnet.conv2d(input=x,
+                        image_shape=layer.input_shape,
+                        filters=layer.weight.shared,
+                        filter_shape=layer.filter_shape(),
+                        border_mode='full')
+    border_h = (layer.kernel_h - 1) // 2
+    border_w = (layer.kernel_w - 1) // 2
+    return out[:, :, border_h:border_h+layer.input_shape[2],
+               border_w:border_w+layer.input_shape[3]]
+
+
+def padded(x, layer):
+    return layer._conv2d(x)
+
+
+def benchmark(fn, *args):
+    fn(*args)
+    start = time.time()
+    for _ in range(REPEATS):
+        fn(*args)
+    return (time.time() - start) / REPEATS
+
+
+def main():
+    floatX = theano.config.floatX
+    print("{:>6} | {:>15} | {:>12} | {:>12}".format(
+        "layer", "full+crop [ms]", "padded [ms]", "speedup"))
+    for name, input_shape, n_filters, kernel in ALEXNET_SAME_CONVS:
+        layer = ConvLayer(name=name, input_shape=input_shape,
+                          num_feature_maps=n_filters,
+                          kernel_h=kernel, kernel_w=kernel,
+                          border_mode='same',
+                          weight=Parameter(name=name + "_weight"),
+                          bias=Parameter(name=name + "_bias"))
+        layer.fill_parameters()
+        x_np = np.random.standard_normal(input_shape).astype(floatX)
+        x = T.tensor4('x')
+        times = []
+        for impl in [full_and_crop, padded]:
+            times.append(benchmark(theano.function([x], impl(x, layer)),
+                                   x_np))
+        print("{:>6} | {:15.2f} | {:12.2f} | {:11.2f}x".format(
+            name, 1000*times[0], 1000*times[1], times[0] / times[1]))
+
+
+if __name__ == "__main__":
+    main()
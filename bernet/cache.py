@@ -0,0 +1,190 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+import theano
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class _unpickle_without_reoptimization(object):
+    def __enter__(self):
+        self.saved = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        theano.config.reoptimize_unpickled_function = self.saved
+
+
+class _SharedPickler(pickle.Pickler):
+    """Replaces the given shared variables, their containers and values by
+    a persistent id. The compiled function is stored without the parameter
+    values and is bound to the live shared variables when it is loaded."""
+
+    def __init__(self, file, shared_variables):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._ids = {}
+        for name, var in shared_variables.items():
+            self._ids[id(var)] = ('variable', name)
+            self._ids[id(var.container)] = ('container', name)
+            self._ids[id(var.container.storage)] = ('storage', name)
+            self._ids[id(var.container.storage[0])] = ('value', name)
+
+    def persistent_id(self, obj):
+        return self._ids.get(id(obj))
+
+
+class _SharedUnpickler(pickle.Unpickler):
+    def __init__(self, file, shared_variables):
+        super().__init__(file)
+        self._shared_variables = shared_variables
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        if name not in self._shared_variables:
+            raise pickle.UnpicklingError(
+                "Shared variable `{}` is not available.".format(name))
+        var = self._shared_variables[name]
+        if kind == 'variable':
+            return var
+        elif kind == 'container':
+            return var.container
+        elif kind == 'storage':
+            return var.container.storage
+        elif kind == 'value':
+            return var.container.storage[0]
+        raise pickle.UnpicklingError("Unknown persistent id `{}`."
+                                     .format(pid))
+
+
+class FunctionCache(object):
+    """
+    On-disk cache of compiled Theano functions.
+
+    A function is stored under a key, which should be a content hash of
+    everything the compiled graph depends on (see :meth:`.key`). The values
+    of the shared variables are not stored. When a function is loaded from
+    the cache it is bound to the given live shared variables, so it sees
+    the current parameters of the network.
+
+    .. code-block:: python
+
+        net.function_cache = FunctionCache()
+        net.forward(x)
+        print(net.function_cache.stats())
+
+    """
+    DEFAULT_DIR = os.path.expanduser("~/.bernet/cache/")
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = self.DEFAULT_DIR
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.compile_seconds = 0.
+        self.saved_seconds = 0.
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Returns a sha256 hash of `parts`, the Theano version, mode and
+        floatX. `parts` must be serializable to json."""
+        env = [theano.__version__, str(theano.config.mode),
+               theano.config.floatX, theano.config.device]
+        data = json.dumps([env, list(parts)], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def get_or_compile(self, key, compile, shared_variables):
+        """
+        Returns the function cached under `key`. If there is no such
+        function, `compile` is called and its result is cached.
+
+        :param key: see :meth:`.key`
+        :param compile: a callable without arguments returning the
+            compiled function.
+        :param shared_variables: dict of unique names to the shared
+            variables used by the function.
+        """
+        fn = self._load(key, shared_variables)
+        if fn is not None:
+            return fn
+
+        self.misses += 1
+        start = time.time()
+        fn = compile()
+        compile_time = time.time() - start
+        self.compile_seconds += compile_time
+        self._store(key, fn, compile_time, shared_variables)
+        return fn
+
+    def _load(self, key, shared_variables):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+
+        start = time.time()
+        try:
+            with open(path, 'rb') as f, _unpickle_without_reoptimization():
+                entry = _SharedUnpickler(f, shared_variables).load()
+        except Exception as e:
+            print("Could not load cached function {}: {}".format(path, e))
+            return None
+        load_time = time.time() - start
+        self.hits += 1
+        self.saved_seconds += max(entry['compile_time'] - load_time, 0.)
+        return entry['function']
+
+    def _store(self, key, fn, compile_time, shared_variables):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = {'function': fn, 'compile_time': compile_time}
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                _SharedPickler(f, shared_variables).dump(entry)
+            os.replace(tmp_path, self.path(key))
+        except Exception as e:
+            print("Could not cache function under {}: {}"
+                  .format(self.path(key), e))
+            os.remove(tmp_path)
+
+    def clear(self):
+        if not os.path.exists(self.cache_dir):
+            return
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.pkl'):
+                os.remove(os.path.join(self.cache_dir, file_name))
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'compile_seconds': self.compile_seconds,
+            'saved_seconds': self.saved_seconds,
+        }
+
+    def __str__(self):
+        return "FunctionCache(dir={}, hits={}, misses={}, " \
+               "compile_seconds={:.3f}, saved_seconds={:.3f})" \
+            .format(self.cache_dir, self.hits, self.misses,
+                    self.compile_seconds, self.saved_seconds)
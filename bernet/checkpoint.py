@@ -0,0 +1,119 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Training checkpoints as npz files.
+
+A checkpoint is a dict of arrays. It is written to a temporary file in the
+directory of the checkpoint, which is then renamed, so a crash never leaves
+a partially written checkpoint behind. :class:`.CheckpointWriter` writes in
+a background thread. See :class:`.SupervisedTrainer` for the content.
+"""
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+def save_checkpoint(path, arrays):
+    """Writes the dict `arrays` atomically as npz file to `path`."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path) -> dict:
+    with np.load(path) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints with :func:`.save_checkpoint` in a background
+    thread. :meth:`.write` does not wait for the disk. If the previous
+    checkpoint is still being written, only the latest of the waiting
+    checkpoints is written afterwards.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.n_written = 0
+        self._pending = None
+        self._writing = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, arrays):
+        """Queues the dict `arrays`. They must not be modified afterwards.
+        Raises the error of a previous write, if one failed."""
+        with self._cond:
+            self._raise_error()
+            self._pending = arrays
+            self._cond.notify_all()
+
+    def flush(self):
+        """Waits until all queued checkpoints are written."""
+        with self._cond:
+            while self._pending is not None or self._writing:
+                self._cond.wait()
+            self._raise_error()
+
+    def close(self):
+        """Writes the queued checkpoint and stops the thread."""
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                arrays, self._pending = self._pending, None
+                self._writing = True
+            error = None
+            try:
+                save_checkpoint(self.path, arrays)
+            except Exception as e:
+                error = e
+            with self._cond:
+                self._writing = False
+                if error is None:
+                    self.n_written += 1
+                else:
+                    self._error = error
+                self._cond.notify_all()
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import copy
+import hashlib
 from _yaml import MappingNode
 
 import numpy as np
@@ -20,6 +21,8 @@ import yaml
 from yaml import YAMLObjectMetaclass, SequenceNode, ScalarNode, \
     Loader, Dumper
 
+from bernet.trace import stage
+
 try:
     import simplejson as json
 except ImportError:
@@ -408,11 +411,12 @@ def load(cls, stream, Loader=ConfigLoader):
     Parse the first YAML document in a stream
     and produce the corresponding Python object.
     """
-    loader = Loader(stream)
-    try:
-        return loader.get_single_config_data(cls)
-    finally:
-        loader.dispose()
+    with stage("load", cls=cls.__name__):
+        loader = Loader(stream)
+        try:
+            return loader.get_single_config_data(cls)
+        finally:
+            loader.dispose()
 
 
 class ConfigDumper(Dumper):
@@ -440,6 +444,31 @@ def dump_all(documents, **kwargs):
     return yaml.dump_all(documents, **kwargs)
 
 
+def _primitive(value):
+    if isinstance(value, ConfigObject):
+        return [type(value).__name__,
+                [[name, _primitive(value._get_property(name))]
+                 for name in sorted(value.__config_fields__.keys())]]
+    elif isinstance(value, (list, tuple)):
+        return [_primitive(v) for v in value]
+    elif isinstance(value, dict):
+        return [[str(k), _primitive(v)] for k, v in sorted(value.items())]
+    elif isinstance(value, np.ndarray):
+        return value.tolist()
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    else:
+        return type(value).__name__
+
+
+def config_digest(config_object) -> str:
+    """Returns the sha256 hex digest of the configuration of
+    `config_object`. Two objects with equal configurations have the same
+    digest."""
+    data = json.dumps(_primitive(config_object), sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
 class ConfigObjectMetaclass(YAMLObjectMetaclass):
     """Meta class of :class:`.ConfigObject`."""
 
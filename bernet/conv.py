@@ -0,0 +1,131 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Grouped 2D convolution.
+
+The convolution has the same semantics as :func:`theano.tensor.nnet.conv2d`,
+i.e. the filters are flipped. The input channels and the filters are split
+into `group` consecutive blocks and block `i` of the filters is only applied
+to block `i` of the input channels.
+
+:func:`.grouped_conv2d` is the NumPy implementation, which computes every
+example with im2col and one batched GEMM over the groups and writes all
+groups into a single preallocated output. The Theano graph of
+:class:`.ConvLayer` is a single `conv2d`, which has C and GPU
+implementations. Since Theano 0.10 it has a `num_groups` argument, see
+:data:`.CONV2D_NUM_GROUPS`. Before, the grouped convolution is a
+convolution over all channels with :func:`.block_diagonal_filters`.
+
+`padding` is given as `((top, bottom), (left, right))` zeros.
+"""
+import inspect
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import theano.tensor as T
+
+NO_PADDING = ((0, 0), (0, 0))
+# Theano's conv2d computes grouped convolutions itself
+CONV2D_NUM_GROUPS = \
+    'num_groups' in inspect.signature(T.nnet.conv2d).parameters
+
+
+def conv_output_size(size, kernel, stride, padding):
+    return (size + padding[0] + padding[1] - kernel) // stride + 1
+
+
+def border_padding(border_mode, kernel_shape):
+    """Returns the padding of a `valid` or `full` convolution."""
+    if border_mode == 'valid':
+        return NO_PADDING
+    elif border_mode == 'full':
+        return tuple((k - 1, k - 1) for k in kernel_shape)
+    raise ValueError("Unknown border mode `{}`.".format(border_mode))
+
+
+def same_padding(size, kernel, stride=1):
+    """Returns the `(begin, end)` padding of a `same` convolution. The
+    output has `ceil(size / stride)` elements and the input is centered."""
+    out = -(-size // stride)
+    total = max((out - 1) * stride + kernel - size, 0)
+    return total - total // 2, total // 2
+
+
+def pad(x, padding):
+    """Returns `x` with zeros padded around the last two axes."""
+    (top, bottom), (left, right) = padding
+    if top == bottom == left == right == 0:
+        return x
+    shape = x.shape[:-2] + (x.shape[-2] + top + bottom,
+                            x.shape[-1] + left + right)
+    padded = np.zeros(shape, dtype=x.dtype)
+    padded[..., top:top+x.shape[-2], left:left+x.shape[-1]] = x
+    return padded
+
+
+def im2col(x, kernel_shape, stride, padding=NO_PADDING):
+    """Returns a strided view of shape
+    `(batch, channels, kernel_h, kernel_w, out_h, out_w)`. No data is
+    copied unless `x` has to be padded."""
+    x = pad(x, padding)
+    kh, kw = kernel_shape
+    sh, sw = stride
+    b, c, h, w = x.shape
+    oh = conv_output_size(h, kh, sh, NO_PADDING[0])
+    ow = conv_output_size(w, kw, sw, NO_PADDING[1])
+    s = x.strides
+    return as_strided(x, shape=(b, c, kh, kw, oh, ow),
+                      strides=(s[0], s[1], s[2], s[3], s[2]*sh, s[3]*sw))
+
+
+def _grouped_filters(w, group):
+    """Flips the filters and reshapes them to
+    `(group, filters per group, channels per group * kernel_h * kernel_w)`.
+    """
+    f = w.shape[0]
+    return w[:, :, ::-1, ::-1].reshape(group, f // group, -1)
+
+
+def grouped_conv2d(x, w, group=1, stride=(1, 1), padding=NO_PADDING,
+                   out=None):
+    """Convolves `x` of shape `(batch, channels, h, w)` with the filters `w`
+    of shape `(filters, channels // group, kernel_h, kernel_w)`."""
+    b = x.shape[0]
+    f = w.shape[0]
+    windows = im2col(x, w.shape[2:], stride, padding)
+    oh, ow = windows.shape[-2:]
+    filters = _grouped_filters(w, group)
+    if out is None:
+        out = np.empty((b, f, oh, ow), dtype=np.result_type(x, w))
+    out_groups = out.reshape(b, group, f // group, oh*ow)
+    for i in range(b):
+        cols = windows[i].reshape(group, filters.shape[-1], oh*ow)
+        np.matmul(filters, cols, out=out_groups[i])
+    return out
+
+
+def block_diagonal_filters(w, group):
+    """Returns the symbolic filters of shape
+    `(filters, channels, kernel_h, kernel_w)` of a convolution over all
+    channels, that equals the grouped convolution with the filters `w`.
+    Block `i` of the filters connects only block `i` of the channels, all
+    other weights are zero."""
+    f, cg = w.shape[0], w.shape[1]
+    fg = f // group
+    filters = T.zeros((f, cg * group, w.shape[2], w.shape[3]),
+                      dtype=w.dtype)
+    for i in range(group):
+        filters = T.set_subtensor(
+            filters[fg*i:fg*(i+1), cg*i:cg*(i+1)], w[fg*i:fg*(i+1)])
+    return filters
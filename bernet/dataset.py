@@ -18,12 +18,15 @@ import pickle
 from multiprocessing import Pipe, Process
 
 import numpy as np
-from bernet.utils import chunks, load_images, download
+from bernet.utils import chunks, load_images, download, as_floatX
 
 
 class Epoche(object):
     def __init__(self, data, labels=None):
-        self._data = data
+        # the data and labels are copied to shared variables of floatX
+        self._data = as_floatX(data)
+        if labels is not None:
+            labels = as_floatX(labels)
         self._labels = labels
 
     def n_examples(self) -> int:
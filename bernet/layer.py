@@ -11,32 +11,115 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import hashlib
+import multiprocessing
 import random
+import threading
+import zlib
 
 import numpy as np
 import re
+import scipy.sparse
 import theano
 from theano.ifelse import ifelse
 import theano.tensor as T
-from theano.tensor.nnet import conv2d
 import theano.tensor.signal.downsample
+import theano.sparse
 from yaml import ScalarNode, SequenceNode, MappingNode
 
 from bernet.config import REQUIRED, OPTIONAL, TAGS, REPEAT, ConfigObject, \
     ConfigField, ENUM, config_error, EITHER
+from bernet.conv import border_padding, same_padding, conv_output_size, \
+    NO_PADDING, grouped_conv2d, block_diagonal_filters, CONV2D_NUM_GROUPS
+from bernet.pool import pool2d, pool_output_size
 
-from bernet.utils import chans, bs, w, h, fast_compile, prod
+from bernet.utils import chans, bs, w, h, fast_compile, prod, floatX, \
+    as_floatX
 
 # # # # # # # # # # # # # # # # # - Utilities - # # # # # # # # # # # # # # # #
 
 
+# elements per chunk of :meth:`.Filler.fill`
+FILL_CHUNK_SIZE = 2**20
+# threads that fill the chunks of large parameters
+try:
+    FILL_THREADS = multiprocessing.cpu_count()
+except NotImplementedError:
+    FILL_THREADS = 1
+
+
+def random_stream(seed):
+    """Returns a :class:`numpy.random.Generator` seeded with `seed`, an int
+    or a list of ints. NumPy before 1.17 has no Generator, then a
+    :class:`numpy.random.RandomState` is returned. The two produce
+    different numbers for the same seed."""
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
+
+
+def _random_sample(stream, shape):
+    if hasattr(stream, 'random'):
+        return stream.random(shape)
+    return stream.random_sample(shape)
+
+
 class Filler(ConfigObject):
+    """
+    Fills the parameters. The array is filled in chunks of
+    `FILL_CHUNK_SIZE` elements. Every chunk has its own random stream
+    seeded with the seed of the array and the index of the chunk. Large
+    arrays are filled by `FILL_THREADS` threads in parallel, and the values
+    do not depend on the number of threads.
+    """
+
     @staticmethod
-    def _apply_sparsity(sparsity, param):
-        if sparsity is not None:
-            param *= np.random.binomial(n=1, p=1.-sparsity, size=param.shape)
+    def _apply_sparsity(sparsity, param, stream=np.random):
+        if sparsity:
+            param[_random_sample(stream, param.shape) < sparsity] = 0
+
+    def fill(self, shape, seed=None, dtype=None, n_threads=None):
+        """
+        Returns a new array of `shape` and `dtype`, which defaults to
+        :func:`.floatX`. The values are written in place in `dtype`.
+
+        :param seed: an int or a list of ints. Without a seed, one is drawn
+            from the global `np.random`.
+        :param n_threads: defaults to `FILL_THREADS`.
+        """
+        if seed is None:
+            seed = np.random.randint(2**31)
+        seed = list(seed) if isinstance(seed, (list, tuple)) else [seed]
+        if n_threads is None:
+            n_threads = FILL_THREADS
+        param = np.empty(shape, dtype=dtype or floatX())
+        flat = param.reshape(-1)
+        chunk_size = FILL_CHUNK_SIZE
+        n_chunks = -(-flat.size // chunk_size)
+
+        def fill_chunks(chunk_indices):
+            for i in chunk_indices:
+                chunk = flat[i*chunk_size:(i+1)*chunk_size]
+                stream = random_stream(seed + [i])
+                self._fill(stream, chunk)
+                self._apply_sparsity(getattr(self, 'sparsity', None),
+                                     chunk, stream)
+
+        n_threads = min(n_threads, n_chunks)
+        if n_threads <= 1:
+            fill_chunks(range(n_chunks))
+        else:
+            threads = [threading.Thread(target=fill_chunks,
+                                        args=(range(t, n_chunks, n_threads),))
+                       for t in range(n_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return param
 
-    def fill(self, shape):
+    def _fill(self, stream, out):
+        """Writes the values to the 1-d array `out`."""
         raise NotImplementedError("Please use a subclass of Filler")
 
 
@@ -44,11 +127,8 @@ class ConstFiller(Filler):
     const_value = REQUIRED(float)
     sparsity = OPTIONAL(float, default=0.)
 
-    def fill(self, shape):
-        param = np.empty(shape)
-        param.fill(self.const_value)
-        self._apply_sparsity(self.sparsity, param)
-        return param
+    def _fill(self, stream, out):
+        out.fill(self.const_value)
 
 
 class UniformFiller(Filler):
@@ -56,10 +136,14 @@ class UniformFiller(Filler):
     high = REQUIRED(float)
     sparsity = OPTIONAL(float, default=0.)
 
-    def fill(self, shape):
-        param = np.random.uniform(low=self.low, high=self.high, size=shape)
-        self._apply_sparsity(self.sparsity, param)
-        return param
+    def _fill(self, stream, out):
+        if hasattr(stream, 'random') and out.dtype in (np.float32,
+                                                       np.float64):
+            stream.random(out=out, dtype=out.dtype)
+        else:
+            out[:] = stream.random_sample(out.shape)
+        out *= self.high - self.low
+        out += self.low
 
 
 class GaussianFiller(Filler):
@@ -67,10 +151,14 @@ class GaussianFiller(Filler):
     std = OPTIONAL(float, default=1.)
     sparsity = OPTIONAL(float, default=0.)
 
-    def fill(self, shape):
-        param = self.std*np.random.standard_normal(size=shape) + self.mean
-        self._apply_sparsity(self.sparsity, param)
-        return param
+    def _fill(self, stream, out):
+        if hasattr(stream, 'random') and out.dtype in (np.float32,
+                                                       np.float64):
+            stream.standard_normal(out=out, dtype=out.dtype)
+        else:
+            out[:] = stream.standard_normal(out.shape)
+        out *= self.std
+        out += self.mean
 
 
 class Shape(REPEAT):
@@ -137,20 +225,101 @@ class Parameter(ConfigObject):
         super().__init__(**kwargs)
         self._tensor = None
         self._shared = None
+        # `indices`, `indptr` and shape of a sparse parameter. Its nonzero
+        # entries are only stored in the shared variable.
+        self._structure = None
+        # sets the tensor on the first use. See :meth:`.defer`.
+        self._deferred = None
+
+    def defer(self, init):
+        """Calls `init`, which sets the tensor, on the first access of the
+        tensor, the shared variable or the value instead of now."""
+        self._deferred = init
+
+    @property
+    def is_deferred(self):
+        return self._deferred is not None
+
+    def _materialize(self):
+        if self._deferred is not None:
+            init, self._deferred = self._deferred, None
+            init()
 
     @property
     def tensor(self):
+        self._materialize()
+        if self._structure is not None:
+            return self.value
         return self._tensor
 
     @tensor.setter
     def tensor(self, tensor):
-        self._tensor = tensor
-        self._shared = theano.shared(self.tensor, name=self.name)
+        """Sets the value of the parameter. If `tensor` is a scipy sparse
+        matrix, it is stored in CSR format and only the nonzero entries are
+        a shared variable, i.e. only those are trained. The shared variable
+        holds the only copy of them."""
+        self._deferred = None
+        if scipy.sparse.issparse(tensor):
+            tensor = scipy.sparse.csr_matrix(tensor, dtype=floatX())
+            tensor.sort_indices()
+            self._tensor = None
+            self._structure = (tensor.indices, tensor.indptr, tensor.shape)
+            self._shared = theano.shared(tensor.data, name=self.name,
+                                         borrow=True)
+        else:
+            # memory-mapped parameters are not copied. They share the pages
+            # of the file with other processes.
+            borrow = isinstance(tensor, np.memmap) and \
+                tensor.dtype == floatX()
+            self._structure = None
+            self._tensor = tensor if borrow else as_floatX(tensor)
+            self._shared = theano.shared(self._tensor, name=self.name,
+                                         borrow=borrow)
 
     @property
     def shared(self):
+        self._materialize()
         return self._shared
 
+    @property
+    def is_sparse(self):
+        self._materialize()
+        return self._structure is not None
+
+    @property
+    def value(self):
+        """The current value of the shared variable. No data is copied. A
+        sparse parameter is returned as CSR matrix."""
+        if self.is_sparse:
+            indices, indptr, shape = self._structure
+            return scipy.sparse.csr_matrix(
+                (self._shared.get_value(borrow=True), indices, indptr),
+                shape=shape)
+        return self._shared.get_value(borrow=True)
+
+    def structure_digest(self):
+        """Returns a sha256 hash of the `indices`, `indptr` and shape of a
+        sparse parameter. They are constants of the compiled functions.
+        Returns `None` for a dense parameter."""
+        if not self.is_sparse:
+            return None
+        sha = hashlib.sha256()
+        for array in self._structure:
+            sha.update(np.ascontiguousarray(array, dtype=np.int64).data)
+        return sha.hexdigest()
+
+    def symbolic(self):
+        """Returns the shared variable or, if the parameter is sparse, a
+        symbolic CSR matrix of the shared nonzero entries."""
+        if not self.is_sparse:
+            return self._shared
+        indices, indptr, shape = self._structure
+        return theano.sparse.CSR(
+            self._shared,
+            T.constant(indices.astype(np.int32)),
+            T.constant(indptr.astype(np.int32)),
+            T.constant(np.asarray(shape, dtype=np.int32)))
+
 
 class NotConnectedException(Exception):
     pass
@@ -199,14 +368,55 @@ class Layer(ConfigObject):
         return self._output(reshaped_input)
 
     def output_shape(self, input_shape: tuple):
+        """Returns the shape of the output for an input of `input_shape`.
+        Subclasses compute it in closed form. This default falls back to
+        :meth:`.symbolic_output_shape`."""
+        return self.symbolic_output_shape(input_shape)
+
+    def macs(self, input_shape: tuple) -> int:
+        """Returns the number of multiply-accumulates to compute the output
+        for an input of `input_shape`. Layers without products count one
+        per elementary operation, e.g. a comparison or an addition. Layers
+        that only copy values count 0."""
+        return 0
+
+    def constants_digest(self):
+        """Returns a sha256 hash of the arrays, that are constants in the
+        graph of the layer, but not part of its configuration, e.g. loaded
+        from a file. Returns `None` if there are none."""
+        return None
+
+    def symbolic_output_shape(self, input_shape: tuple):
+        """Returns the output shape by compiling and evaluating the shape of
+        the symbolic output. This is slow and only a fallback."""
         batch_size = input_shape[0]
-        out = self.output(T.zeros((1,) + input_shape[1:]))
+        out = self.output(T.zeros((1,) + tuple(input_shape[1:])))
         with fast_compile():
             return (batch_size,) + tuple(out.shape.eval())[1:]
 
+    def np_output(self, input: np.ndarray):
+        """Computes the output of the layer with NumPy. The result is the
+        same as the one of :meth:`.output`, but nothing is compiled."""
+        reshaped_input = self._np_reshape(input)
+        return self._np_output(reshaped_input)
+
     def _output(self, input):
         raise NotImplementedError("Please use a subclass of Layer")
 
+    def _np_output(self, input):
+        raise NotImplementedError("Please use a subclass of Layer")
+
+    def _np_reshape(self, input: np.ndarray):
+        expected = self._expected_shape()
+        if expected is not None:
+            return input.reshape(expected)
+
+        max_dims = self._reshape_dims()
+        if input.ndim > max_dims:
+            return input.reshape(input.shape[:max_dims-1] + (-1,))
+
+        return input
+
     def _reshape(self, input: 'Theano Expression'):
         expected = self._expected_shape()
 
@@ -227,6 +437,19 @@ class Layer(ConfigObject):
 
         return input
 
+    def _reshaped_shape(self, input_shape: tuple):
+        """Returns the shape of the input after :meth:`._reshape`."""
+        expected = self._expected_shape()
+        if expected is not None:
+            return tuple(expected)
+
+        max_dims = self._reshape_dims()
+        if len(input_shape) > max_dims:
+            return tuple(input_shape[:max_dims-1]) + \
+                (prod(input_shape[max_dims-1:]),)
+
+        return tuple(input_shape)
+
     def _reshape_dims(self):
         return 4
 
@@ -238,6 +461,31 @@ class ParameterLayer(Layer):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.parameters = []
+        # an :class:`.ActivationLayer` that is applied to the output. It is
+        # set by :meth:`.FeedForwardNet.fuse_layers`.
+        self.activation = None
+
+    def linear_output(self, input: 'Theano Expression'):
+        """Returns the output without the fused activation."""
+        return self._linear_output(self._reshape(input))
+
+    def _output(self, input):
+        out = self._linear_output(input)
+        if self.activation is not None:
+            out = self.activation._output(out)
+        return out
+
+    def _np_output(self, input):
+        out = self._np_linear_output(input)
+        if self.activation is not None:
+            out = self.activation._np_output_inplace(out)
+        return out
+
+    def _linear_output(self, input):
+        raise NotImplementedError("Please use a subclass of Layer")
+
+    def _np_linear_output(self, input):
+        raise NotImplementedError("Please use a subclass of Layer")
 
     def parameter_shape(self, param: 'Parameter|str'):
         if type(param) == str:
@@ -253,11 +501,31 @@ class ParameterLayer(Layer):
     def _parameter_shape(self, param: Parameter):
         raise NotImplementedError("Please use a subclass of Layer")
 
-    def fill_parameter(self, param: 'Parameter|str'):
+    def fill_parameter(self, param: 'Parameter|str', seed=None, lazy=False):
+        """
+        Fills `param` with its filler.
+
+        :param seed: the stream of the parameter is seeded with `seed` and
+            its name. Without a seed, one is drawn from `np.random`.
+        :param lazy: fill the parameter on its first use.
+        """
         if type(param) == str:
             param = self._param_by_name(param)
+        if seed is None:
+            seed = np.random.randint(2**31)
+        seed = [seed, zlib.crc32(param.name.encode('utf-8'))]
+
+        def fill():
+            tensor = param.filler.fill(self.parameter_shape(param), seed)
+            self.set_parameter(param, tensor)
+
+        if lazy:
+            param.defer(fill)
+        else:
+            fill()
 
-        param.tensor = param.filler.fill(self.parameter_shape(param))
+    def set_parameter(self, param: Parameter, tensor):
+        param.tensor = tensor
 
     def fill_parameters(self):
         for p in self.parameters:
@@ -312,71 +580,112 @@ class ConvLayer(ParameterLayer):
         shp = self.filter_shape()
         return shp[0],
 
+    # The batch size of `input_shape` is not fixed. Only the channels and
+    # the spatial shape are static, so a compiled function accepts batches
+    # of any size.
     def _reshape(self, input: 'Theano Expression'):
-        return T.reshape(input, self.input_shape)
+        return T.reshape(input, (input.shape[0],) +
+                         tuple(self.input_shape[1:]), ndim=4)
 
-    def _output(self, input):
+    def _np_reshape(self, input: np.ndarray):
+        return input.reshape((input.shape[0],) + tuple(self.input_shape[1:]))
+
+    def _linear_output(self, input):
         assert self.weight.tensor is not None
-        in_chan = chans(self.input_shape) // self.group
-        f = self.num_feature_maps // self.group
-        filter_shape = (f, ) + self.filter_shape()[1:]
-        input_shape = self.input_shape[:1] + (in_chan, ) + self.input_shape[2:]
-        conv_outs = []
-        if self.border_mode == 'same':
-            assert self.stride_h == 1 and self.stride_v == 1
-            border_mode = 'full'
+        if self.group == 1:
+            conv_out = self._conv2d(input)
         else:
-            border_mode = self.border_mode
-        for i in range(self.group):
-            conv_out = T.nnet.conv2d(
-                input=input[:, in_chan*i:in_chan*(i+1), :],
-                image_shape=input_shape,
-                filters=self.weight.shared[f*i:f*(i+1), :],
-                filter_shape=filter_shape,
-                subsample=(self.stride_h, self.stride_v),
-                border_mode=border_mode,
-            )
-            if self.border_mode == 'same':
-                conv_out = self._fix_same_border_mode(conv_out)
-            conv_outs.append(conv_out)
-
-        concated = T.concatenate(conv_outs, axis=1)
+            conv_out = self._grouped_conv2d(input)
+
         if self.bias is None:
-            return concated
+            return conv_out
+        else:
+            return conv_out + self.bias.shared.dimshuffle('x', 0, 'x', 'x')
+
+    def _conv2d(self, input, filters=None, filter_shape=None, **kwargs):
+        """Returns Theano's conv2d of `input` with the `filters`, by default
+        the weight. `kwargs` are passed to conv2d."""
+        if filters is None:
+            filters = self.weight.shared
+        if filter_shape is None:
+            filter_shape = self.filter_shape()
+        padding = self._padding()
+        if padding == NO_PADDING or self.border_mode == 'full':
+            border_mode = self.border_mode
+            if border_mode == 'same':
+                border_mode = 'valid'
+            image_shape = self.input_shape
         else:
-            return concated + self.bias.shared.dimshuffle('x', 0, 'x', 'x')
+            input = self._pad(input, padding)
+            border_mode = 'valid'
+            (top, bottom), (left, right) = padding
+            image_shape = self.input_shape[:2] + (
+                h(self.input_shape) + top + bottom,
+                w(self.input_shape) + left + right)
+
+        return T.nnet.conv2d(
+            input=input,
+            image_shape=(None,) + tuple(image_shape[1:]),
+            filters=filters,
+            filter_shape=filter_shape,
+            subsample=(self.stride_h, self.stride_v),
+            border_mode=border_mode,
+            **kwargs
+        )
 
-    def output_shape(self, in_shp: tuple):
+    @staticmethod
+    def _pad(input, padding):
+        """Pads `input` with zeros, so that a `valid` convolution only
+        computes the output pixels that are kept."""
+        (top, bottom), (left, right) = padding
+        in_h = input.shape[2]
+        in_w = input.shape[3]
+        padded = T.zeros((input.shape[0], input.shape[1],
+                          in_h + top + bottom, in_w + left + right),
+                         dtype=input.dtype)
+        return T.set_subtensor(
+            padded[:, :, top:top+in_h, left:left+in_w], input)
+
+    def _padding(self, input_shape=None):
+        if input_shape is None:
+            input_shape = self.input_shape
         if self.border_mode == 'same':
-            return (in_shp[0],) + (self.num_feature_maps,) + in_shp[2:]
-
-        batch_size = bs(in_shp)
-        channels = self.num_feature_maps  # * chans(input_shape)
-        miss_h = self.kernel_h - 1
-        miss_w = self.kernel_w - 1
-        # maximum possible step, if stride_X = 1.
-        if self.border_mode == "valid":
-            max_steps_h = h(in_shp) - miss_h
-            max_steps_w = w(in_shp) - miss_w
-        elif self.border_mode == "full":
-            max_steps_h = h(in_shp) + miss_h
-            max_steps_w = w(in_shp) + miss_w
-        height = max_steps_h // self.stride_h
-        width = max_steps_w // self.stride_v
-        if max_steps_h % self.stride_h != 0:
-            height += 1
-        if max_steps_w % self.stride_v != 0:
-            width += 1
-        return batch_size, channels, height, width
-
-    def _fix_same_border_mode(self, conv_out):
-        hb = (conv_out.shape[-2] - h(self.input_shape)) // 2
-        he = hb + h(self.input_shape)
-
-        wb = (conv_out.shape[-1] - w(self.input_shape)) // 2
-        we = wb + w(self.input_shape)
-
-        return conv_out[:, :, hb:he, wb:we]
+            return (same_padding(h(input_shape), self.kernel_h,
+                                 self.stride_h),
+                    same_padding(w(input_shape), self.kernel_w,
+                                 self.stride_v))
+        return border_padding(self.border_mode,
+                              (self.kernel_h, self.kernel_w))
+
+    def _grouped_conv2d(self, input):
+        """Computes all groups with a single conv2d, see :mod:`bernet.conv`.
+        """
+        if CONV2D_NUM_GROUPS:
+            return self._conv2d(input, num_groups=self.group)
+        filters = block_diagonal_filters(self.weight.shared, self.group)
+        filter_shape = (self.num_feature_maps, chans(self.input_shape),
+                        self.kernel_h, self.kernel_w)
+        return self._conv2d(input, filters, filter_shape)
+
+    def _np_linear_output(self, input):
+        out = grouped_conv2d(input, self.weight.value, self.group,
+                             stride=(self.stride_h, self.stride_v),
+                             padding=self._padding())
+        if self.bias is not None:
+            out += self.bias.value.reshape(1, -1, 1, 1)
+        return out
+
+    def output_shape(self, in_shp: tuple):
+        padding = self._padding(in_shp)
+        height = conv_output_size(h(in_shp), self.kernel_h, self.stride_h,
+                                  padding[0])
+        width = conv_output_size(w(in_shp), self.kernel_w, self.stride_v,
+                                 padding[1])
+        return bs(in_shp), self.num_feature_maps, height, width
+
+    def macs(self, input_shape: tuple):
+        return prod(self.output_shape(input_shape)) * \
+            (input_shape[1] // self.group) * self.kernel_h * self.kernel_w
 
 register_layer("Conv", ConvLayer)
 
@@ -386,6 +695,11 @@ class InnerProductLayer(ParameterLayer):
     weight = OPTIONAL(Parameter)
     bias = OPTIONAL(EITHER(Parameter, bool))
     input_shape = REQUIRED(Shape(dims=2), doc="Shape of the input tensor.")
+    sparse_threshold = OPTIONAL(
+        float, default=0.9,
+        doc="The weight is stored as sparse CSR matrix, if at least this "
+            "fraction of its entries is zero. The zeros are then skipped "
+            "in the forward pass and in the updates.")
 
     def __init__(self, **kwargs):
         if "weight" not in kwargs:
@@ -408,28 +722,82 @@ class InnerProductLayer(ParameterLayer):
         elif param == self.bias:
             return self.n_units,
 
+    def set_parameter(self, param: Parameter, tensor):
+        if param == self.weight and not scipy.sparse.issparse(tensor) and \
+                self.sparse_threshold is not None and tensor.size > 0 and \
+                1. - np.count_nonzero(tensor) / tensor.size >= \
+                self.sparse_threshold:
+            tensor = scipy.sparse.csr_matrix(tensor)
+        super().set_parameter(param, tensor)
+
     def _reshape_dims(self):
         return 2
 
-    def _output(self, input):
-        ip = T.dot(input, self.weight.shared.T)
+    def _linear_output(self, input):
+        if self.weight.is_sparse:
+            ip = theano.sparse.structured_dot(self.weight.symbolic(),
+                                              input.T).T
+        else:
+            ip = T.dot(input, self.weight.shared.T)
         if self.bias is not None:
             return ip + self.bias.shared
         else:
             return ip
 
+    def _np_linear_output(self, input):
+        if self.weight.is_sparse:
+            ip = np.ascontiguousarray(self.weight.value.dot(input.T).T)
+        else:
+            ip = np.dot(input, self.weight.value.T)
+        if self.bias is not None:
+            ip += self.bias.value
+        return ip
+
     def output_shape(self, input_shape: tuple):
         return input_shape[0], self.n_units
 
+    def macs(self, input_shape: tuple):
+        # the zeros of a sparse weight are skipped. A deferred weight is
+        # not filled to find out.
+        if not self.weight.is_deferred and self.weight.is_sparse:
+            return input_shape[0] * self.weight.value.nnz
+        return input_shape[0] * self.n_units * prod(input_shape[1:])
+
 register_layer("InnerProduct", InnerProductLayer)
 
 
 class PoolingLayer(Layer):
-    poolsize = REQUIRED(Shape(max_dims=2))
+    """
+    Max or average pooling over the last two axes.
+
+    If `global_pooling` is set, every feature map is pooled to a single
+    value and `poolsize` and `stride` are not used.
+    """
+    poolsize = OPTIONAL(Shape(max_dims=2))
     stride = OPTIONAL(Shape(max_dims=2), default=(1, 1))
-    ignore_border = OPTIONAL(bool, default=False)
+    ignore_border = OPTIONAL(bool, default=False,
+                             doc="If `False`, the windows may be partial at "
+                                 "the border, i.e. the output size is "
+                                 "rounded up (ceil mode).")
+    mode = OPTIONAL(ENUM("max", "average"), default="max")
+    global_pooling = OPTIONAL(bool, default=False)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.poolsize is None and not self.global_pooling:
+            raise config_error("Either poolsize or global_pooling must be "
+                               "given.")
 
     def _output(self, input):
+        if self.global_pooling:
+            axis = [input.ndim - 2, input.ndim - 1]
+            if self.mode == 'max':
+                return T.max(input, axis=axis, keepdims=True)
+            else:
+                return T.mean(input, axis=axis, keepdims=True)
+
+        if self.mode == 'average':
+            return self._average_pool(input)
         return theano.tensor.signal.downsample.max_pool_2d(
             input=input,
             ds=self.poolsize,
@@ -437,6 +805,68 @@ class PoolingLayer(Layer):
             ignore_border=self.ignore_border
         )
 
+    def _output_size(self, size, pool, stride):
+        """Symbolic version of :func:`.pool_output_size`."""
+        if self.ignore_border:
+            return T.maximum((size - pool) // stride + 1, 0)
+        elif stride >= pool:
+            return (size - 1) // stride + 1
+        else:
+            return T.maximum((size - 1 - pool) // stride + 1, 0) + 1
+
+    def _average_pool(self, input):
+        # theano 0.7's max_pool_2d has no average mode. Sums the strided
+        # window elements of the zero padded input and divides by the
+        # number of elements of each window inside the input.
+        ph, pw = self.poolsize
+        sh, sw = self.stride
+        h, w = input.shape[-2], input.shape[-1]
+        oh = self._output_size(h, ph, sh)
+        ow = self._output_size(w, pw, sw)
+        lead = (slice(None),) * (input.ndim - 2)
+        padded_shape = [input.shape[i] for i in range(input.ndim - 2)] + [
+            T.maximum((oh - 1) * sh + ph, h),
+            T.maximum((ow - 1) * sw + pw, w)]
+        padded = T.zeros(padded_shape, dtype=input.dtype)
+        padded = T.set_subtensor(padded[lead + (slice(None, h),
+                                                slice(None, w))], input)
+        out = None
+        for i in range(ph):
+            for j in range(pw):
+                window = padded[lead + (slice(i, i + sh*(oh-1) + 1, sh),
+                                        slice(j, j + sw*(ow-1) + 1, sw))]
+                out = window if out is None else out + window
+        begin_h = T.arange(oh) * sh
+        begin_w = T.arange(ow) * sw
+        counts = T.outer(T.minimum(begin_h + ph, h) - begin_h,
+                         T.minimum(begin_w + pw, w) - begin_w)
+        return out / T.cast(counts, input.dtype)
+
+    def _np_output(self, input):
+        if self.global_pooling:
+            if self.mode == 'max':
+                return input.max(axis=(-2, -1), keepdims=True)
+            else:
+                return input.mean(axis=(-2, -1), keepdims=True)
+
+        return pool2d(input, self.poolsize, self.stride, self.ignore_border,
+                      mode=self.mode)
+
+    def output_shape(self, input_shape: tuple):
+        if self.global_pooling:
+            return tuple(input_shape[:-2]) + (1, 1)
+
+        return tuple(input_shape[:-2]) + (
+            pool_output_size(input_shape[-2], self.poolsize[0],
+                             self.stride[0], self.ignore_border),
+            pool_output_size(input_shape[-1], self.poolsize[1],
+                             self.stride[1], self.ignore_border))
+
+    def macs(self, input_shape: tuple):
+        if self.global_pooling:
+            return prod(input_shape)
+        return prod(self.output_shape(input_shape)) * prod(self.poolsize)
+
 register_layer("Pooling", PoolingLayer)
 
 # ------------------------- Normalization Layers ------------------------------
@@ -455,24 +885,45 @@ class LRNLayer(Layer):
     beta = OPTIONAL(float, default=0.75)
     k = OPTIONAL(float, default=3.)
 
+    def _window_before(self):
+        """Channel `c` is normalized by the squares of the channels
+        `c - before` to `c - before + n - 1`."""
+        return self.n - 1 - self.n // 2
+
     def _output(self, input):
-        sq = T.sqr(input)
+        # sums the squares over a window of channels by adding `n` shifted
+        # slices of the zero padded squares
+        nb_chans = input.shape[1]
+        before = self._window_before()
+        padded = T.zeros((input.shape[0], nb_chans + self.n - 1,
+                          input.shape[2], input.shape[3]), dtype=input.dtype)
+        padded = T.set_subtensor(padded[:, before:before+nb_chans],
+                                 T.sqr(input))
+        sum_sq = padded[:, :nb_chans]
+        for i in range(1, self.n):
+            sum_sq += padded[:, i:i+nb_chans]
+        scale = self.k + (self.alpha / self.n) * sum_sq
+        return input / scale ** self.beta
+
+    def _np_output(self, input):
         nb_chans = input.shape[1]
-        start = self.n // 2
-        end = start + nb_chans
-        sq = sq.reshape((sq.shape[0], 1, sq.shape[1], -1))
-        filter_shape = (1, 1, self.n, 1)
-        filter = T.ones(filter_shape)
-        conved = conv2d(input=sq, filters=filter, border_mode='full')
-        conved = conved.reshape((input.shape[0], -1, input.shape[2],
-                                 input.shape[3]))
-        scaled = self.k + (self.alpha / self.n) * conved[:, start:end, :, :]
-        scale = scaled ** self.beta
-        return input / scale
+        before = self._window_before()
+        padded = np.zeros((input.shape[0], nb_chans + self.n - 1) +
+                          input.shape[2:], dtype=input.dtype)
+        np.square(input, out=padded[:, before:before+nb_chans])
+        sum_sq = padded[:, :nb_chans].copy()
+        for i in range(1, self.n):
+            sum_sq += padded[:, i:i+nb_chans]
+        scale = self.k + (self.alpha / self.n) * sum_sq
+        return input / scale ** self.beta
 
     def output_shape(self, input_shape: tuple):
         return input_shape
 
+    def macs(self, input_shape: tuple):
+        # the window sum of the squares, the scale and the division
+        return prod(input_shape) * (self.n + 2)
+
 register_layer("LRN", LRNLayer)
 
 # ------------------------- Activation Layers ---------------------------------
@@ -480,13 +931,31 @@ register_layer("LRN", LRNLayer)
 
 class ActivationLayer(Layer):
     def output_shape(self, input_shape: tuple):
-        return input_shape
+        return self._reshaped_shape(input_shape)
+
+    def macs(self, input_shape: tuple):
+        return prod(input_shape)
+
+    def _np_output_inplace(self, input):
+        """Like :meth:`._np_output`, but may overwrite `input`."""
+        return self._np_output(input)
 
 
 class SigmoidLayer(ActivationLayer):
     def _output(self, input):
         return T.nnet.sigmoid(input)
 
+    def _np_output(self, input):
+        # does not overflow for large negative inputs like 1 / (1 + exp(-x))
+        return 0.5 * np.tanh(0.5 * input) + 0.5
+
+    def _np_output_inplace(self, input):
+        input *= 0.5
+        np.tanh(input, out=input)
+        input *= 0.5
+        input += 0.5
+        return input
+
 register_layer("Sigmoid", SigmoidLayer)
 
 
@@ -494,6 +963,12 @@ class ReLULayer(ActivationLayer):
     def _output(self, input):
         return T.clip(input, 0, np.infty)
 
+    def _np_output(self, input):
+        return np.maximum(input, 0)
+
+    def _np_output_inplace(self, input):
+        return np.maximum(input, 0, out=input)
+
 register_layer("ReLU", ReLULayer)
 
 
@@ -501,6 +976,12 @@ class TanHLayer(ActivationLayer):
     def _output(self, input):
         return T.tanh(input)
 
+    def _np_output(self, input):
+        return np.tanh(input)
+
+    def _np_output_inplace(self, input):
+        return np.tanh(input, out=input)
+
 register_layer("TanH", TanHLayer)
 
 
@@ -511,6 +992,15 @@ class SoftmaxLayer(ActivationLayer):
     def _output(self, input):
         return T.nnet.softmax(input)
 
+    def _np_output(self, input):
+        return self._np_output_inplace(input.copy())
+
+    def _np_output_inplace(self, input):
+        input -= input.max(axis=1, keepdims=True)
+        np.exp(input, out=input)
+        input /= input.sum(axis=1, keepdims=True)
+        return input
+
 register_layer("Softmax", SoftmaxLayer)
 
 # --------------------------- Utility Layer -----------------------------------
@@ -522,6 +1012,9 @@ class RGB2BGRLayer(Layer):
         bgr = [c.dimshuffle(0, 'x', 1, 2) for c in [b, g, r]]
         return T.concatenate(bgr, axis=1)
 
+    def _np_output(self, input):
+        return input[:, [2, 1, 0]]
+
     def output_shape(self, input_shape: tuple):
         assert input_shape[1] == 3
         assert len(input_shape) == 4
@@ -540,9 +1033,12 @@ class CropLayer(Layer):
         crop_h = random.randint(0, max_crop_h)
         return input[:, :, crop_h:self.height+crop_h, crop_w:self.width+crop_w]
 
+    def _np_output(self, input):
+        return self._output(input)
+
     def output_shape(self, input_shape: tuple):
-        assert input_shape == self.input_shape
-        return input_shape[:2] + (self.height, self.width)
+        assert tuple(input_shape[1:]) == tuple(self.input_shape[1:])
+        return tuple(input_shape[:2]) + (self.height, self.width)
 
 
 class SubtractMeanLayer(Layer):
@@ -558,7 +1054,7 @@ class SubtractMeanLayer(Layer):
 
         if self.mean_file:
             print(self.mean_file)
-            self.mean_from_file = np.load(self.mean_file)
+            self.mean_from_file = as_floatX(np.load(self.mean_file))
 
     def output(self, input: 'Theano Expression'):
         if self.mean:
@@ -566,6 +1062,21 @@ class SubtractMeanLayer(Layer):
         else:
             return input - self.mean_from_file
 
+    def np_output(self, input: np.ndarray):
+        return self.output(input)
+
+    def constants_digest(self):
+        if not self.mean_file:
+            return None
+        return hashlib.sha256(
+            np.ascontiguousarray(self.mean_from_file).data).hexdigest()
+
+    def output_shape(self, input_shape: tuple):
+        return tuple(input_shape)
+
+    def macs(self, input_shape: tuple):
+        return prod(input_shape)
+
 register_layer("SubtractMean", SubtractMeanLayer)
 
 
@@ -576,6 +1087,15 @@ class ArgMaxLayer(Layer):
     def _output(self, input):
         return T.argmax(input, axis=1)
 
+    def _np_output(self, input):
+        return np.argmax(input, axis=1)
+
+    def output_shape(self, input_shape: tuple):
+        return self._reshaped_shape(input_shape)[:1]
+
+    def macs(self, input_shape: tuple):
+        return prod(input_shape)
+
 register_layer("ArgMax", ArgMaxLayer)
 
 
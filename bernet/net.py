@@ -19,11 +19,17 @@ import theano
 import theano.tensor as T
 
 from bernet import utils
+from bernet.cache import FunctionCache
 from bernet.config import REQUIRED, OPTIONAL, ConfigObject, REPEAT, \
-    ConfigError, ENUM, config_error
-from bernet.layer import ParameterLayer, ANY_LAYER, Shape, Connection
+    ConfigError, ENUM, config_error, config_digest
+from bernet.layer import ParameterLayer, ANY_LAYER, Shape, Connection, \
+    ConvLayer, InnerProductLayer, ReLULayer, TanHLayer, SigmoidLayer, \
+    SoftmaxLayer
 from bernet.loss import NegativeLogLikelihood
-from bernet.utils import symbolic_tensor_from_shape, size
+from bernet.profiling import profile_layers
+from bernet.trace import stage
+from bernet.utils import symbolic_tensor_from_shape, size, bs, \
+    staged_batches
 
 
 class FeedForwardNet(ConfigObject):
@@ -68,92 +74,255 @@ class FeedForwardNet(ConfigObject):
     loss = OPTIONAL(ENUM('NLL', 'MSE'),
                     default=NegativeLogLikelihood(), doc="")
 
+    seed = OPTIONAL(int, doc="Seed of the parameter fillers. Every "
+                             "parameter gets its own random stream seeded "
+                             "with this seed and its name. Without a seed, "
+                             "the fillers are seeded from `np.random`.")
+
+    lazy_init = OPTIONAL(bool, default=False,
+                         doc="Fill the parameters on their first use, e.g. "
+                             "when a function is compiled, instead of on "
+                             "construction.")
+
+    fuse_activations = OPTIONAL(bool, default=False,
+                                doc="Fuse the activation layers into the "
+                                    "preceding layer. See "
+                                    ":meth:`.fuse_layers`.")
+
     MODELS_DIR = os.path.expanduser("~/.bernet/")
 
+    # a local directory with copies of the parameter files, e.g. for
+    # machines without internet access
+    DATA_MIRROR = os.environ.get("BERNET_DATA_MIRROR")
+
+    # number of parallel connections to download the parameter file
+    DOWNLOAD_CONNECTIONS = 4
+
+    # set it to a :class:`.FunctionCache` to load compiled functions from disk
+    function_cache = None
+
+    # set it to a :class:`.Quantization` to use the `int8` engine
+    quantization = None
+
+    # activation layers that can be fused into a preceding layer
+    FUSABLE_ACTIVATIONS = {
+        ConvLayer: (ReLULayer, TanHLayer, SigmoidLayer),
+        InnerProductLayer: (ReLULayer, TanHLayer, SigmoidLayer,
+                            SoftmaxLayer),
+    }
+
     def __init__(self,  **kwargs):
-        super().__init__(**kwargs)
+        with stage("net.config"):
+            super().__init__(**kwargs)
         self.data = {}
+        # names of fused activation layers to the layer they are fused into
+        self.fused = OrderedDict()
+        self._setup_indexes()
         if self.data_url is not None and self.data_sha256 is None:
             raise ConfigError("Field data_url requires data_sha256 to be set")
         if self.data_url is not None:
-            file_name = os.path.join(self.MODELS_DIR,
-                                     kwargs['name'] + "_parameters.npz")
-            data_url = kwargs['data_url']
-            data_sha256 = kwargs['data_sha256']
-            self.data = self._get_data(file_name, data_url, data_sha256)
-        self._setup_connections()
-        self._setup_parameters()
-        self._check_shapes()
-
-    def _get_data(self, file_path, url, sha256_expected):
-        file_dir = os.path.dirname(file_path)
-        if not os.path.exists(file_dir):
-            os.makedirs(file_dir)
-        with open(file_path, "w+b") as f:
-            utils.download(url, f)
-            sha256_got = utils.sha256_of_file(f)
-            if sha256_expected != sha256_got:
-                raise ValueError("The given sha256sum {:} of is not equal to"
-                                 " {:} from the url {:}"
-                                 .format(sha256_expected, sha256_got, url))
-            f.seek(0)
-            npzfile = np.load(f)
-            npz_dict = {n: np.asarray(npzfile[n], dtype=theano.config.floatX)
-                        for n in npzfile.files}
-            parameter_names = [p.name for p in self.parameters()]
-            for name in npz_dict.keys():
-                assert name in parameter_names, \
-                    "Got parameter `{}` in file `{}`, but there is no " \
-                    "parameter in the network with this name.\n" \
-                    "Parameter names in file:    [{}]\n" \
-                    "Parameter names in network: [{}]" \
-                    .format(name, self.data_url,
-                            ", ".join(sorted(npz_dict.keys())),
-                            ", ".join(sorted(parameter_names)))
-            return npz_dict
+            with stage("net.get_data"):
+                self.data = self._get_data(self.data_url, self.data_sha256)
+        with stage("net.setup_connections"):
+            self._setup_connections()
+        with stage("net.setup_parameters"):
+            self._setup_parameters()
+        with stage("net.check_shapes"):
+            self._check_shapes()
+        if self.fuse_activations:
+            with stage("net.fuse_layers"):
+                self.fuse_layers()
+
+    def _get_data(self, url, sha256):
+        """Returns the parameters of the npz file at `url`. The cache is
+        addressed by `sha256`: the npz file is stored as
+        `MODELS_DIR/<sha256>.npz` and only downloaded if no file with this
+        digest exists. Its arrays are converted once to uncompressed npy
+        files in `MODELS_DIR/<sha256>_<floatX>/`, which are memory-mapped."""
+        npy_dir = os.path.join(self.MODELS_DIR,
+                               "{}_{}".format(sha256, utils.floatX()))
+        if not os.path.isdir(npy_dir):
+            npz_path = os.path.join(self.MODELS_DIR, sha256 + ".npz")
+            with stage("fetch"):
+                utils.fetch_verified(url, npz_path, sha256,
+                                     self.DOWNLOAD_CONNECTIONS,
+                                     self.DATA_MIRROR)
+            with stage("convert_npz"):
+                with np.load(npz_path) as npzfile:
+                    parameters = utils.parameters_from_npz(npzfile)
+                utils.save_npy_dir(npy_dir,
+                                   utils.parameters_to_npz(parameters))
+        with stage("mmap"):
+            npz_dict = utils.parameters_from_npz(
+                utils.load_npy_dir(npy_dir))
+        for name in npz_dict.keys():
+            assert name in self._parameter_by_name, \
+                "Got parameter `{}` in file `{}`, but there is no " \
+                "parameter in the network with this name.\n" \
+                "Parameter names in file:    [{}]\n" \
+                "Parameter names in network: [{}]" \
+                .format(name, url,
+                        ", ".join(sorted(npz_dict.keys())),
+                        ", ".join(sorted(self._parameter_by_name)))
+        return npz_dict
+
+    def _setup_indexes(self):
+        """Builds the name indexes of the layers and parameters. The layers
+        and their parameters are fixed after construction, so the indexes
+        are built once."""
+        self._layer_by_name = OrderedDict()
+        self._parameters = []
+        self._parameter_by_name = OrderedDict()
+        for layer in self.layers:
+            self._layer_by_name.setdefault(layer.name, layer)
+            if issubclass(type(layer), ParameterLayer):
+                for param in layer.parameters:
+                    self._parameters.append(param)
+                    self._parameter_by_name.setdefault(param.name, param)
 
     def get_layer(self, name):
         """Return the layer with layer.name == `name`. If no such layer
-        exists, None is returned."""
-        for l in self.layers:
-            if l.name == name:
-                return l
-        raise KeyError("Layer with name {} does not exists.".format(name))
+        exists, a KeyError is raised."""
+        try:
+            return self._layer_by_name[name]
+        except KeyError:
+            raise KeyError("Layer with name {} does not exists."
+                           .format(name)) from None
 
     def parameters(self):
-        params = []
-        for layer in self.layers:
-            if issubclass(type(layer), ParameterLayer):
-                params.extend(layer.parameters)
-        return params
+        """Returns the list of all parameters. The list is cached and must
+        not be modified."""
+        return self._parameters
 
     def parameters_as_shared(self):
         return [p.shared for p in self.parameters()]
 
-    def shape_info(self):
-        input_shape = self.input_shape
+    def infer_shapes(self, input_shape=None):
+        """
+        Propagates `input_shape` through the network with the closed-form
+        :meth:`.Layer.output_shape` of each layer. Nothing is compiled.
+
+        :return: OrderedDict of layer names to `(input_shape, output_shape)`.
+        """
+        if input_shape is None:
+            input_shape = self.input_shape
+        shapes = OrderedDict()
+        for layer in self.layer_iter():
+            if layer is not self.input_layer:
+                input_shape = shapes[layer.source][1]
+            shapes[layer.name] = input_shape, layer.output_shape(input_shape)
+        return shapes
+
+    def _batch_input_shape(self, batch_size=None):
+        if batch_size is None:
+            return tuple(self.input_shape)
+        return (batch_size,) + tuple(self.input_shape[1:])
+
+    def shape_info(self, batch_size=None, dtype=None, optimizer=None):
+        """
+        Returns a dict of the layer names to the `input_shape`,
+        `output_shape` and the static costs of every layer for a batch of
+        `batch_size` examples: the multiply-accumulates `macs` (see
+        :meth:`.Layer.macs`) and the `activation_bytes` of the output.
+        Parameter layers also have the shapes of their `params`, the
+        `parameter_bytes` and the `optimizer_state_bytes` of `optimizer`.
+        A fused activation layer writes into the output of the layer it is
+        fused into and has no activation bytes. See :meth:`.cost_summary`
+        for the totals.
+
+        :param batch_size: defaults to the batch size of `input_shape`.
+        :param dtype: dtype of the activations and parameters. Defaults to
+            `floatX`.
+        :param optimizer: an :class:`.Optimizator`. Without it the
+            optimizer state has 0 bytes.
+        """
+        itemsize = np.dtype(dtype or theano.config.floatX).itemsize
+        n_state_tensors = getattr(optimizer, 'n_state_tensors', 0)
         info = {}
+        shapes = self.infer_shapes(self._batch_input_shape(batch_size))
         for layer in self.layer_iter():
-            output_shape = layer.output_shape(input_shape)
-
+            input_shape, output_shape = shapes[layer.name]
             info[layer.name] = {
                 'output_shape': output_shape,
                 'input_shape': input_shape,
+                'macs': layer.macs(input_shape),
+                'activation_bytes': 0 if layer.name in self.fused
+                else size(output_shape) * itemsize,
             }
             if issubclass(type(layer), ParameterLayer):
                 info[layer.name]['params'] = {}
+                parameter_bytes = 0
                 for param in layer.parameters:
-                    info[layer.name]['params'][param.name] = \
-                        layer.parameter_shape(param)
-
-            input_shape = output_shape
+                    shape = layer.parameter_shape(param)
+                    info[layer.name]['params'][param.name] = shape
+                    parameter_bytes += _parameter_bytes(param, shape,
+                                                        itemsize)
+                info[layer.name]['parameter_bytes'] = parameter_bytes
+                info[layer.name]['optimizer_state_bytes'] = \
+                    n_state_tensors * parameter_bytes
         return info
 
+    def cost_summary(self, batch_size=None, dtype=None, optimizer=None):
+        """
+        Returns the totals of :meth:`.shape_info` over all layers, i.e.
+        `macs`, `activation_bytes`, `parameter_bytes` and
+        `optimizer_state_bytes`, and estimates to plan batch sizes and
+        machines:
+
+        * `peak_activation_bytes`: the maximum bytes of the input and the
+          outputs alive during a forward pass, that frees every output
+          once all layers using it are computed.
+        * `inference_bytes`: the parameters and the peak activations.
+        * `training_macs`: three times the forward `macs`, for the
+          forward pass and the gradients of the inputs and the weights.
+        * `training_bytes`: the input, all activations, which are kept
+          for the backward pass, the parameters, their gradients and the
+          optimizer state.
+        """
+        itemsize = np.dtype(dtype or theano.config.floatX).itemsize
+        info = self.shape_info(batch_size, dtype, optimizer)
+        summary = {key: sum(i.get(key, 0) for i in info.values())
+                   for key in ['macs', 'activation_bytes', 'parameter_bytes',
+                               'optimizer_state_bytes']}
+        input_bytes = size(self._batch_input_shape(batch_size)) * itemsize
+
+        # the buffer of every alive output. A fused activation layer
+        # outputs the buffer of the layer it is fused into. The input is
+        # keyed by None.
+        buffer_of = {None: None}
+        buffer_bytes = {None: input_bytes}
+        n_consumers = {name: len(cons) for name, cons in
+                       self._connections_from_layer.items()}
+        n_consumers[None] = 1
+        peak = input_bytes
+        for layer in self.layer_iter():
+            source = None if layer is self.input_layer else layer.source
+            if layer.name in self.fused:
+                buffer_of[layer.name] = buffer_of[source]
+            else:
+                buffer_of[layer.name] = layer.name
+                buffer_bytes[layer.name] = \
+                    info[layer.name]['activation_bytes']
+            peak = max(peak, sum(buffer_bytes[b]
+                                 for b in set(buffer_of.values())))
+            n_consumers[source] -= 1
+            if n_consumers[source] == 0:
+                del buffer_of[source]
+
+        summary['peak_activation_bytes'] = peak
+        summary['inference_bytes'] = summary['parameter_bytes'] + peak
+        summary['training_macs'] = 3 * summary['macs']
+        summary['training_bytes'] = \
+            input_bytes + summary['activation_bytes'] + \
+            2 * summary['parameter_bytes'] + summary['optimizer_state_bytes']
+        return summary
+
     def get_parameter(self, name):
-        for p in self.parameters():
-            if p.name == name:
-                return p
-        raise KeyError("No parameter with name {}.".format(name))
+        try:
+            return self._parameter_by_name[name]
+        except KeyError:
+            raise KeyError("No parameter with name {}.".format(name)) \
+                from None
 
     def _setup_input_layer(self):
         layers_without_a_source = [l for l in self.layers if l.source is None]
@@ -176,25 +345,83 @@ class FeedForwardNet(ConfigObject):
 
         self.output_layer = self.get_layer(not_used_as_source.pop())
 
+    def output_names(self):
+        """Returns the names of the layers whose outputs are returned by
+        :meth:`.forward`."""
+        return [self.output_layer.name]
+
+    def _pack_outputs(self, outputs: list):
+        return outputs[0]
+
+    def _unpack_outputs(self, packed) -> list:
+        return [packed]
+
     def _setup_connections(self):
         self._setup_input_layer()
-        self._setup_output_layer()
 
         self.connections = []
-        self._connection_from_layer = {}
+        self._connections_from_layer = {}
         self._connection_to_layer = {}
-        layer_dict = {l.name: l for l in self.layers}
-        for l in set(self.layers) - {self.input_layer}:
-            from_layer = layer_dict[l.source]
+        for l in self.layers:
+            if l is self.input_layer:
+                continue
+            from_layer = self.get_layer(l.source)
             con = Connection.create_from_layers(from_layer, l)
-            self._connection_from_layer[from_layer.name] = con
+            self._connections_from_layer.setdefault(from_layer.name, []) \
+                .append(con)
             self._connection_to_layer[l.name] = con
             self.connections.append(con)
+        self._setup_layer_order()
+        self._setup_output_layer()
+
+    def _setup_layer_order(self):
+        """Orders the layers topologically. Every layer comes after its
+        source, otherwise the order of :attr:`.layers` is kept."""
+        order = [self.input_layer]
+        for layer in order:
+            order.extend(c.to_layer for c in
+                         self._connections_from_layer.get(layer.name, []))
+        if len(order) != len(self.layers):
+            reachable = {l.name for l in order}
+            unreachable = {l.name for l in self.layers} - reachable
+            cycle = self._cycle_layers(unreachable)
+            errors = []
+            if cycle:
+                errors.append("The layers {} form a cycle.".format(
+                    ", ".join(sorted(cycle))))
+            if unreachable - cycle:
+                errors.append(
+                    "The layers {} are not connected to the input layer "
+                    "`{}`.".format(", ".join(sorted(unreachable - cycle)),
+                                   self.input_layer.name))
+            raise config_error(" ".join(errors))
+        self._layer_order = order
+
+    def _cycle_layers(self, names):
+        """Returns the names of the layers in `names` that are their own
+        direct or indirect source."""
+        cycle = set()
+        for name in names:
+            source = self.get_layer(name).source
+            for _ in range(len(self.layers)):
+                if source is None or source == name:
+                    break
+                source = self.get_layer(source).source
+            if source == name:
+                cycle.add(name)
+        return cycle
 
     def _check_shapes(self):
-        input_shape = self.input_shape
-        last_layer = "network `{}` has input_shape of".format(self.name)
+        output_shapes = {}
         for layer in self.layer_iter():
+            if layer is self.input_layer:
+                input_shape = self.input_shape
+                last_layer = "network `{}` has input_shape of" \
+                    .format(self.name)
+            else:
+                input_shape = output_shapes[layer.source]
+                last_layer = "the source layer `{}` has a output_shape of" \
+                    .format(layer.source)
             if hasattr(layer, 'input_shape') and \
                     size(layer.input_shape) != size(input_shape):
                 raise config_error(
@@ -206,60 +433,379 @@ class FeedForwardNet(ConfigObject):
                         last_layer,
                         input_shape
                     ))
-            output_shape = layer.output_shape(input_shape)
-            last_layer = "the previous layer `{}` has a output_shape of"\
-                .format(layer.name)
-            input_shape = output_shape
+            output_shapes[layer.name] = layer.output_shape(input_shape)
 
     def layer_iter(self):
-        layer = self.input_layer
-        while True:
-            yield layer
-            if layer.name in self._connection_from_layer:
-                next_layer = self._connection_from_layer[layer.name].to_layer
-                layer = next_layer
-            else:
-                return
+        """Iterates over the layers in topological order."""
+        return iter(self._layer_order)
 
     def _setup_parameters(self):
         for layer in self.layer_iter():
-            self._setup_parameters_for_layer(layer)
+            if isinstance(layer, ParameterLayer):
+                with stage("layer_parameters", layer=layer.name):
+                    self._setup_parameters_for_layer(layer)
 
     def _setup_parameters_for_layer(self, layer):
         if issubclass(type(layer), ParameterLayer):
             for param in layer.parameters:
                 if self.data.get(param.name) is not None:
-                    param.tensor = self.data[param.name]
+                    layer.set_parameter(param, self.data[param.name])
                 elif param.tensor is None:
-                    layer.fill_parameter(param)
-
-    def layer_outputs(self, input):
-        next_input = input
+                    layer.fill_parameter(param, self.seed, self.lazy_init)
+
+    def fuse_layers(self):
+        """
+        Fuses every ReLU, TanH and Sigmoid layer that follows a Conv or
+        InnerProduct layer, and every Softmax that follows an InnerProduct
+        layer, into the preceding layer. The bias and the activation are
+        then applied to the output of the layer in one step. The NumPy
+        engine applies them in place, and Theano gets a single elementwise
+        op. The fused layers are recorded in :attr:`.fused`.
+
+        :return: :attr:`.fused`
+        """
+        output_names = set(self.output_names())
+        for layer in self.layer_iter():
+            cons = self._connections_from_layer.get(layer.name, [])
+            # the output without activation must not be used elsewhere
+            if len(cons) != 1 or layer.name in output_names or \
+                    getattr(layer, 'activation', None) is not None:
+                continue
+            activation = cons[0].to_layer
+            if isinstance(activation,
+                          self.FUSABLE_ACTIVATIONS.get(type(layer), ())):
+                layer.activation = activation
+                self.fused[activation.name] = layer.name
+
+        # the compiled functions compute the unfused graph
+        self.fuse_activations = True
+        for attr in ['_forward_func', '_predict_funcs']:
+            if hasattr(self, attr):
+                delattr(self, attr)
+        return self.fused
+
+    def layer_outputs(self, input, fused_outputs=False):
+        """
+        Returns an OrderedDict of the layer names to their symbolic outputs.
+
+        A fused activation layer is not computed on its own. It gets the
+        output of the layer it is fused into, which already includes the
+        activation.
+
+        :param fused_outputs: If `True`, layers with a fused activation
+            return their output without the activation like in the unfused
+            network. This computes the intermediate tensor again.
+        """
+        # the outputs that are passed on to the next layers
+        values = {}
         outputs = OrderedDict()
         for layer in self.layer_iter():
-            output = layer.output(next_input)
-            outputs[layer.name] = output
-            next_input = output
+            x = input if layer is self.input_layer else values[layer.source]
+            if layer.name in self.fused:
+                values[layer.name] = outputs[layer.name] = x
+                continue
+
+            values[layer.name] = layer.output(x)
+            if fused_outputs and getattr(layer, 'activation', None):
+                outputs[layer.name] = layer.linear_output(x)
+            else:
+                outputs[layer.name] = values[layer.name]
 
         return outputs
 
-    def forward(self, input):
+    def _symbolic_outputs(self, input):
+        outputs = self.layer_outputs(input)
+        return [outputs[name] for name in self.output_names()]
+
+    def save_parameters(self, file):
+        """Saves the current parameters as npz file, which can be loaded
+        with `data_url`. Sparse parameters are stored in CSR format."""
+        parameters = {p.name: p.value for p in self.parameters()}
+        np.savez(file, **utils.parameters_to_npz(parameters))
+
+    def _function_key(self, kind, *parts):
+        # the structure of sparse parameters is baked into the functions
+        sparse = sorted((p.name, p.structure_digest())
+                        for p in self.parameters() if p.is_sparse)
+        # and so are the arrays of the layers, that are loaded from files
+        constants = sorted((l.name, l.constants_digest())
+                           for l in self.layer_iter()
+                           if l.constants_digest() is not None)
+        return FunctionCache.key(kind, config_digest(self), sparse,
+                                 constants, *parts)
+
+    def _compile(self, key, compile, shared_variables=None):
+        """Calls `compile` or loads the compiled function from the
+        :attr:`function_cache`, if it is set."""
+        with stage("compile", function_cache=self.function_cache is not None):
+            if self.function_cache is None:
+                return compile()
+            named_shared = {p.name: p.shared for p in self.parameters()}
+            if shared_variables is not None:
+                named_shared.update(shared_variables)
+            return self.function_cache.get_or_compile(key, compile,
+                                                      named_shared)
+
+    def forward(self, input, engine="theano"):
+        """
+        Returns the output of the network for `input`. The batch size of
+        `input` can differ from the one of `input_shape`. One compiled
+        function serves all batch sizes.
+
+        :param engine: `"theano"` compiles a Theano function on the first
+            call. `"numpy"` computes the layers with NumPy. It needs no
+            compilation and has no compiler dependency, which makes it a
+            good fit for inference on CPU-only machines. `"int8"` is the
+            NumPy engine with the Conv and InnerProduct layers quantized by
+            :attr:`.quantization`.
+        """
+        if engine == "numpy":
+            return self._np_forward(input)
+        elif engine == "int8":
+            if self.quantization is None:
+                raise ValueError("The int8 engine requires the quantization "
+                                 "to be set. See Quantization.calibrate.")
+            return self._np_forward(input, self.quantization)
+        elif engine != "theano":
+            raise ValueError("Unknown engine `{}`. Use `theano`, `numpy` or "
+                             "`int8`.".format(engine))
+
+        return self._pack_outputs(self._get_forward_func()(input))
+
+    def _get_forward_func(self):
         if not hasattr(self, '_forward_func'):
+            def compile():
+                x = symbolic_tensor_from_shape('x', self.input_shape)
+                return theano.function([x], self._symbolic_outputs(x))
+
+            key = self._function_key('forward', self.input_shape)
+            self._forward_func = self._compile(key, compile)
+        return self._forward_func
+
+    def float64_variables(self):
+        """Returns the float64 variables in the compiled forward function.
+        With `floatX=float32` the list should be empty. Otherwise some
+        parameter or constant upcasts the graph to double precision."""
+        return utils.float64_variables(self._get_forward_func())
+
+    def profile(self, input, backward=False, n_runs=10):
+        """
+        Runs the layers on `input` under Theano's profiler and returns a
+        dict like :meth:`.shape_info` with the `input_shape` and
+        `output_shape` of every layer and the `forward` profile. The
+        profile holds the `seconds` per run, the `flops`, the
+        `output_bytes` of all values computed by the layer and the
+        `seconds` per op in `ops`. Fused activation layers have
+        `fused_into` instead. See :mod:`bernet.profiling`.
+
+        :param backward: also profile the gradients of the parameters and
+            the input of every layer as `backward`. The backward functions
+            compute the forward ops again, that the gradient depends on.
+        :param n_runs: number of timed runs after one warm-up run.
+        """
+        return profile_layers(self, input, backward, n_runs)
+
+    def np_layer_iter(self, input, quantization=None):
+        """
+        Computes the layers with NumPy in topological order and yields
+        `(layer, input, output)` for every layer that is not fused. The
+        output of a layer is freed once all layers using it are computed.
+
+        :param quantization: a :class:`.Quantization`. Its layers are
+            computed with int8 weights and inputs.
+        """
+        values = {}
+        n_consumers = {name: len(cons) for name, cons in
+                       self._connections_from_layer.items()}
+        for layer in self.layer_iter():
+            if layer is self.input_layer:
+                x = utils.as_floatX(input)
+            else:
+                x = values[layer.source]
+                n_consumers[layer.source] -= 1
+                if n_consumers[layer.source] == 0:
+                    del values[layer.source]
+            if layer.name in self.fused:
+                values[layer.name] = x
+                continue
+            if quantization is not None and layer.name in quantization:
+                output = quantization.np_output(layer, x)
+            else:
+                output = layer.np_output(x)
+            yield layer, x, output
+            values[layer.name] = output
+
+    def _np_forward(self, input, quantization=None):
+        # a fused activation layer outputs the output of its producer
+        names = [self.fused.get(n, n) for n in self.output_names()]
+        outputs = {}
+        for layer, _, output in self.np_layer_iter(input, quantization):
+            if layer.name in names:
+                outputs[layer.name] = output
+        return self._pack_outputs([outputs[n] for n in names])
+
+    def minibatch_func(self, shared_input, updates=None):
+        def compile():
             x = symbolic_tensor_from_shape('x', self.input_shape)
+            begin = T.iscalar('minibatch_begin')
+            end = T.iscalar('minibatch_end')
             y = self.output(x)
-            self._forward_func = theano.function([x], [y])
+            return theano.function([begin, end], [y],
+                                   givens={x: shared_input[begin:end, :]},
+                                   updates=updates)
+
+        if updates is None:
+            key = self._function_key('minibatch', self.input_shape,
+                                     str(shared_input.type))
+            func = self._compile(key, compile,
+                                 {'__minibatch_input__': shared_input})
+        else:
+            func = compile()
+        return lambda b, e: func(b, e)[0]
 
-        return self._forward_func(input)[0]
+    def _predict_func(self, layer_names=None):
+        """Returns the shared input buffer and a compiled function
+        computing the list of outputs for the examples in the buffer. The
+        buffer can hold any number of examples.
+
+        :param layer_names: compute the outputs of these layers instead of
+            the network outputs.
+        """
+        if not hasattr(self, '_predict_funcs'):
+            self._predict_funcs = {}
+        if layer_names is not None:
+            layer_names = tuple(layer_names)
+        if layer_names not in self._predict_funcs:
+            shared_input = theano.shared(
+                np.zeros(self.input_shape, dtype=theano.config.floatX),
+                name='predict_input', borrow=True)
+
+            def compile():
+                x = symbolic_tensor_from_shape('x', self.input_shape)
+                if layer_names is None:
+                    ys = self._symbolic_outputs(x)
+                else:
+                    outputs = self.layer_outputs(x, fused_outputs=True)
+                    ys = [outputs[name] for name in layer_names]
+                return theano.function([], ys, givens={x: shared_input})
+
+            key = self._function_key('predict_outputs',
+                                     tuple(self.input_shape[1:]), layer_names)
+            func = self._compile(key, compile,
+                                 {'__predict_input__': shared_input})
+            self._predict_funcs[layer_names] = shared_input, func
+        return self._predict_funcs[layer_names]
+
+    def predict_iter(self, data, batch_size=None):
+        """
+        Yields the network outputs for `data` in chunks of `batch_size`
+        examples. The chunks are copied into a single shared input buffer.
+        The next chunk is staged in a background thread while the current
+        one is computed.
+
+        :param data: array with the examples along the first axis or an
+            iterable of examples. Can be of any length.
+        :param batch_size: defaults to the batch size of `input_shape`.
+        """
+        for outputs in self._predict_iter(data, batch_size):
+            yield self._pack_outputs(outputs)
+
+    def _predict_iter(self, data, batch_size, layer_names=None):
+        if batch_size is None:
+            batch_size = bs(self.input_shape)
+        shared_input, func = self._predict_func(layer_names)
+        batches = staged_batches(data, batch_size, self.input_shape[1:])
+        for batch, n in batches:
+            # the function accepts any batch size, so the padding of the
+            # last batch is not computed
+            shared_input.set_value(batch[:n], borrow=True)
+            yield func()
+
+    def predict_batches(self, data, out=None, batch_size=None):
+        """
+        Returns the network outputs for `data`. See :meth:`.predict_iter`.
+
+        :param out: If given, the outputs are written into this array.
+        """
+        if out is None and not hasattr(data, '__len__'):
+            chunks = list(self._predict_iter(data, batch_size))
+            if not chunks:
+                return self._empty_outputs()
+            return self._pack_outputs([np.concatenate(ys)
+                                       for ys in zip(*chunks)])
+
+        if out is not None:
+            out = self._unpack_outputs(out)
+        begin = 0
+        for ys in self._predict_iter(data, batch_size):
+            if out is None:
+                out = [np.empty((len(data),) + y.shape[1:], dtype=y.dtype)
+                       for y in ys]
+            for o, y in zip(out, ys):
+                o[begin:begin+len(y)] = y
+            begin += len(ys[0])
+        if out is None:
+            return self._empty_outputs()
+        return self._pack_outputs(out)
+
+    def _empty_outputs(self):
+        """Returns the outputs for zero examples. Their shapes and dtypes are
+        taken from the outputs of a single example."""
+        example = utils.as_floatX(np.zeros((1,) +
+                                           tuple(self.input_shape[1:])))
+        outputs = self._unpack_outputs(self.forward(example))
+        return self._pack_outputs([o[:0] for o in outputs])
+
+    def extract(self, layers, data, out_dir=None, batch_size=None):
+        """
+        Computes the outputs of the `layers` for `data` with one compiled
+        function. The outputs of every batch are written into arrays that
+        are allocated once, so the data is passed through the network only
+        once. The output of a layer with a fused activation is its output
+        without the activation.
+
+        :param layers: list of layer names.
+        :param data: array or sequence with the examples along the first
+            axis. Its length must be known.
+        :param out_dir: If given, the output of each layer is written to the
+            memory-mapped file `<out_dir>/<layer name>.npy`. Otherwise the
+            arrays are kept in memory.
+        :param batch_size: defaults to the batch size of `input_shape`.
+        :return: OrderedDict of the layer names to their outputs.
+        """
+        layers = list(layers)
+        for name in layers:
+            self.get_layer(name)
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+
+        def allocate(name, shape, dtype):
+            if out_dir is None:
+                return np.empty(shape, dtype=dtype)
+            return np.lib.format.open_memmap(
+                os.path.join(out_dir, name + ".npy"), mode='w+',
+                dtype=dtype, shape=shape)
 
-    def minibatch_func(self, shared_input, updates=None):
-        x = symbolic_tensor_from_shape('x', self.input_shape)
-        begin = T.iscalar('minibatch_begin')
-        end = T.iscalar('minibatch_end')
-        y = self.output(x)
-        func = theano.function([begin, end], [y],
-                               givens={x: shared_input[begin:end, :]},
-                               updates=updates)
-        return lambda b, e: func(b, e)[0]
+        outputs = OrderedDict()
+        begin = 0
+        for ys in self._predict_iter(data, batch_size, layers):
+            if not outputs:
+                for name, y in zip(layers, ys):
+                    outputs[name] = allocate(name, (len(data),) + y.shape[1:],
+                                             y.dtype)
+            for out, y in zip(outputs.values(), ys):
+                out[begin:begin+len(y)] = y
+            begin += len(ys[0])
+
+        if not outputs:
+            shapes = self.infer_shapes()
+            for name in layers:
+                shape = (0,) + tuple(shapes[name][1][1:])
+                outputs[name] = allocate(name, shape, utils.floatX())
+        for out in outputs.values():
+            if isinstance(out, np.memmap):
+                out.flush()
+        return outputs
 
     def output(self, input: 'symbolic tensor'):
         return self.layer_outputs(input)[self.output_layer.name]
@@ -280,7 +826,75 @@ class FeedForwardNet(ConfigObject):
 
         from_layer = str2layer(from_layer)
         to_layer = str2layer(to_layer)
-        for c in self.connections:
-            if c.from_layer == from_layer and c.to_layer == to_layer:
-                return True
-        return False
+        con = self._connection_to_layer.get(to_layer.name)
+        return con is not None and con.from_layer == from_layer
+
+
+def _parameter_bytes(param, shape, itemsize):
+    """Returns the bytes of a parameter of `shape`. Sparse parameters
+    store their nonzero values and the CSR indices. Deferred parameters
+    are counted as dense."""
+    if not param.is_deferred and param.is_sparse:
+        value = param.value
+        return value.nnz * itemsize + value.indices.nbytes + \
+            value.indptr.nbytes
+    return size(shape) * itemsize
+
+
+class GraphNet(FeedForwardNet):
+    """
+    A network whose layers form a tree. Every layer has a single source,
+    but several layers can use the same source, e.g. several classifier
+    heads on one shared trunk. The layers are computed in topological order
+    and every layer only once, so all heads cost a single pass through the
+    trunk.
+
+    :meth:`.forward`, :meth:`.predict_iter` and :meth:`.predict_batches`
+    return an OrderedDict of the output layer names to their outputs. All
+    outputs are computed by one compiled function. :meth:`.output` and
+    the training use the first output layer.
+
+    .. code-block:: yaml
+
+        !GraphNet
+        name: two_heads
+        input_shape: [1, 3, 227, 227]
+        outputs: [imagenet_softmax, scenes_softmax]
+        layers:
+            # ... the shared trunk up to the layer `relu7`
+            - !InnerProduct {name: imagenet_fc8, source: relu7,
+                             input_shape: [1, 4096], n_units: 1000}
+            - !Softmax {name: imagenet_softmax, source: imagenet_fc8}
+            - !InnerProduct {name: scenes_fc8, source: relu7,
+                             input_shape: [1, 4096], n_units: 365}
+            - !Softmax {name: scenes_softmax, source: scenes_fc8}
+    """
+
+    outputs = OPTIONAL(REPEAT(str),
+                       doc="The names of the output layers. Defaults to "
+                           "all layers that are not the source of another "
+                           "layer.")
+
+    def _setup_output_layer(self):
+        if self.outputs is None:
+            names = [l.name for l in self.layer_iter()
+                     if l.name not in self._connections_from_layer]
+        else:
+            names = list(self.outputs)
+        if len(names) == 0:
+            raise config_error("A GraphNet needs at least one output layer.")
+        for name in names:
+            if name not in self._layer_by_name:
+                raise config_error("Output layer `{}` does not exist."
+                                   .format(name))
+        self.output_layers = [self.get_layer(name) for name in names]
+        self.output_layer = self.output_layers[0]
+
+    def output_names(self):
+        return [l.name for l in self.output_layers]
+
+    def _pack_outputs(self, outputs: list):
+        return OrderedDict(zip(self.output_names(), outputs))
+
+    def _unpack_outputs(self, packed) -> list:
+        return [packed[name] for name in self.output_names()]
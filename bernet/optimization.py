@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import math
+import os
 
 import sys
 import numpy as np
@@ -19,6 +20,7 @@ import theano
 import theano.tensor as T
 import time
 
+from bernet.checkpoint import CheckpointWriter, load_checkpoint
 from bernet.config import OPTIONAL, ConfigObject
 from bernet.dataset import Dataset
 from bernet.net import FeedForwardNet
@@ -27,6 +29,10 @@ from bernet.utils import shared_like, shared_tensor_from_dims, \
 
 
 class Optimizator(ConfigObject):
+    # number of tensors of the size of a parameter the optimizer keeps for
+    # every parameter, see :meth:`.FeedForwardNet.shape_info`
+    n_state_tensors = 0
+
     def _grads(self, cost, params):
         assert cost is not None
         for param in params:
@@ -46,6 +52,9 @@ class Rprop(Optimizator):
     step_increase = OPTIONAL(float, default=1.2)
     step_decrease = OPTIONAL(float, default=0.5)
 
+    # the last gradient and step
+    n_state_tensors = 2
+
     def _updates(self, cost, params, grads):
         for param, grad in zip(params, grads):
             grad_tm1 = shared_like(param, 'grad')
@@ -81,9 +90,34 @@ class SupervisedTrainer(ConfigObject):
     validate_every = OPTIONAL(int, default=10)
     min_improvement = OPTIONAL(float, default=0.01)
     max_epochs = OPTIONAL(int)
-
-    def train(self, network: FeedForwardNet, dataset: Dataset):
+    checkpoint_file = OPTIONAL(str, doc="Write checkpoints of the training "
+                                        "to this npz file. See "
+                                        ":meth:`.train`.")
+    checkpoint_every = OPTIONAL(int, default=1,
+                                doc="Number of epochs between two "
+                                    "checkpoints.")
+
+    def train(self, network: FeedForwardNet, dataset: Dataset,
+              resume=False):
+        """
+        Trains `network` on `dataset` until the validation loss stops
+        improving for `patience` epochs or `max_epochs` are done.
+
+        If `checkpoint_file` is set, a checkpoint is written every
+        `checkpoint_every` epochs and after the last one. It holds the
+        parameters, the optimizer state, the epoch, the best validation
+        loss and parameters and the state of `np.random`, from which the
+        datasets draw their data. The checkpoints are written by a
+        background thread.
+
+        :param resume: continue from `checkpoint_file`, if it exists. The
+            network and the trainer must have the same configuration as the
+            interrupted training, which is then continued bit-exactly.
+        """
         trainer_state = SupervisedTrainerState(network, dataset, self)
+        if resume and self.checkpoint_file is not None and \
+                os.path.exists(self.checkpoint_file):
+            trainer_state.restore(load_checkpoint(self.checkpoint_file))
         trainer_state.train()
 
 
@@ -96,6 +130,8 @@ class SupervisedTrainerState(object):
         self.best_loss = sys.float_info.max
         self.best_iteration = -10000
         self.best_parameters = []
+        # the last finished epoch
+        self.epoch = 0
 
         self._validate_data, self._validate_labels = \
             self._shared_tensors(dataset, network.name, "validate")
@@ -131,11 +167,65 @@ class SupervisedTrainerState(object):
         return self.best_loss - loss > self.train_opt.min_improvement
 
     def train(self):
-        epoche_iter = self.epoche_iter(self.network, self.dataset)
-        for i, epoche_info in enumerate(epoche_iter, start=1):
-            self._print_epoche_info(i, epoche_info)
-            if not self.enough_patience(i, epoche_info['avg_valid_loss']):
-                return
+        writer = None
+        if self.train_opt.checkpoint_file is not None:
+            writer = CheckpointWriter(self.train_opt.checkpoint_file)
+        try:
+            epoche_iter = self.epoche_iter(self.network, self.dataset)
+            for i, epoche_info in enumerate(epoche_iter,
+                                            start=self.epoch + 1):
+                self.epoch = i
+                self._print_epoche_info(i, epoche_info)
+                done = not self.enough_patience(
+                    i, epoche_info['avg_valid_loss'])
+                if writer is not None and \
+                        (done or i % self.train_opt.checkpoint_every == 0):
+                    writer.write(self.checkpoint())
+                if done:
+                    return
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def checkpoint(self) -> dict:
+        """Returns the state of the training as dict of arrays. The arrays
+        are copies."""
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        arrays = {
+            'epoch': np.asarray(self.epoch),
+            'best_loss': np.asarray(self.best_loss, dtype=np.float64),
+            'best_iteration': np.asarray(self.best_iteration),
+            'rng_keys': keys,
+            'rng_pos': np.asarray(pos),
+            'rng_has_gauss': np.asarray(has_gauss),
+            'rng_cached_gaussian': np.asarray(cached_gaussian),
+        }
+        for i, param in enumerate(self.train_params):
+            arrays['param_{}'.format(i)] = param.get_value()
+        for i, state in enumerate(self.optimizer_state):
+            arrays['optimizer_{}'.format(i)] = state.get_value()
+        for i, value in enumerate(self.best_parameters):
+            arrays['best_{}'.format(i)] = value
+        return arrays
+
+    def restore(self, arrays):
+        """Sets the state of the training to the :meth:`.checkpoint`
+        `arrays`."""
+        self.epoch = int(arrays['epoch'])
+        self.best_loss = float(arrays['best_loss'])
+        self.best_iteration = int(arrays['best_iteration'])
+        for i, param in enumerate(self.train_params):
+            param.set_value(arrays['param_{}'.format(i)])
+        for i, state in enumerate(self.optimizer_state):
+            state.set_value(arrays['optimizer_{}'.format(i)])
+        self.best_parameters = []
+        while 'best_{}'.format(len(self.best_parameters)) in arrays:
+            self.best_parameters.append(
+                arrays['best_{}'.format(len(self.best_parameters))])
+        np.random.set_state(('MT19937', arrays['rng_keys'],
+                             int(arrays['rng_pos']),
+                             int(arrays['rng_has_gauss']),
+                             float(arrays['rng_cached_gaussian'])))
 
     def _print_epoche_info(self, epoche_number, epoche_info):
         def spaces(l, n=12):
@@ -184,14 +274,14 @@ class SupervisedTrainerState(object):
         validate_batch = next(self.dataset.validate_epoch())
         self._validate_data.set_value(validate_batch.data())
         self._validate_labels.set_value(validate_batch.labels())
-        for b, e, in validate_batch.minibatch_idx():
+        for b, e, in validate_batch.minibatch_idx(self.network.batch_size):
             yield self._valid_fn(b, e)
 
     def run_train_epoch(self):
         train_batch = next(self.dataset.train_epoch())
         self._train_data.set_value(train_batch.data())
         self._train_labels.set_value(train_batch.labels())
-        for b, e, in train_batch.minibatch_idx():
+        for b, e, in train_batch.minibatch_idx(self.network.batch_size):
             yield self._train_fn(b, e)
 
     def _create_validate_func(self):
@@ -223,6 +313,11 @@ class SupervisedTrainerState(object):
         out = self.network.output(x)
         loss = self.network.get_loss(out, y)
         self.train_params = self.network.parameters_as_shared()
+        updates = self.train_opt.optimizator.updates(loss, self.train_params)
+        # the shared variables of the optimizer, e.g. the last steps
+        self.optimizer_state = [
+            var for var, _ in updates
+            if not any(var is param for param in self.train_params)]
         fn = theano.function(
             [idx_begin, idx_end],
             loss,
@@ -230,6 +325,6 @@ class SupervisedTrainerState(object):
                 x: self._train_data[idx_begin:idx_end, :],
                 y: self._train_labels[idx_begin:idx_end]
             },
-            updates=self.train_opt.optimizator.updates(loss, self.train_params)
+            updates=updates
         )
         return fn
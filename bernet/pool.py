@@ -0,0 +1,73 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+2D pooling over the last two axes with the semantics of
+:func:`theano.tensor.signal.downsample.max_pool_2d`.
+
+If `ignore_border` is `False`, the windows at the border may be partial
+(ceil mode) and the output has `ceil((size - pool) / stride) + 1` elements.
+Average pooling divides by the number of elements of a window that lie
+inside the input.
+"""
+import numpy as np
+
+
+def pool_output_size(size, pool, stride, ignore_border):
+    if ignore_border:
+        return max((size - pool) // stride + 1, 0)
+    elif stride >= pool:
+        return (size - 1) // stride + 1
+    else:
+        return max(0, (size - 1 - pool) // stride + 1) + 1
+
+
+def window_counts(size, pool, stride, out_size):
+    """Returns the number of elements of each window inside the input."""
+    begin = np.arange(out_size) * stride
+    return np.minimum(begin + pool, size) - begin
+
+
+def pool2d(x, pool, stride, ignore_border, mode='max'):
+    """Pools the last two axes of `x`. `mode` is `max` or `average`."""
+    if mode not in ('max', 'average'):
+        raise ValueError("Unknown pooling mode `{}`.".format(mode))
+    ph, pw = pool
+    sh, sw = stride
+    h, w = x.shape[-2:]
+    oh = pool_output_size(h, ph, sh, ignore_border)
+    ow = pool_output_size(w, pw, sw, ignore_border)
+    # partial windows at the border are padded with a neutral value
+    need_h = (oh - 1) * sh + ph
+    need_w = (ow - 1) * sw + pw
+    if need_h > h or need_w > w:
+        padded = np.empty(x.shape[:-2] + (max(need_h, h), max(need_w, w)),
+                          dtype=x.dtype)
+        padded.fill(-np.inf if mode == 'max' else 0)
+        padded[..., :h, :w] = x
+        x = padded
+
+    out = x[..., 0:sh*(oh-1)+1:sh, 0:sw*(ow-1)+1:sw].copy()
+    for i in range(ph):
+        for j in range(pw):
+            if i == j == 0:
+                continue
+            window = x[..., i:i+sh*(oh-1)+1:sh, j:j+sw*(ow-1)+1:sw]
+            if mode == 'max':
+                np.maximum(out, window, out=out)
+            else:
+                out += window
+    if mode == 'average':
+        out /= np.outer(window_counts(h, ph, sh, oh),
+                        window_counts(w, pw, sw, ow))
+    return out
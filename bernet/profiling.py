@@ -0,0 +1,192 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-layer profiling of the Theano functions of a :class:`.FeedForwardNet`.
+
+Every layer is compiled as its own function and run under Theano's
+profiler, so the time of every op is attributed to the layer that created
+it. Optimizations across layers, e.g. the fusion of the elementwise ops of
+two layers, are therefore not applied. Activations fused by
+:meth:`.FeedForwardNet.fuse_layers` are part of the layer they are fused
+into.
+
+.. code-block:: python
+
+    info = net.profile(x, backward=True)
+    print(format_profile(info))
+
+"""
+from collections import OrderedDict
+
+import numpy as np
+import theano
+import theano.tensor as T
+from theano.compile.profiling import ProfileStats
+from theano.gradient import NullTypeGradError
+from theano.tensor import blas
+
+from bernet import utils
+
+# ops computing `out = x * y` and the index of `x`
+_DOT_OPS = [
+    (T.basic.Dot, 0),
+    (blas.Dot22, 0),
+    (blas.Dot22Scalar, 0),
+    (blas.Gemm, 2),
+    (blas.Gemv, 2),
+]
+
+
+def _tensor(name, value):
+    return T.TensorType(value.dtype, (False,) * value.ndim)(name)
+
+
+def _nbytes(value):
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    # sparse matrices
+    return int(getattr(getattr(value, 'data', None), 'nbytes', 0))
+
+
+def _node_flops(node, shapes):
+    """Returns the FLOPs of `node` for the ops that report them and for
+    the matrix products. Other ops count as 0."""
+    in_shapes = [shapes.get(v) for v in node.inputs]
+    out_shapes = [shapes.get(v) for v in node.outputs]
+    if any(s is None for s in in_shapes + out_shapes):
+        return 0
+    if hasattr(node.op, 'flops'):
+        return int(node.op.flops(in_shapes, out_shapes))
+    for op_type, x_idx in _DOT_OPS:
+        if isinstance(node.op, op_type):
+            inner = in_shapes[x_idx][-1] if in_shapes[x_idx] else 1
+            return 2 * int(np.prod(out_shapes[0])) * int(inner)
+    return 0
+
+
+def _profile_function(inputs, outputs, values, n_runs):
+    """Compiles and runs the function `n_runs` times after one warm-up
+    run. Returns the outputs and a dict with the seconds per run, the
+    FLOPs, the bytes of all intermediate and output values and the seconds
+    per op."""
+    stats = ProfileStats(atexit_print=False)
+    # keeps the intermediate values to get their shapes and sizes
+    mode = theano.compile.mode.get_default_mode().clone(
+        link_kwargs={'allow_gc': False})
+    func = theano.function(inputs, outputs, mode=mode, profile=stats)
+    results = func(*values)
+    stats.apply_time.clear()
+    stats.apply_callcount.clear()
+    for _ in range(n_runs):
+        results = func(*values)
+
+    storage_map = func.fn.storage_map
+    shapes = {}
+    for var, storage in storage_map.items():
+        if getattr(storage[0], 'shape', None) is not None:
+            shapes[var] = tuple(storage[0].shape)
+    # the storage of the inputs is cleared after each call
+    for var, value in zip(func.maker.fgraph.inputs, values):
+        shapes[var] = value.shape
+
+    info = {'seconds': 0., 'flops': 0, 'output_bytes': 0, 'ops': {}}
+    for node in func.maker.fgraph.toposort():
+        seconds = stats.apply_time.get(node, 0.) / n_runs
+        info['seconds'] += seconds
+        op = str(node.op)
+        info['ops'][op] = info['ops'].get(op, 0.) + seconds
+        info['flops'] += _node_flops(node, shapes)
+        info['output_bytes'] += sum(_nbytes(storage_map[v][0])
+                                    for v in node.outputs)
+    return results, info
+
+
+def _profile_backward(layer, x, x_value, y, y_value, is_input, n_runs):
+    if not y.dtype.startswith('float'):
+        return None
+    wrt = [p.shared for p in getattr(layer, 'parameters', [])]
+    if not is_input:
+        wrt.append(x)
+    if not wrt:
+        return None
+    gy = _tensor('grad_' + layer.name, y_value)
+    gy_value = np.random.RandomState(0).normal(size=y_value.shape) \
+        .astype(y_value.dtype)
+    try:
+        grads = T.grad(None, wrt, known_grads={y: gy},
+                       disconnected_inputs='ignore',
+                       return_disconnected='zero')
+    except (NullTypeGradError, NotImplementedError):
+        return None
+    _, info = _profile_function([x, gy], grads, [x_value, gy_value],
+                                n_runs)
+    return info
+
+
+def profile_layers(net, input, backward=False, n_runs=10) -> OrderedDict:
+    """See :meth:`.FeedForwardNet.profile`."""
+    values = {}
+    profile = OrderedDict()
+    for layer in net.layer_iter():
+        if layer is net.input_layer:
+            x_value = utils.as_floatX(input)
+        else:
+            x_value = values[layer.source]
+        if layer.name in net.fused:
+            values[layer.name] = x_value
+            profile[layer.name] = {
+                'input_shape': x_value.shape,
+                'output_shape': x_value.shape,
+                'fused_into': net.fused[layer.name],
+            }
+            continue
+
+        x = _tensor(layer.name + '_input', x_value)
+        y = layer.output(x)
+        [y_value], forward = _profile_function([x], [y], [x_value], n_runs)
+        values[layer.name] = y_value
+        profile[layer.name] = {
+            'input_shape': x_value.shape,
+            'output_shape': y_value.shape,
+            'forward': forward,
+        }
+        if backward:
+            info = _profile_backward(layer, x, x_value, y, y_value,
+                                     layer is net.input_layer, n_runs)
+            if info is not None:
+                profile[layer.name]['backward'] = info
+    return profile
+
+
+def format_profile(profile) -> str:
+    """Returns a table of the seconds, FLOPs and output bytes per layer and
+    pass of :meth:`.FeedForwardNet.profile`."""
+    lines = ["{:<16} {:<8} {:>12} {:>8} {:>14} {:>14}".format(
+        "layer", "pass", "ms", "%", "MFLOPs", "output KiB")]
+    total = sum(info[p]['seconds'] for info in profile.values()
+                for p in ['forward', 'backward'] if p in info)
+    for name, info in profile.items():
+        if 'fused_into' in info:
+            lines.append("{:<16} fused into {}".format(
+                name, info['fused_into']))
+        for p in ['forward', 'backward']:
+            if p not in info:
+                continue
+            stats = info[p]
+            lines.append(
+                "{:<16} {:<8} {:>12.3f} {:>8.1f} {:>14.2f} {:>14.1f}".format(
+                    name, p, 1000 * stats['seconds'],
+                    100 * stats['seconds'] / max(total, 1e-12),
+                    stats['flops'] / 1e6, stats['output_bytes'] / 1024))
+    return "\n".join(lines)
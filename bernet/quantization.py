@@ -0,0 +1,274 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Post-training int8 quantization of the Conv and InnerProduct layers.
+
+The weights are quantized symmetrically with one scale per output channel,
+the inputs of a layer with one scale per layer. The scales of the inputs are
+calibrated on a sample :class:`.Epoche`. A quantized layer computes
+
+    int32 accumulator = int8 input * int8 weights
+    output = accumulator * input_scale * weight_scale + bias
+
+.. code-block:: python
+
+    quant = Quantization.calibrate(net, dataset.validate_epoch())
+    quant.save("alexnet_int8.npz")
+    net.quantization = Quantization.load("alexnet_int8.npz")
+    net.forward(x, engine="int8")
+
+"""
+import numpy as np
+import scipy.sparse
+
+from bernet.conv import grouped_conv2d
+from bernet.layer import ConvLayer, InnerProductLayer
+from bernet.utils import bs, staged_batches, as_floatX, floatX
+
+INT8_MAX = 127
+QUANTIZABLE_LAYERS = (ConvLayer, InnerProductLayer)
+
+
+def quantize(x, scale):
+    """Returns `round(x / scale)` clipped to [-127, 127] as int8."""
+    q = np.rint(x / scale)
+    np.clip(q, -INT8_MAX, INT8_MAX, out=q)
+    return q.astype(np.int8)
+
+
+def _scale(max_abs):
+    return np.where(max_abs > 0, max_abs / INT8_MAX, 1.).astype(np.float32)
+
+
+# NumPy has no int8 GEMM. The sums of the int8 products are computed with a
+# float32 GEMM, which is exact as long as they fit in the 24 bit mantissa.
+# Longer sums are split into chunks of at most CHUNK_PRODUCTS products,
+# which are summed in int32. The int8 weights are converted to float32 one
+# chunk at a time, so only a single chunk is held as float32.
+CHUNK_PRODUCTS = (2**24 - 1) // INT8_MAX**2
+
+
+def int_matmul(a, b):
+    """Returns the int32 product of the int8 matrices `a` and `b`."""
+    a = a.astype(np.float32)
+    k = a.shape[-1]
+    out = np.zeros(a.shape[:-1] + b.shape[1:], dtype=np.int32)
+    for begin in range(0, k, CHUNK_PRODUCTS):
+        end = begin + CHUNK_PRODUCTS
+        b_chunk = b[begin:end].astype(np.float32)
+        out += np.dot(a[..., begin:end], b_chunk).astype(np.int32)
+    return out
+
+
+def int_grouped_conv2d(x, w, group, stride, padding):
+    """Returns the int32 result of :func:`.grouped_conv2d` of int8 inputs.
+    The zero padding stays exact, because the quantization is symmetric."""
+    f, cg, kh, kw = w.shape
+    dtype = np.float32
+    # a chunk contains all kernel elements of at least one channel
+    chunk = CHUNK_PRODUCTS // (kh * kw)
+    if chunk == 0:
+        dtype, chunk = np.float64, cg
+    x = x.astype(dtype)
+    b, _, h, w_ = x.shape
+    x_groups = x.reshape(b, group, cg, h, w_)
+    out = None
+    for begin in range(0, cg, chunk):
+        end = min(begin + chunk, cg)
+        x_chunk = x_groups[:, :, begin:end].reshape(
+            b, group * (end - begin), h, w_)
+        acc = grouped_conv2d(x_chunk, w[:, begin:end].astype(dtype), group,
+                             stride, padding)
+        acc = np.rint(acc).astype(np.int32)
+        if out is None:
+            out = acc
+        else:
+            out += acc
+    return out
+
+
+class Quantization(object):
+    """
+    Int8 weights, weight scales and input scales of the Conv and
+    InnerProduct layers of a :class:`.FeedForwardNet`. All dicts are keyed
+    by layer name.
+    """
+
+    def __init__(self, weights, weight_scales, input_scales, biases):
+        self.weights = weights
+        self.weight_scales = weight_scales
+        self.input_scales = input_scales
+        self.biases = biases
+
+    @classmethod
+    def calibrate(cls, net, epoche, max_batches=None):
+        """
+        Quantizes the weights of `net` and calibrates the input scales with
+        the maximum absolute input of each layer on the examples of
+        `epoche`.
+
+        :param max_batches: only use the first `max_batches` batches.
+        """
+        batch_size = bs(net.input_shape)
+        input_max = {}
+        batches = staged_batches(epoche.data(), batch_size,
+                                 net.input_shape[1:])
+        for i, (batch, n) in enumerate(batches):
+            if max_batches is not None and i >= max_batches:
+                batches.close()
+                break
+            for layer, x, _ in net.np_layer_iter(batch):
+                if isinstance(layer, QUANTIZABLE_LAYERS):
+                    max_abs = float(np.abs(x[:n]).max())
+                    input_max[layer.name] = max(
+                        input_max.get(layer.name, 0.), max_abs)
+
+        weights, weight_scales, input_scales, biases = {}, {}, {}, {}
+        for layer in net.layer_iter():
+            if not isinstance(layer, QUANTIZABLE_LAYERS):
+                continue
+            w = layer.weight.value
+            if layer.weight.is_sparse:
+                w = w.toarray()
+            w_max = np.abs(w.reshape(w.shape[0], -1)).max(axis=1)
+            weight_scales[layer.name] = _scale(w_max)
+            scale = weight_scales[layer.name].reshape((-1,) +
+                                                      (1,) * (w.ndim - 1))
+            weights[layer.name] = quantize(w, scale)
+            input_scales[layer.name] = _scale(
+                np.asarray(input_max.get(layer.name, 0.)))
+            if layer.bias is not None:
+                biases[layer.name] = as_floatX(layer.bias.value)
+        return cls(weights, weight_scales, input_scales, biases)
+
+    def save(self, file):
+        """Writes the int8 parameter file as npz."""
+        arrays = {}
+        for name in self.weights:
+            arrays[name + "__weight"] = self.weights[name]
+            arrays[name + "__weight_scale"] = self.weight_scales[name]
+            arrays[name + "__input_scale"] = self.input_scales[name]
+            if name in self.biases:
+                arrays[name + "__bias"] = self.biases[name]
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        dicts = {"weight": {}, "weight_scale": {}, "input_scale": {},
+                 "bias": {}}
+        with np.load(file) as npz:
+            for key in npz.files:
+                name, kind = key.rsplit("__", 1)
+                dicts[kind][name] = npz[key]
+        return cls(dicts["weight"], dicts["weight_scale"],
+                   dicts["input_scale"], dicts["bias"])
+
+    def __contains__(self, layer_name):
+        return layer_name in self.weights
+
+    def np_output(self, layer, input):
+        """Computes the output of `layer` with int8 weights and inputs."""
+        name = layer.name
+        x = layer._np_reshape(input)
+        x_q = quantize(x, self.input_scales[name])
+        if isinstance(layer, ConvLayer):
+            acc = int_grouped_conv2d(x_q, self.weights[name], layer.group,
+                                     (layer.stride_h, layer.stride_v),
+                                     layer._padding())
+            scale = self.weight_scales[name].reshape(1, -1, 1, 1)
+            bias_shape = (1, -1, 1, 1)
+        else:
+            acc = int_matmul(x_q, self.weights[name].T)
+            scale = self.weight_scales[name]
+            bias_shape = (-1,)
+
+        out = acc.astype(floatX())
+        out *= as_floatX(scale * self.input_scales[name])
+        if name in self.biases:
+            out += self.biases[name].reshape(bias_shape)
+        if layer.activation is not None:
+            out = layer.activation._np_output_inplace(out)
+        return out
+
+    def nbytes(self):
+        """Returns the number of bytes of the weights and scales."""
+        return sum(a.nbytes for d in [self.weights, self.weight_scales,
+                                      self.input_scales, self.biases]
+                   for a in d.values())
+
+
+def accuracy_report(net, quantization, epoche, output=None) -> dict:
+    """
+    Compares the float NumPy engine with the int8 engine on `epoche`.
+
+    :param output: name of the output layer to compare. Required if `net`
+        is a :class:`.GraphNet` with several outputs.
+    :return: dict with the float and int8 accuracies (if `epoche` has
+        labels), the fraction of examples with the same prediction, the
+        maximum absolute difference of the outputs and the bytes of the
+        float and int8 weights.
+    """
+    names = net.output_names()
+    if output is None:
+        if len(names) != 1:
+            raise ValueError("The network has the outputs {}. Choose one "
+                             "with `output`.".format(", ".join(names)))
+        output = names[0]
+    index = names.index(output)
+
+    def forward(batch, quantization=None):
+        outputs = net._np_forward(batch, quantization)
+        return net._unpack_outputs(outputs)[index]
+
+    batch_size = bs(net.input_shape)
+    float_preds, int8_preds = [], []
+    max_abs_diff = 0.
+    for batch, n in staged_batches(epoche.data(), batch_size,
+                                   net.input_shape[1:]):
+        float_out = forward(batch)[:n]
+        int8_out = forward(batch, quantization)[:n]
+        max_abs_diff = max(max_abs_diff,
+                           float(np.abs(float_out - int8_out).max()))
+        for out, preds in [(float_out, float_preds),
+                           (int8_out, int8_preds)]:
+            if out.ndim > 1:
+                out = out.reshape(n, -1).argmax(axis=1)
+            preds.append(out)
+
+    float_preds = np.concatenate(float_preds)
+    int8_preds = np.concatenate(int8_preds)
+    report = {
+        'agreement': float(np.mean(float_preds == int8_preds)),
+        'max_abs_diff': max_abs_diff,
+        'float_bytes': sum(_nbytes(net.get_layer(name).weight.value)
+                           for name in quantization.weights),
+        'int8_bytes': sum(w.nbytes for w in quantization.weights.values()),
+    }
+    if epoche.labels() is not None:
+        labels = epoche.labels().astype(np.int64)
+        report['float_accuracy'] = float(np.mean(float_preds == labels))
+        report['int8_accuracy'] = float(np.mean(int8_preds == labels))
+    return report
+
+
+def _nbytes(value):
+    if scipy.sparse.issparse(value):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return value.nbytes
+
+
+def format_accuracy_report(report) -> str:
+    lines = ["{:>16}: {}".format(key, report[key])
+             for key in sorted(report.keys())]
+    return "\n".join(lines)
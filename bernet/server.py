@@ -0,0 +1,447 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local inference server with dynamic micro-batching.
+
+Concurrent requests are queued and combined into one batch, until the batch
+has `max_batch_size` examples or its first request has waited `max_wait`
+seconds. A single compiled function computes all batch sizes.
+
+Start a server for a model with:
+
+.. code-block:: bash
+
+    python -m bernet.server models/alexnet.yaml --port 8000
+    python -m bernet.server models/alexnet.yaml --unix-socket /tmp/alexnet
+    python -m bernet.server models/alexnet.yaml --engine int8 \
+        --quantization alexnet_int8.npz
+
+The server understands three requests:
+
+* `POST /predict` with an array in `.npy` format as body. It has the shape
+  `input_shape` of the network with any batch size, or the shape of a
+  single example. The response are the outputs in `.npy` format or, for a
+  :class:`.GraphNet`, a `.npz` file with one array per output layer.
+* `GET /stats`: JSON with the p50/p99 latency, the batch fill rate and the
+  queue depth.
+* `GET /info`: JSON with the input shape of the network.
+
+:class:`.InferenceClient` sends these requests. The script
+`benchmarks/load_generator.py` uses it to put load on a server.
+"""
+import argparse
+import collections
+import http.client
+import http.server
+import io
+import json
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+from bernet.config import load
+from bernet.net import FeedForwardNet, GraphNet
+from bernet.quantization import Quantization
+from bernet.utils import bs, as_floatX
+
+
+class _Request(object):
+    def __init__(self, input):
+        self.input = input
+        self.output = None
+        self.error = None
+        self.enqueued = time.time()
+        self.done = threading.Event()
+
+
+_STOP = object()
+
+
+def _slice_outputs(outputs, begin, end):
+    if isinstance(outputs, dict):
+        return collections.OrderedDict(
+            (name, out[begin:end]) for name, out in outputs.items())
+    return outputs[begin:end]
+
+
+class MicroBatcher(object):
+    """
+    Combines the inputs of concurrent :meth:`.submit` calls into batches
+    and computes them with `predict` in a single worker thread.
+
+    :param predict: function from a batch of examples to the outputs, e.g.
+        :meth:`.FeedForwardNet.forward`.
+    :param max_batch_size: maximum number of examples in a batch. A single
+        request with more examples is computed on its own.
+    :param max_wait: maximum number of seconds the first request of a batch
+        waits for more requests.
+    :param n_latencies: number of recent latencies kept for :meth:`.stats`.
+    """
+
+    def __init__(self, predict, max_batch_size, max_wait=0.005,
+                 n_latencies=10000):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._next = None
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=n_latencies)
+        self._n_requests = 0
+        self._n_batches = 0
+        self._n_examples = 0
+        # sum of max(max_batch_size, examples) over the batches. A single
+        # oversized request fills its own batch.
+        self._capacity = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, input):
+        """Returns the outputs for `input`, an array of examples. Blocks
+        until the batch with `input` is computed."""
+        request = _Request(input)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def close(self):
+        """Computes the queued requests and stops the worker thread."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def stats(self) -> dict:
+        """Returns the number of requests, batches and examples, the p50 and
+        p99 latency in milliseconds of the recent requests, the fraction of
+        the batch capacity that was used and the number of queued requests.
+        The capacity of a batch is `max_batch_size` or the number of
+        examples of a larger single request."""
+        with self._lock:
+            latencies = np.array(self._latencies)
+            stats = {
+                'requests': self._n_requests,
+                'batches': self._n_batches,
+                'examples': self._n_examples,
+            }
+            capacity = self._capacity
+        if len(latencies) > 0:
+            stats['p50_latency_ms'] = 1000 * float(np.percentile(latencies,
+                                                                 50))
+            stats['p99_latency_ms'] = 1000 * float(np.percentile(latencies,
+                                                                 99))
+        if capacity > 0:
+            stats['batch_fill_rate'] = stats['examples'] / capacity
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def _next_batch(self):
+        """Returns the requests of the next batch or None, if the batcher
+        is stopped."""
+        first = self._next if self._next is not None else self._queue.get()
+        self._next = None
+        if first is _STOP:
+            return None
+        batch = [first]
+        n_examples = len(first.input)
+        deadline = first.enqueued + self.max_wait
+        while n_examples < self.max_batch_size:
+            try:
+                timeout = deadline - time.time()
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is _STOP or \
+                    n_examples + len(request.input) > self.max_batch_size:
+                self._next = request
+                break
+            batch.append(request)
+            n_examples += len(request.input)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                outputs = self.predict(
+                    np.concatenate([r.input for r in batch]))
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            begin = 0
+            done = time.time()
+            with self._lock:
+                for request in batch:
+                    end = begin + len(request.input)
+                    request.output = _slice_outputs(outputs, begin, end)
+                    self._latencies.append(done - request.enqueued)
+                    begin = end
+                self._n_requests += len(batch)
+                self._n_batches += 1
+                self._n_examples += begin
+                self._capacity += max(self.max_batch_size, begin)
+            for request in batch:
+                request.done.set()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # keeps the connection of a client open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(self.server.inference.batcher.stats())
+        elif self.path == "/info":
+            self._send_json({
+                'name': self.server.inference.net.name,
+                'input_shape': list(self.server.inference.net.input_shape),
+            })
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_error(404)
+            return
+        if self.headers["Content-Length"] is None:
+            self.send_error(411)
+            return
+        try:
+            length = int(self.headers["Content-Length"])
+        except ValueError:
+            self.send_error(400, "Content-Length is not an integer.")
+            return
+        try:
+            input = self.server.inference.prepare_input(np.load(
+                io.BytesIO(self.rfile.read(length)), allow_pickle=False))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            output = self.server.inference.batcher.submit(input)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        body = io.BytesIO()
+        if isinstance(output, dict):
+            np.savez(body, **output)
+            content_type = "application/x-npz"
+        else:
+            np.save(body, output)
+            content_type = "application/x-npy"
+        self._send(body.getvalue(), content_type)
+
+    def _send_json(self, obj):
+        self._send(json.dumps(obj).encode('utf-8'), "application/json")
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # the client address of a unix socket is not a (host, port) tuple
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def log_message(self, format, *args):
+        if self.server.inference.verbose:
+            super().log_message(format, *args)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class InferenceServer(object):
+    """
+    Serves :meth:`.FeedForwardNet.forward` of `net` over HTTP on localhost
+    or on a unix socket. The requests are combined by a
+    :class:`.MicroBatcher`.
+
+    :param max_batch_size: defaults to the batch size of `input_shape`.
+    :param max_wait: maximum number of seconds a request waits for more
+        requests to fill its batch.
+    :param engine: see :meth:`.FeedForwardNet.forward`.
+    :param port: TCP port on `host`. `0` picks a free port.
+    :param unix_socket: path of a unix socket. If given, the server listens
+        on it instead of `host` and `port`.
+    """
+
+    def __init__(self, net, max_batch_size=None, max_wait=0.005,
+                 engine="theano", host="127.0.0.1", port=8000,
+                 unix_socket=None, verbose=False):
+        self.net = net
+        self.verbose = verbose
+        if max_batch_size is None:
+            max_batch_size = bs(net.input_shape)
+        # compile before the first request arrives
+        net.forward(as_floatX(np.zeros((1,) + tuple(net.input_shape[1:]))),
+                    engine=engine)
+        self.batcher = MicroBatcher(
+            lambda x: net.forward(x, engine=engine), max_batch_size,
+            max_wait)
+        if unix_socket is None:
+            self._server = _TCPServer((host, port), _Handler)
+        else:
+            self._server = _UnixServer(unix_socket, _Handler)
+        self._server.inference = self
+
+    @property
+    def address(self):
+        """The `(host, port)` tuple or the path of the unix socket."""
+        return self._server.server_address
+
+    def prepare_input(self, input):
+        """Adds the batch axis to a single example and checks the shape."""
+        example_shape = tuple(self.net.input_shape[1:])
+        if input.shape == example_shape:
+            input = input[np.newaxis]
+        if input.shape[1:] != example_shape:
+            raise ValueError("Expected input of shape (n, {}), but got {}."
+                             .format(", ".join(map(str, example_shape)),
+                                     input.shape))
+        return as_floatX(input)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stops :meth:`.serve_forever`, which runs in another thread."""
+        self._server.shutdown()
+
+    def close(self):
+        self._server.server_close()
+        self.batcher.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class InferenceClient(object):
+    """
+    Client of an :class:`.InferenceServer` at `host` and `port` or at
+    `unix_socket`. A client holds one connection and must not be shared
+    between threads.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8000, unix_socket=None,
+                 timeout=60.):
+        if unix_socket is None:
+            self._connection = http.client.HTTPConnection(host, port,
+                                                          timeout=timeout)
+        else:
+            self._connection = _UnixHTTPConnection(unix_socket, timeout)
+
+    def predict(self, input):
+        body = io.BytesIO()
+        np.save(body, np.asarray(input))
+        response = self._request("POST", "/predict", body.getvalue())
+        data = np.load(io.BytesIO(response), allow_pickle=False)
+        if isinstance(data, np.lib.npyio.NpzFile):
+            with data:
+                return collections.OrderedDict(
+                    (name, data[name]) for name in data.files)
+        return data
+
+    def stats(self) -> dict:
+        return json.loads(self._request("GET", "/stats").decode('utf-8'))
+
+    def info(self) -> dict:
+        return json.loads(self._request("GET", "/info").decode('utf-8'))
+
+    def close(self):
+        self._connection.close()
+
+    def _request(self, method, path, body=None):
+        self._connection.request(method, path, body=body)
+        response = self._connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise IOError("Request {} {} failed with {} {}".format(
+                method, path, response.status, response.reason))
+        return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serves a network with dynamic micro-batching.")
+    parser.add_argument("model", help="YAML file of the network")
+    parser.add_argument("--graph", action="store_true",
+                        help="load the model as GraphNet")
+    parser.add_argument("--engine", default="theano",
+                        choices=["theano", "numpy", "int8"])
+    parser.add_argument("--quantization",
+                        help="int8 parameter file of the int8 engine, see "
+                             "Quantization.save")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket")
+    parser.add_argument("--max-batch-size", type=int)
+    parser.add_argument("--max-wait-ms", type=float, default=5.)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    if args.engine == "int8" and args.quantization is None:
+        parser.error("--engine int8 requires --quantization")
+
+    with open(args.model) as f:
+        net = load(GraphNet if args.graph else FeedForwardNet, f)
+    if args.quantization is not None:
+        net.quantization = Quantization.load(args.quantization)
+    server = InferenceServer(
+        net, max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000., engine=args.engine,
+        host=args.host, port=args.port, unix_socket=args.unix_socket,
+        verbose=args.verbose)
+    print("Serving {} on {}".format(net.name, server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Timing of the stages of loading and compiling a model.
+
+The stages are the YAML parsing, the construction of the network, the
+loading of its parameters, the connection and shape checks, the filling of
+the parameters and the compilation of functions. Stages nest, e.g. the
+construction of a network is part of the YAML parsing.
+
+.. code-block:: python
+
+    with tracing() as trace:
+        net = load(FeedForwardNet, open("models/alexnet.yaml"))
+        net.forward(x)
+    trace.write(sys.stdout)
+
+If the environment variable `BERNET_TRACE` is set to a file path, the
+stages of the whole process are traced and written to that file at exit.
+`BERNET_TRACE=-` writes them to stderr.
+
+Every stage is written as one line of JSON with its `name`, `depth`,
+`start` (seconds since the start of the trace), `seconds`,
+`allocated_bytes` (the change of the memory traced by :mod:`tracemalloc`,
+which needs Python 3.4) and `rss_bytes` (the change of the resident set
+size), if available.
+"""
+import atexit
+from contextlib import contextmanager
+import json
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 3.3
+    tracemalloc = None
+
+_active_traces = []
+
+
+def _traced_bytes():
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0]
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Trace(object):
+    """The recorded stages. See :func:`.tracing`."""
+
+    def __init__(self):
+        self.events = []
+        self._depth = 0
+        self._start = time.time()
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Records the duration and the allocated bytes of the body as the
+        stage `name`. `info` is added to the event."""
+        event = {'name': name, 'depth': self._depth,
+                 'start': time.time() - self._start}
+        event.update(info)
+        # the event is appended now to keep the events in start order
+        self.events.append(event)
+        rss = _rss_bytes()
+        allocated = _traced_bytes()
+        begin = time.time()
+        self._depth += 1
+        try:
+            yield event
+        finally:
+            self._depth -= 1
+            event['seconds'] = time.time() - begin
+            traced = _traced_bytes()
+            if allocated is not None and traced is not None:
+                event['allocated_bytes'] = traced - allocated
+            if rss is not None:
+                event['rss_bytes'] = _rss_bytes() - rss
+
+    def summary(self) -> dict:
+        """Returns the total seconds per stage name."""
+        totals = {}
+        for event in self.events:
+            totals[event['name']] = \
+                totals.get(event['name'], 0.) + event.get('seconds', 0.)
+        return totals
+
+    def write(self, file):
+        """Writes the events as JSON lines to `file`."""
+        for event in self.events:
+            file.write(json.dumps(event, sort_keys=True) + "\n")
+        file.flush()
+
+
+@contextmanager
+def tracing(trace=None):
+    """Records the stages of the body in `trace` or a new :class:`.Trace`,
+    which is returned by the context manager. The memory allocations are
+    traced with :mod:`tracemalloc` while the body runs."""
+    if trace is None:
+        trace = Trace()
+    started_tracemalloc = tracemalloc is not None and \
+        not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    _active_traces.append(trace)
+    try:
+        yield trace
+    finally:
+        _active_traces.remove(trace)
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+
+@contextmanager
+def stage(name, **info):
+    """Records the body as stage `name` in the innermost active trace.
+    Does nothing if no trace is active."""
+    if not _active_traces:
+        yield None
+        return
+    with _active_traces[-1].stage(name, **info) as event:
+        yield event
+
+
+def _trace_from_environment():
+    path = os.environ.get("BERNET_TRACE")
+    if not path:
+        return
+    context = tracing()
+    trace = context.__enter__()
+
+    def write():
+        context.__exit__(None, None, None)
+        if path == "-":
+            trace.write(sys.stderr)
+        else:
+            with open(path, "w") as f:
+                trace.write(f)
+
+    atexit.register(write)
+
+
+_trace_from_environment()
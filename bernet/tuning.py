@@ -0,0 +1,189 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmarks a compiled forward pass or training step of a
+:class:`.FeedForwardNet` over a range of batch sizes and picks the one with
+the highest throughput.
+
+.. code-block:: python
+
+    report = tune_batch_size(net, memory_budget=2 * 2**30)
+    print(format_tuning_report(report))
+    dump(net, stream=open("alexnet_tuned.yaml", "w"))
+
+The best inference batch size is written to the batch dimension of the
+`input_shape` of the network and its layers. It is the default batch size
+of :meth:`.predict_iter` and :meth:`.extract`. The best training batch size
+is written to `batch_size`, the minibatch size of the
+:class:`.SupervisedTrainer`.
+Batch sizes whose estimated memory (see :meth:`.cost_summary`) exceeds the
+budget are not run.
+"""
+import time
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from bernet.loss import MSE
+from bernet.optimization import Rprop
+from bernet.utils import floatX
+
+DEFAULT_BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _time_calls(func, n_runs):
+    """Returns the median seconds of `n_runs` calls after one warm-up
+    call."""
+    func()
+    seconds = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds))
+
+
+def _inference_step(net):
+    shared_input, func = net._predict_func()
+
+    def step(batch_size):
+        shape = (batch_size,) + tuple(net.input_shape[1:])
+        shared_input.set_value(np.random.sample(shape).astype(floatX()),
+                               borrow=True)
+        return func
+    return step
+
+
+def _training_step(net, max_batch_size, optimizer):
+    """Compiles one training step on the first examples of shared buffers
+    of `max_batch_size` examples. Its updates change the parameters, see
+    :func:`.tune_batch_size`."""
+    example_shape = tuple(net.input_shape[1:])
+    data = theano.shared(np.random.sample(
+        (max_batch_size,) + example_shape).astype(floatX()),
+        name='tuning_data')
+    x = T.TensorType(floatX(), (False,) * (len(example_shape) + 1))('x')
+    out = net.output(x)
+    if isinstance(net.loss, MSE):
+        labels = T.TensorType(floatX(), (False,) * out.ndim)('labels')
+        label_shape = (max_batch_size,) + \
+            tuple(net.infer_shapes()[net.output_layer.name][1][1:])
+    else:
+        labels = T.vector('labels', dtype=floatX())
+        label_shape = (max_batch_size,)
+    shared_labels = theano.shared(np.zeros(label_shape, dtype=floatX()),
+                                  name='tuning_labels')
+    end = T.lscalar('end')
+    loss = net.get_loss(out, labels)
+    func = theano.function(
+        [end], loss,
+        givens={x: data[:end], labels: shared_labels[:end]},
+        updates=optimizer.updates(loss, net.parameters_as_shared()))
+
+    def step(batch_size):
+        return lambda: func(batch_size)
+    return step
+
+
+def _set_input_batch_size(net, batch_size):
+    """Sets the batch dimension of the `input_shape` of `net` and its
+    layers, which must match, see :meth:`.FeedForwardNet._check_shapes`."""
+    net.input_shape = (batch_size,) + tuple(net.input_shape[1:])
+    for layer in net.layer_iter():
+        if getattr(layer, 'input_shape', None) is not None:
+            layer.input_shape = (batch_size,) + tuple(layer.input_shape[1:])
+
+
+def tune_batch_size(net, batch_sizes=DEFAULT_BATCH_SIZES, training=False,
+                    memory_budget=None, max_latency=None, n_runs=5,
+                    optimizer=None, write_back=True) -> dict:
+    """
+    Measures the latency and throughput of `net` for every batch size in
+    `batch_sizes` and returns a dict with the `results` and the `best`
+    batch size, which has the most examples per second.
+
+    :param training: benchmark a training step with `optimizer` instead of
+        the forward pass. The parameters are restored afterwards.
+    :param memory_budget: skip batch sizes whose estimated memory in bytes
+        exceeds the budget.
+    :param max_latency: only choose batch sizes with at most this many
+        seconds per batch.
+    :param n_runs: timed calls per batch size after one warm-up call.
+    :param optimizer: an :class:`.Optimizator`. Defaults to :class:`.Rprop`.
+    :param write_back: write the best batch size to `net`. See
+        :mod:`bernet.tuning`.
+    """
+    if optimizer is None:
+        optimizer = Rprop()
+    batch_sizes = sorted(batch_sizes)
+    memory_key = 'training_bytes' if training else 'inference_bytes'
+
+    candidates = []
+    for batch_size in batch_sizes:
+        summary = net.cost_summary(batch_size,
+                                   optimizer=optimizer if training else None)
+        if memory_budget is not None and \
+                summary[memory_key] > memory_budget:
+            break
+        candidates.append((batch_size, summary[memory_key]))
+    if not candidates:
+        raise ValueError("The smallest batch size {} needs more than the "
+                         "memory budget of {} bytes."
+                         .format(batch_sizes[0], memory_budget))
+
+    max_batch_size = candidates[-1][0]
+    parameters = [p.get_value() for p in net.parameters_as_shared()]
+    try:
+        if training:
+            step = _training_step(net, max_batch_size, optimizer)
+        else:
+            step = _inference_step(net)
+        results = []
+        for batch_size, estimated_bytes in candidates:
+            latency = _time_calls(step(batch_size), n_runs)
+            results.append({
+                'batch_size': batch_size,
+                'latency': latency,
+                'examples_per_second': batch_size / latency,
+                'estimated_bytes': estimated_bytes,
+            })
+    finally:
+        if training:
+            for shared, value in zip(net.parameters_as_shared(), parameters):
+                shared.set_value(value)
+
+    allowed = [r for r in results
+               if max_latency is None or r['latency'] <= max_latency]
+    best = None
+    if allowed:
+        best = max(allowed, key=lambda r: r['examples_per_second'])
+        best = best['batch_size']
+    if write_back and best is not None:
+        if training:
+            net.batch_size = best
+        else:
+            _set_input_batch_size(net, best)
+    return {'best': best, 'training': training, 'results': results}
+
+
+def format_tuning_report(report) -> str:
+    lines = ["{:>10} {:>12} {:>14} {:>14}".format(
+        "batch size", "latency ms", "examples/s", "estimated MiB")]
+    for r in report['results']:
+        mark = "  *" if r['batch_size'] == report['best'] else ""
+        lines.append("{:>10} {:>12.3f} {:>14.1f} {:>14.1f}{}".format(
+            r['batch_size'], 1000 * r['latency'], r['examples_per_second'],
+            r['estimated_bytes'] / 2**20, mark))
+    return "\n".join(lines)
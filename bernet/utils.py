@@ -12,40 +12,282 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import hashlib
+import io
 import operator
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
 from functools import reduce
 from PIL import Image, ImageDraw, ImageFont
 from math import sqrt, ceil
 
 import numpy as np
+import scipy.sparse
 import theano
 
 import theano.tensor as T
 
 
-def download(url: str, file) -> bool:
-    # TODO: make the download bar nicer (e.g MBytes, a real bar, ...)
-    u = urllib.request.urlopen(url)
-    meta = u.info()
-    file_size = int(meta["Content-Length"])
+class _Progress(object):
+    """Prints the download status at most every `interval` seconds."""
+
+    def __init__(self, total, done, interval):
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self._last_print = 0.
+
+    def update(self, n_bytes):
+        self.done += n_bytes
+        now = time.time()
+        if now - self._last_print >= self.interval:
+            self._last_print = now
+            self._print(end='\r')
+
+    def finish(self):
+        self._print(end='\n')
+
+    def _print(self, end):
+        if self.total:
+            print(r"%10d  [%3.2f%%]" % (self.done,
+                                        self.done * 100. / self.total),
+                  end=end)
+        else:
+            print(r"%10d" % self.done, end=end)
+
+
+class _HashingWriter(object):
+    """Writes the chunks at their offsets to `file` and hashes the content
+    of the file in order. Chunks that arrive before their predecessors are
+    read back from the file once the gap before them is filled."""
+
+    def __init__(self, file, sha, offset, block_size):
+        self.file = file
+        self.sha = sha
+        self.hashed = offset
+        self.block_size = block_size
+        self._written = {}
+
+    def write(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+        if offset != self.hashed:
+            self._written[offset] = offset + len(data)
+            return
+        self.sha.update(data)
+        self.hashed += len(data)
+        while self.hashed in self._written:
+            end = self._written.pop(self.hashed)
+            self.file.seek(self.hashed)
+            _hash_file(self.sha, self.file, end - self.hashed,
+                       self.block_size)
+            self.hashed = end
+
+
+def _hash_file(sha, file, n_bytes, block_size):
+    while n_bytes > 0:
+        buf = file.read(min(block_size, n_bytes))
+        if not buf:
+            raise IOError("File ended before all bytes were hashed.")
+        sha.update(buf)
+        n_bytes -= len(buf)
+
+
+def _open_range(url, start, end=None):
+    """Opens `url` at the byte `start` (and up to the byte `end`).
+
+    :return: the stream, the offset at which the stream starts, the total
+        size of the resource (None if unknown) and whether ranges are
+        supported. The offset is 0 if the server does not support range
+        requests.
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'file':
+        f = open(urllib.request.url2pathname(parsed.path), 'rb')
+        total = os.fstat(f.fileno()).st_size
+        start = min(start, total)
+        f.seek(start)
+        return f, start, total, True
+
+    request = urllib.request.Request(url)
+    request.add_header("Range", "bytes={}-{}".format(
+        start, "" if end is None else end - 1))
+    try:
+        u = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        # the range starts at the end of the resource
+        total = e.headers.get("Content-Range", "*/*").rsplit("/", 1)[1]
+        e.close()
+        if total != str(start):
+            return _open_range(url, 0, end)
+        return io.BytesIO(), start, start, True
+    if u.getcode() == 206:
+        total = u.info()["Content-Range"].rsplit("/", 1)[1]
+        return u, start, None if total == "*" else int(total), True
+    length = u.info()["Content-Length"]
+    return u, 0, None if length is None else int(length), False
+
+
+def _read_range(stream, begin, end, block_size, chunks, stop):
+    try:
+        pos = begin
+        while (end is None or pos < end) and not stop.is_set():
+            n = block_size if end is None else min(block_size, end - pos)
+            buf = stream.read(n)
+            if not buf:
+                break
+            chunks.put((pos, buf))
+            pos += len(buf)
+        if end is not None and pos < end and not stop.is_set():
+            raise IOError("Connection closed after {} of the bytes {}-{}."
+                          .format(pos - begin, begin, end - 1))
+        chunks.put((None, None))
+    except Exception as e:
+        chunks.put((None, e))
+    finally:
+        stream.close()
+
+
+def download(url: str, file, n_connections: int=1, mirror: str=None,
+             block_size: int=2**16, progress_interval: float=1.) -> str:
+    """
+    Downloads `url` to `file`, which must be opened in `w+b` or `r+b` mode.
+    If `file` already contains data, the download is resumed with a HTTP
+    Range request. The content is hashed while it is written.
+
+    :param n_connections: number of ranges that are fetched in parallel, if
+        the server supports range requests.
+    :param mirror: a local directory. If it contains a file with the name
+        of the last part of `url`, the file is copied from there.
+    :param progress_interval: minimal number of seconds between two
+        status lines.
+    :return: the sha256 hex digest of the content of `file`.
+    """
+    if mirror is not None:
+        name = os.path.basename(urllib.parse.urlparse(url).path)
+        mirrored = os.path.join(mirror, name)
+        if name and os.path.isfile(mirrored):
+            url = "file://" + urllib.request.pathname2url(
+                os.path.abspath(mirrored))
+
+    file.seek(0, os.SEEK_END)
+    stream, offset, total, ranges_supported = _open_range(url, file.tell())
+    file.truncate(offset)
     print("Downloading url {} to {}. Total bytes: {}"
-          .format(url, file.name, file_size))
+          .format(url, file.name, total))
 
-    file_size_dl = 0
-    block_sz = 2**16
-    while True:
-        buffer = u.read(block_sz)
-        if not buffer:
-            break
+    sha = hashlib.sha256()
+    file.seek(0)
+    _hash_file(sha, file, offset, block_size)
+    writer = _HashingWriter(file, sha, offset, block_size)
+    progress = _Progress(total, offset, progress_interval)
+
+    ranges = [(stream, offset, None)]
+    if n_connections > 1 and ranges_supported and total is not None:
+        bounds = np.linspace(offset, total, n_connections + 1).astype(int)
+        ranges = [(stream, bounds[0], bounds[1])]
+        for begin, end in zip(bounds[1:-1], bounds[2:]):
+            if end > begin:
+                ranges.append((_open_range(url, begin, end)[0], begin, end))
+
+    chunks = queue.Queue(maxsize=4 * len(ranges))
+    stop = threading.Event()
+    threads = [threading.Thread(target=_read_range,
+                                args=(s, b, e, block_size, chunks, stop),
+                                daemon=True)
+               for s, b, e in ranges]
+    for t in threads:
+        t.start()
+    error = None
+    n_running = len(threads)
+    while n_running > 0:
+        pos, data = chunks.get()
+        if pos is None:
+            n_running -= 1
+            if data is not None and error is None:
+                error = data
+                stop.set()
+        elif error is None:
+            writer.write(pos, data)
+            progress.update(len(data))
+    file.flush()
+    if error is not None:
+        raise error
+    progress.finish()
+    return sha.hexdigest()
 
-        file_size_dl += len(buffer)
-        file.write(buffer)
-        status = r"%10d  [%3.2f%%]" % (file_size_dl,
-                                       file_size_dl * 100. / file_size)
-        print(status, end='\r')
 
-    file.flush()
+def fetch_verified(url: str, file_path: str, sha256: str,
+                   n_connections: int=1, mirror: str=None) -> bool:
+    """Downloads `url` to `file_path`, unless `file_path` already exists
+    and has the sha256 hex digest `sha256`. The download is written to
+    `<file_path>.part` and only moved to `file_path` if its digest matches.
+    An interrupted download is resumed from the part file.
+
+    :return: True if the file was downloaded.
+    :raises ValueError: if the digest of the download does not match.
+    """
+    if os.path.exists(file_path):
+        with open(file_path, "rb") as f:
+            if sha256_of_file(f) == sha256:
+                return False
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    part_path = file_path + ".part"
+    with open(part_path, "r+b" if os.path.exists(part_path) else "w+b") \
+            as f:
+        sha256_got = download(url, f, n_connections, mirror)
+    if sha256 != sha256_got:
+        os.remove(part_path)
+        raise ValueError("The given sha256sum {:} of is not equal to"
+                         " {:} from the url {:}"
+                         .format(sha256, sha256_got, url))
+    os.replace(part_path, file_path)
+    return True
+
+
+def save_npy_dir(directory: str, arrays: dict):
+    """Saves every array of `arrays` uncompressed as
+    `<directory>/<name>.npy`, so that they can be memory-mapped with
+    :func:`.load_npy_dir`. The directory is written to a temporary
+    directory first and then renamed, so concurrent readers never see a
+    partial directory."""
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, suffix=".part")
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"),
+                    np.ascontiguousarray(arr))
+        try:
+            os.rename(tmp_dir, directory)
+        except OSError:
+            # another process has created the directory in the meantime
+            if not os.path.isdir(directory):
+                raise
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def load_npy_dir(directory: str, mmap_mode: str='c') -> dict:
+    """Memory-maps the arrays saved with :func:`.save_npy_dir`. With the
+    default copy-on-write mode, processes share the pages of the files and
+    writes to the arrays never reach the disk."""
+    arrays = {}
+    for file_name in os.listdir(directory):
+        name, ext = os.path.splitext(file_name)
+        if ext == ".npy":
+            arrays[name] = np.load(os.path.join(directory, file_name),
+                                   mmap_mode=mmap_mode)
+    return arrays
 
 
 def sha256_of_file(file, block_size: int=65536) -> str:
@@ -94,9 +336,72 @@ def size(shape):
     return reduce(operator.mul, shape, 1)
 
 
+def floatX():
+    """The dtype of parameters, optimizer states, activations and datasets.
+    It is Theano's `floatX` and is configured with
+    `THEANO_FLAGS="floatX=float32"`."""
+    return theano.config.floatX
+
+
+def as_floatX(arr):
+    """Returns `arr` as array of :func:`.floatX`. Copies only if the dtype
+    differs."""
+    return np.asarray(arr, dtype=floatX())
+
+
+def float64_variables(fn):
+    """Returns the float64 variables in the graph of the compiled Theano
+    function `fn`. With `floatX=float32` these are unintended upcasts, e.g.
+    from a float64 parameter or numpy constant."""
+    return [v for v in fn.maker.fgraph.variables
+            if getattr(v.type, 'dtype', None) == 'float64']
+
+
+_CSR_PARTS = ('data', 'indices', 'indptr', 'shape')
+
+
+def parameters_to_npz(parameters: dict) -> dict:
+    """Returns the arrays to store `parameters` with `np.savez`. A sparse
+    parameter `p` is stored as the arrays `p__csr_data`, `p__csr_indices`,
+    `p__csr_indptr` and `p__csr_shape`."""
+    arrays = {}
+    for name, value in parameters.items():
+        if scipy.sparse.issparse(value):
+            value = scipy.sparse.csr_matrix(value)
+            for part in _CSR_PARTS:
+                arrays["{}__csr_{}".format(name, part)] = \
+                    np.asarray(getattr(value, part))
+        else:
+            arrays[name] = value
+    return arrays
+
+
+def parameters_from_npz(arrays) -> dict:
+    """Inverse of :func:`.parameters_to_npz`. `arrays` is a npz file or a
+    dict. Dense parameters are returned as arrays of :func:`.floatX`, sparse
+    ones as CSR matrices. Memory-mapped arrays of :func:`.floatX` are not
+    copied."""
+    parameters = {}
+    csr_parts = {}
+    for key in arrays.keys():
+        if "__csr_" in key:
+            name, part = key.rsplit("__csr_", 1)
+            csr_parts.setdefault(name, {})[part] = arrays[key]
+        elif isinstance(arrays[key], np.memmap) and \
+                arrays[key].dtype == floatX():
+            parameters[key] = arrays[key]
+        else:
+            parameters[key] = as_floatX(arrays[key])
+    for name, parts in csr_parts.items():
+        parameters[name] = scipy.sparse.csr_matrix(
+            (as_floatX(parts['data']), parts['indices'], parts['indptr']),
+            shape=tuple(parts['shape']))
+    return parameters
+
+
 def shared_tensor_from_dims(name, dims):
     shape = (1, ) * dims
-    return theano.shared(np.zeros(shape), name=name)
+    return theano.shared(np.zeros(shape, dtype=floatX()), name=name)
 
 
 def symbolic_tensor_from_dims(name, dims):
@@ -112,7 +417,10 @@ def symbolic_tensor_from_shape(name, shp):
 
 
 def shared_like(shared_tensor, name, init=0):
-    return theano.shared(np.zeros_like(shared_tensor.get_value()) + init,
+    """Returns a shared variable with the shape and dtype of
+    `shared_tensor` filled with `init`."""
+    value = shared_tensor.get_value(borrow=True)
+    return theano.shared(np.full_like(value, init),
                          name="{}_{}".format(shared_tensor.name, name))
 
 
@@ -216,6 +524,79 @@ def chunks(list, n):
         yield list[i:i+n]
 
 
+def staged_batches(data, batch_size, example_shape, dtype=None):
+    """
+    Yields `(batch, n)` tuples, where the first `n` examples of the
+    preallocated array `batch` hold the next examples of `data`. The rest of
+    `batch` is filled with zeros.
+
+    The next batch is copied in a background thread while the caller
+    processes the current one. A yielded batch stays valid until the next
+    batch is requested.
+
+    :param data: an array with the examples along the first axis or an
+        iterable of examples.
+    """
+    if dtype is None:
+        dtype = theano.config.floatX
+    free = queue.Queue()
+    for _ in range(2):
+        free.put(np.zeros((batch_size,) + tuple(example_shape), dtype=dtype))
+    staged = queue.Queue()
+
+    def fill_from_array(batch, begin):
+        n = min(batch_size, len(data) - begin)
+        batch[:n] = np.reshape(data[begin:begin+n], (n,) + batch.shape[1:])
+        return n
+
+    def stage():
+        try:
+            if hasattr(data, 'shape'):
+                for begin in range(0, len(data), batch_size):
+                    batch = free.get()
+                    if batch is None:
+                        return
+                    n = fill_from_array(batch, begin)
+                    batch[n:] = 0
+                    staged.put((batch, n))
+            else:
+                batch, n = None, 0
+                for example in data:
+                    if batch is None:
+                        batch = free.get()
+                        if batch is None:
+                            return
+                    batch[n] = np.reshape(example, batch.shape[1:])
+                    n += 1
+                    if n == batch_size:
+                        staged.put((batch, n))
+                        batch, n = None, 0
+                if batch is not None:
+                    batch[n:] = 0
+                    staged.put((batch, n))
+            staged.put(None)
+        except Exception as e:
+            staged.put(e)
+
+    threading.Thread(target=stage, daemon=True).start()
+    current = None
+    try:
+        while True:
+            item = staged.get()
+            if current is not None:
+                free.put(current)
+                current = None
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            current, n = item
+            yield current, n
+    finally:
+        # stops the staging thread, if it waits for a free batch
+        free.put(None)
+
+
 def to_image_magic(x):
     """Reshapes x with shape (..., channels, height, weight) to Image Magic
     shape (..., height, weight, channel)."""
@@ -28,7 +28,7 @@ with open(_dir + "/shallow-net.yaml") as f:
     trainer = SupervisedTrainer()
     trainer.train(net, mnist)
     test_epoch = next(mnist.test_epoch())
-    pred_test = net.forward(test_epoch.data())
+    pred_test = net.predict_batches(test_epoch.data())
     confusion = confusion_matrix(pred_test, test_epoch.labels())
     print_confusion_matrix(confusion)
 
@@ -0,0 +1,80 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from bernet.cache import FunctionCache
+
+
+class TestFunctionCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def compile_func(self, w):
+        x = T.vector('x')
+        return lambda: theano.function([x], x * w, updates={w: w + 1})
+
+    def test_hit_and_miss(self):
+        w = theano.shared(np.ones(3), name='w')
+        cache = FunctionCache(self.cache_dir)
+        key = cache.key('test_hit_and_miss')
+        cache.get_or_compile(key, self.compile_func(w), {'w': w})
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 1)
+
+        # simulates a new process
+        new_w = theano.shared(np.zeros(3), name='w')
+        new_cache = FunctionCache(self.cache_dir)
+        fn = new_cache.get_or_compile(key, self.compile_func(new_w),
+                                      {'w': new_w})
+        self.assertEqual(new_cache.hits, 1)
+        self.assertEqual(new_cache.misses, 0)
+        self.assertGreaterEqual(new_cache.saved_seconds, 0)
+
+        # the loaded function uses and updates the live shared variable
+        np.testing.assert_equal(fn(np.ones(3)), np.zeros(3))
+        np.testing.assert_equal(new_w.get_value(), np.ones(3))
+        np.testing.assert_equal(w.get_value(), np.ones(3))
+
+    def test_missing_shared_variable_recompiles(self):
+        w = theano.shared(np.ones(3), name='w')
+        cache = FunctionCache(self.cache_dir)
+        key = cache.key('test_missing_shared_variable')
+        cache.get_or_compile(key, self.compile_func(w), {'w': w})
+        cache.get_or_compile(key, self.compile_func(w), {})
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 2)
+
+    def test_key(self):
+        self.assertEqual(FunctionCache.key('a', [1, 2]),
+                         FunctionCache.key('a', [1, 2]))
+        self.assertNotEqual(FunctionCache.key('a', [1, 2]),
+                            FunctionCache.key('a', [1, 3]))
+
+    def test_clear(self):
+        w = theano.shared(np.ones(3), name='w')
+        cache = FunctionCache(self.cache_dir)
+        key = cache.key('test_clear')
+        cache.get_or_compile(key, self.compile_func(w), {'w': w})
+        cache.clear()
+        cache.get_or_compile(key, self.compile_func(w), {'w': w})
+        self.assertEqual(cache.misses, 2)
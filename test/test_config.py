@@ -314,3 +314,15 @@ class TestYamlEncoding(TestCase):
                          "  sex: female\n"
                          "name: Planetron Inc.\n"
                          "")
+
+    def test_config_digest(self):
+        max = Person(name="Max", sex="male", age=20)
+        susi = Person(name='Susi', sex='female')
+        c = Company(name="Planetron Inc.", employes=[max, susi])
+        self.assertEqual(config_digest(c), config_digest(
+            Company(name="Planetron Inc.",
+                    employes=[Person(name="Max", sex="male", age=20),
+                              Person(name='Susi', sex='female')])))
+        self.assertNotEqual(config_digest(c), config_digest(
+            Company(name="Planetron Inc.", employes=[max])))
+        self.assertNotEqual(config_digest(max), config_digest(susi))
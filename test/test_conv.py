@@ -0,0 +1,93 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import TestCase
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from bernet.conv import grouped_conv2d, pad, block_diagonal_filters, \
+    NO_PADDING
+
+theano.config.mode = "FAST_COMPILE"
+
+
+def naive_grouped_conv2d(x, w, group, stride, padding):
+    x = pad(x, padding)
+    b, c, height, width = x.shape
+    f, cg, kh, kw = w.shape
+    sh, sw = stride
+    oh = (height - kh) // sh + 1
+    ow = (width - kw) // sw + 1
+    fg = f // group
+    flipped = w[:, :, ::-1, ::-1]
+    out = np.zeros((b, f, oh, ow))
+    for k in range(f):
+        g = k // fg
+        for i in range(oh):
+            for j in range(ow):
+                window = x[:, g*cg:(g+1)*cg, i*sh:i*sh+kh, j*sw:j*sw+kw]
+                out[:, k, i, j] = (window * flipped[k]).sum(axis=(1, 2, 3))
+    return out
+
+
+def pad_symbolic(x, padding):
+    (top, bottom), (left, right) = padding
+    padded = T.zeros((x.shape[0], x.shape[1], x.shape[2] + top + bottom,
+                      x.shape[3] + left + right), dtype=x.dtype)
+    return T.set_subtensor(
+        padded[:, :, top:top+x.shape[2], left:left+x.shape[3]], x)
+
+
+class TestGroupedConv2d(TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(1234)
+        self.settings = [
+            # group, stride, padding
+            (1, (1, 1), NO_PADDING),
+            (2, (1, 1), ((2, 2), (2, 2))),
+            (2, (2, 3), ((1, 2), (0, 1))),
+            (3, (4, 4), NO_PADDING),
+        ]
+
+    def test_grouped_conv2d(self):
+        for group, stride, padding in self.settings:
+            x = self.rng.standard_normal((2, 6, 11, 13))
+            w = self.rng.standard_normal((6, 6 // group, 3, 4))
+            np.testing.assert_almost_equal(
+                grouped_conv2d(x, w, group, stride, padding),
+                naive_grouped_conv2d(x, w, group, stride, padding))
+
+    def test_block_diagonal_filters(self):
+        x = T.tensor4('x')
+        w = T.tensor4('w')
+        for group, stride, padding in self.settings:
+            out = T.nnet.conv2d(pad_symbolic(x, padding),
+                                block_diagonal_filters(w, group),
+                                subsample=stride)
+            fn = theano.function([x, w], out)
+            x_np = self.rng.standard_normal((2, 6, 11, 13))
+            w_np = self.rng.standard_normal((6, 6 // group, 3, 4))
+            np.testing.assert_almost_equal(
+                fn(x_np, w_np),
+                naive_grouped_conv2d(x_np, w_np, group, stride, padding))
+
+    def test_block_diagonal_filters_grad(self):
+        x = self.rng.standard_normal((2, 6, 7, 8))
+        for group in [2, 3]:
+            w = self.rng.standard_normal((6, 6 // group, 3, 2))
+            theano.gradient.verify_grad(
+                lambda w: T.nnet.conv2d(T.constant(x),
+                                        block_diagonal_filters(w, group)),
+                [w], rng=self.rng)
@@ -13,7 +13,7 @@
 # limitations under the License.
 from tempfile import NamedTemporaryFile
 
-from unittest import TestCase
+from unittest import TestCase, mock
 from numpy.testing import assert_array_equal, assert_almost_equal
 
 import theano
@@ -22,7 +22,7 @@ import yaml
 from yaml.constructor import ConstructorError
 
 from bernet.layer import *
-from bernet.config import ConfigError
+from bernet.config import ConfigError, load
 from test.test_config import ConfigFieldTestCase
 
 theano.config.mode = "FAST_COMPILE"
@@ -44,6 +44,7 @@ class TestLayer(TestCase):
     def test_base_function(self):
         l = self.layer
         self.assertNotImplemented(l.output, T.matrix("foo"))
+        self.assertNotImplemented(l.np_output, np.zeros((2, 2)))
 
     def assertNotImplemented(self, callable, *args, **kwargs):
         self.assertRaisesRegex(
@@ -89,12 +90,38 @@ class TestFiller(TestCase):
         n_total = shape[0] * shape[1]
         self.assertAlmostEqual(n_zeros / n_total, sparsity, delta=0.05)
 
+    def test_seed_and_threads(self):
+        filler = GaussianFiller(mean=1., std=2., sparsity=0.3)
+        with mock.patch('bernet.layer.FILL_CHUNK_SIZE', 100):
+            arr = filler.fill((30, 51), seed=[1, 2], n_threads=1)
+            assert_array_equal(arr, filler.fill((30, 51), seed=[1, 2],
+                                                n_threads=4))
+        # the chunks do not change the values of the first chunk
+        first_chunk = filler.fill((10, 10), seed=[1, 2])
+        assert_array_equal(arr.reshape(-1)[:100], first_chunk.reshape(-1))
+        self.assertFalse(np.array_equal(arr, filler.fill((30, 51), seed=3)))
+        self.assertEqual(filler.fill((2, 2), dtype='float32').dtype,
+                         np.float32)
+        self.assertAlmostEqual(np.mean(arr == 0.), 0.3, delta=0.05)
+
     def test_uniform(self):
         filler = UniformFiller(low=-1., high=1.)
         arr = filler.fill((200, 200))
         self.assertGreater(arr.min(), -1.)
         self.assertLess(arr.max(), 1.)
 
+    def test_dtype(self):
+        fillers = [ConstFiller(const_value=1., sparsity=0.5),
+                   UniformFiller(low=-1., high=1.),
+                   GaussianFiller(mean=1., std=2.)]
+        for filler in fillers:
+            self.assertEqual(filler.fill((20, 20)).dtype, floatX())
+
+        param = Parameter(name="param")
+        param.tensor = np.ones((2, 2), dtype='float64')
+        self.assertEqual(param.tensor.dtype, floatX())
+        self.assertEqual(param.shared.dtype, floatX())
+
 
 class TestRGB2BGRLayer(TestCase):
     def test_layer(self):
@@ -106,6 +133,7 @@ class TestRGB2BGRLayer(TestCase):
         np.testing.assert_equal(out[:, 0], input[:, 2])
         np.testing.assert_equal(out[:, 1], input[:, 1])
         np.testing.assert_equal(out[:, 2], input[:, 0])
+        np.testing.assert_equal(rgb2bgr.np_output(input), out)
         self.assertEqual(rgb2bgr.output_shape(input_shape), input_shape)
 
 
@@ -162,6 +190,7 @@ class TestArgMaxLayer(TestCase):
         argmax = ArgMaxLayer(name='argmax')
         out = argmax.output(shared(x)).eval()
         np.testing.assert_equal(out, np.argmax(x, axis=1))
+        np.testing.assert_equal(argmax.np_output(x), out)
         print(argmax.output_shape(in_shape))
         self.assertTupleEqual(argmax.output_shape(in_shape), in_shape[:1])
 
@@ -234,6 +263,8 @@ class TestConvolutionLayer(TestCase):
             (2,    5,  3,   3,  2, "full"),
             (2,    5,  5,   1,  1, "same"),
             (5,    8,  4,   1,  1, "same"),
+            (3,    5,  5,   2,  2, "same"),
+            (2,    4,  3,   3,  2, "same"),
         ]
         self.conv_layers = []
         for p in conv_nets_properties:
@@ -300,6 +331,13 @@ class TestConvolutionLayer(TestCase):
         self.assertTupleEqual(conv_out.shape, (1, 1, 12, 12))
         self.assertTupleEqual(conv.output_shape(input_shape), (1, 1, 12, 12))
 
+    def test_np_output(self):
+        for conv in self.conv_layers:
+            conv.fill_parameters()
+            x = self.gauss.fill(conv.input_shape)
+            assert_almost_equal(conv.np_output(x),
+                                conv.output(shared(x)).eval())
+
     def test_same_border_mode(self):
         conv = ConvLayer(
             name="conv#test",
@@ -318,6 +356,76 @@ class TestConvolutionLayer(TestCase):
         self.assertTupleEqual(conv_out.shape, (1, 20, 20, 20))
         self.assertTupleEqual(conv.output_shape(input_shape), (1, 20, 20, 20))
 
+    def test_same_border_mode_stride(self):
+        def same_conv(stride):
+            return ConvLayer(
+                name="conv#test",
+                num_feature_maps=4,
+                kernel_w=5,
+                kernel_h=5,
+                stride_h=stride,
+                stride_v=stride,
+                weight=Parameter(name="conv#test#weight"),
+                bias=Parameter(name="conv#test#bias"),
+                border_mode='same',
+                input_shape=(2, 3, 16, 16))
+
+        conv = same_conv(1)
+        conv.fill_parameters()
+        conv_stride = same_conv(2)
+        conv_stride.weight.tensor = conv.weight.tensor
+        conv_stride.bias.tensor = conv.bias.tensor
+        x = shared(self.gauss.fill(conv.input_shape))
+        out = conv.output(x).eval()
+        out_stride = conv_stride.output(x).eval()
+        self.assertTupleEqual(out_stride.shape, (2, 4, 8, 8))
+        self.assertTupleEqual(conv_stride.output_shape(conv.input_shape),
+                              (2, 4, 8, 8))
+        np.testing.assert_almost_equal(out_stride, out[:, :, ::2, ::2])
+
+    def test_grouped_conv(self):
+        input_shape = (2, 4, 11, 11)
+        for border_mode in ['valid', 'full', 'same']:
+            conv = ConvLayer(
+                name="conv#grouped",
+                num_feature_maps=6,
+                kernel_w=3,
+                kernel_h=5,
+                group=2,
+                border_mode=border_mode,
+                weight=Parameter(name="conv#grouped#weight"),
+                bias=Parameter(name="conv#grouped#bias"),
+                input_shape=input_shape)
+            conv.fill_parameters()
+            x = self.gauss.fill(input_shape)
+            conv_out = conv.output(shared(x)).eval()
+
+            # the result must be equal to convolving every group separately
+            group_outs = []
+            for i in range(2):
+                group_conv = ConvLayer(
+                    name="conv#group{}".format(i),
+                    num_feature_maps=3,
+                    kernel_w=3,
+                    kernel_h=5,
+                    border_mode=border_mode,
+                    weight=Parameter(name="conv#group#weight"),
+                    bias=Parameter(name="conv#group#bias"),
+                    input_shape=(2, 2, 11, 11))
+                group_conv.weight.tensor = conv.weight.tensor[3*i:3*(i+1)]
+                group_conv.bias.tensor = conv.bias.tensor[3*i:3*(i+1)]
+                group_outs.append(
+                    group_conv.output(shared(x[:, 2*i:2*(i+1)])).eval())
+            np.testing.assert_almost_equal(
+                conv_out, np.concatenate(group_outs, axis=1))
+            self.assertTupleEqual(conv_out.shape,
+                                  conv.output_shape(input_shape))
+
+    def test_grouped_conv_block_diagonal(self):
+        # the grouped convolution of Theano before 0.10
+        with mock.patch('bernet.layer.CONV2D_NUM_GROUPS', False):
+            self.test_grouped_conv()
+
     def test_output_shape_auto(self):
         input_shapes = [(3, 1, 16, 16),
                         (1, 3, 32, 32),
@@ -360,6 +468,7 @@ class TestActivationLayers(TestCase):
             dummy_data = np.random.sample(shape)
             out = layer.output(shared(dummy_data)).eval()
             assert_almost_equal(out, func(dummy_data))
+            assert_almost_equal(layer.np_output(dummy_data), out)
             self.assertTupleEqual(out.shape, layer.output_shape(shape))
             self.assertTupleEqual(layer.output_shape(shape), shape)
 
@@ -369,8 +478,10 @@ class TestSoftmaxLayer(TestCase):
         softmax = SoftmaxLayer(name="softmax")
         x = T.matrix('x')
         fn = theano.function([x], softmax.output(x))
-        out = fn(np.random.random((200, 200)))
+        x = np.random.random((200, 200))
+        out = fn(x)
         np.testing.assert_almost_equal(out.sum(axis=1), np.ones(200,))
+        np.testing.assert_almost_equal(softmax.np_output(x), out)
 
 
 class TestPoolingLayer(TestCase):
@@ -384,6 +495,67 @@ class TestPoolingLayer(TestCase):
             input = shared(np.random.sample(input_shape))
             out = layer.output(input)
 
+    def test_np_output(self):
+        input_shapes = [(1, 1, 5, 5), (3, 2, 16, 16), (1, 1, 91, 31)]
+        for poolsize, stride in [((2, 2), (2, 2)), ((3, 3), (2, 2)),
+                                 ((2, 3), (3, 1))]:
+            for ignore_border in [True, False]:
+                for mode in ["max", "average"]:
+                    layer = create_layer(PoolingLayer, poolsize=poolsize,
+                                         stride=stride, mode=mode,
+                                         ignore_border=ignore_border)
+                    for input_shape in input_shapes:
+                        input = np.random.sample(input_shape)
+                        out = layer.output(shared(input)).eval()
+                        assert_almost_equal(layer.np_output(input), out)
+                        self.assertTupleEqual(layer.output_shape(input_shape),
+                                              out.shape)
+
+    def test_average_ceil_mode(self):
+        layer = create_layer(PoolingLayer, poolsize=(2, 2), stride=(2, 2),
+                             mode="average")
+        input = np.arange(9.).reshape(1, 1, 3, 3)
+        expected = [[[[2., 3.5], [6.5, 8.]]]]
+        assert_almost_equal(layer.output(shared(input)).eval(), expected)
+        assert_almost_equal(layer.np_output(input), expected)
+
+    def test_pinned_theano_signature(self):
+        # theano 0.7's max_pool_2d has no `mode` argument
+        max_pool_2d = theano.tensor.signal.downsample.max_pool_2d
+
+        def pinned_max_pool_2d(input, ds, ignore_border=False, st=None,
+                               padding=(0, 0)):
+            return max_pool_2d(input=input, ds=ds, st=st,
+                               ignore_border=ignore_border)
+
+        input = np.random.sample((2, 3, 7, 5))
+        with mock.patch('theano.tensor.signal.downsample.max_pool_2d',
+                        pinned_max_pool_2d):
+            for mode in ["max", "average"]:
+                layer = create_layer(PoolingLayer, poolsize=(3, 3),
+                                     stride=(2, 2), mode=mode)
+                assert_almost_equal(layer.output(shared(input)).eval(),
+                                    layer.np_output(input))
+
+    def test_global_pooling(self):
+        input_shape = (2, 3, 7, 5)
+        input = np.random.sample(input_shape)
+        for mode, func in [("max", np.max), ("average", np.mean)]:
+            layer = create_layer(PoolingLayer, global_pooling=True,
+                                 mode=mode)
+            expected = func(input, axis=(2, 3)).reshape(2, 3, 1, 1)
+            assert_almost_equal(layer.output(shared(input)).eval(), expected)
+            assert_almost_equal(layer.np_output(input), expected)
+            self.assertTupleEqual(layer.output_shape(input_shape),
+                                  (2, 3, 1, 1))
+
+    def test_init(self):
+        self.assertRaises(ConfigError, create_layer, PoolingLayer)
+        layer = load(PoolingLayer, "{name: pool, mode: average, "
+                                   "global_pooling: yes}")
+        self.assertEqual(layer.mode, "average")
+        self.assertTrue(layer.global_pooling)
+
 
 class TestInnerProductLayer(TestCase):
     def test_inner_product_layer(self):
@@ -400,6 +572,55 @@ class TestInnerProductLayer(TestCase):
         np.testing.assert_almost_equal(
             layer.output(input).eval(),
             np_output)
+        np.testing.assert_almost_equal(layer.np_output(np_input), np_output)
+
+    def test_sparse_weight(self):
+        layer = InnerProductLayer(
+            name="innerprod", n_units=20, input_shape=(4, 300),
+            weight=Parameter(name="weight",
+                             filler=GaussianFiller(sparsity=0.95)),
+            bias=Parameter(name="bias"))
+        layer.fill_parameters()
+        self.assertTrue(layer.weight.is_sparse)
+        dense = layer.weight.value.toarray()
+        self.assertEqual(layer.weight.shared.get_value().size,
+                         np.count_nonzero(dense))
+
+        np_input = np.random.sample((4, 300)).astype(theano.config.floatX)
+        expected = np.dot(np_input, dense.T) + layer.bias.value
+        assert_almost_equal(layer.output(shared(np_input)).eval(), expected,
+                            decimal=5)
+        assert_almost_equal(layer.np_output(np_input), expected, decimal=5)
+
+        grad = T.grad(layer.output(shared(np_input)).sum(),
+                      layer.weight.shared).eval()
+        self.assertTupleEqual(grad.shape,
+                              layer.weight.shared.get_value().shape)
+
+    def test_sparse_weight_single_copy(self):
+        weight = Parameter(name="weight")
+        dense = np.random.sample((20, 300)) + 1
+        dense[np.random.sample((20, 300)) < 0.95] = 0
+        tensor = scipy.sparse.csr_matrix(dense)
+        weight.tensor = tensor
+        self.assertTrue(np.may_share_memory(
+            weight.value.data, weight.shared.get_value(borrow=True)))
+
+        trained = weight.shared.get_value() + 1
+        weight.shared.set_value(trained)
+        assert_almost_equal(weight.tensor.data, trained)
+        assert_almost_equal(weight.value.data, trained)
+        assert_almost_equal(weight.tensor.toarray(),
+                            tensor.toarray() + (tensor.toarray() != 0))
+
+    def test_dense_weight_below_threshold(self):
+        layer = InnerProductLayer(
+            name="innerprod", n_units=20, input_shape=(4, 300),
+            sparse_threshold=0.99,
+            weight=Parameter(name="weight",
+                             filler=GaussianFiller(sparsity=0.95)))
+        layer.fill_parameters()
+        self.assertFalse(layer.weight.is_sparse)
 
 
 class TestLRNLayer(TestCase):
@@ -431,6 +652,8 @@ class TestLRNLayer(TestCase):
         lrn = LRNLayer(name="lrn", n=n, alpha=alpha, k=k)
         out = lrn.output(test_shared)
         np.testing.assert_almost_equal(out.eval(), ground_truth_lrn(test_np))
+        np.testing.assert_almost_equal(lrn.np_output(test_np),
+                                       ground_truth_lrn(test_np))
 
     def test_output_shape(self):
         lrn = LRNLayer(name="lrn")
@@ -438,6 +661,65 @@ class TestLRNLayer(TestCase):
         self.assertEqual(lrn.output_shape(input_shape), input_shape)
 
 
+class TestStaticOutputShape(TestCase):
+    def test_static_equals_symbolic(self):
+        conv = ConvLayer(name="conv", num_feature_maps=4, kernel_h=3,
+                         kernel_w=3, stride_h=2, stride_v=2,
+                         border_mode="same",
+                         weight=Parameter(name="conv_weight"),
+                         bias=Parameter(name="conv_bias"),
+                         input_shape=(1, 3, 16, 16))
+        ip = InnerProductLayer(name="ip", n_units=10, input_shape=(1, 48))
+        for layer in [conv, ip]:
+            layer.fill_parameters()
+
+        layers_and_shapes = [
+            (conv, (1, 3, 16, 16)),
+            (ip, (2, 3, 4, 4)),
+            (create_layer(PoolingLayer, poolsize=(3, 3), stride=(2, 2)),
+             (2, 3, 13, 13)),
+            (create_layer(PoolingLayer, poolsize=(2, 2), stride=(2, 2),
+                          ignore_border=True), (2, 3, 13, 13)),
+            (create_layer(PoolingLayer, poolsize=(3, 3), stride=(2, 2),
+                          mode="average"), (2, 3, 13, 13)),
+            (create_layer(PoolingLayer, global_pooling=True), (2, 3, 5, 5)),
+            (create_layer(LRNLayer), (2, 8, 5, 5)),
+            (create_layer(SigmoidLayer), (2, 3, 4, 4)),
+            (create_layer(ReLULayer), (2, 3, 4, 4)),
+            (create_layer(TanHLayer), (2, 10)),
+            (create_layer(SoftmaxLayer), (2, 3, 4, 4)),
+            (create_layer(ArgMaxLayer), (2, 3, 4, 4)),
+            (create_layer(RGB2BGRLayer), (2, 3, 5, 5)),
+            (create_layer(CropLayer, width=4, height=3,
+                          input_shape=(2, 3, 5, 5)), (2, 3, 5, 5)),
+            (create_layer(SubtractMeanLayer, mean=1.), (2, 3, 5, 5)),
+        ]
+        for layer, input_shape in layers_and_shapes:
+            self.assertTupleEqual(layer.output_shape(input_shape),
+                                  layer.symbolic_output_shape(input_shape))
+
+    def test_macs(self):
+        conv = ConvLayer(name="conv", num_feature_maps=4, kernel_h=3,
+                         kernel_w=3, group=2,
+                         weight=Parameter(name="conv_weight"),
+                         bias=Parameter(name="conv_bias"),
+                         input_shape=(1, 6, 8, 8))
+        ip = InnerProductLayer(name="ip", n_units=10, input_shape=(1, 48))
+        layers_and_macs = [
+            (conv, (2, 6, 8, 8), 2*4*6*6 * 3*3*3),
+            (ip, (2, 3, 4, 4), 2*10*48),
+            (create_layer(PoolingLayer, poolsize=(2, 2), stride=(2, 2)),
+             (2, 3, 4, 4), 2*3*2*2 * 2*2),
+            (create_layer(PoolingLayer, global_pooling=True), (2, 3, 5, 5),
+             2*3*5*5),
+            (create_layer(LRNLayer, n=5), (2, 8, 5, 5), 2*8*5*5 * 7),
+            (create_layer(ReLULayer), (2, 3, 4, 4), 2*3*4*4),
+            (create_layer(RGB2BGRLayer), (2, 3, 5, 5), 0),
+        ]
+        for layer, input_shape, macs in layers_and_macs:
+            self.assertEqual(layer.macs(input_shape), macs)
+
+
 class TestCONNECTIONS(ConfigFieldTestCase):
     def test_parse_layer(self):
         con_parse = CONNECTIONS()
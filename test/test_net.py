@@ -12,19 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import shutil
 import tempfile
 
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import numpy as np
+import scipy.sparse
 import theano
 import theano.tensor as T
 from theano import shared
 
-from bernet.net import FeedForwardNet
+from bernet.cache import FunctionCache
+from bernet.net import FeedForwardNet, GraphNet
 from bernet.layer import ConvLayer, SoftmaxLayer, TanHLayer, \
-    InnerProductLayer, Parameter
+    InnerProductLayer, Parameter, PoolingLayer, ArgMaxLayer, Layer, \
+    SubtractMeanLayer
 from bernet.config import load, ConfigError
+from bernet.optimization import Rprop
 from bernet.utils import size, sha256_of_file
 
 
@@ -69,6 +74,108 @@ class TestFeedForwardNet(TestCase):
         outs = net.forward(np.random.sample(input_shape))
         self.assertEqual(size(outs.shape), size(input_shape))
 
+    def test_forward_numpy_engine(self):
+        input = np.random.sample((1, 3, 16, 16))
+        for net in self.networks:
+            np.testing.assert_almost_equal(
+                net.forward(input, engine="numpy"),
+                net.forward(input))
+        self.assertRaises(ValueError, self.one_layer_net.forward, input,
+                          engine="foo")
+
+    def test_fuse_layers(self):
+        net = self.innerprod_net
+        input = np.random.sample((1, 3, 16, 16))
+        x = T.tensor4('x')
+        unfused = theano.function([x], list(net.layer_outputs(x).values()))
+        expected = net.forward(input)
+        expected_np = net.forward(input, engine="numpy")
+
+        self.assertDictEqual(net.fuse_layers(),
+                             {"tanh#1": "ip#1", "softmax#1": "ip#2"})
+        self.assertTrue(net.fuse_activations)
+        np.testing.assert_almost_equal(net.forward(input), expected)
+        np.testing.assert_almost_equal(net.forward(input, engine="numpy"),
+                                       expected_np)
+
+        outputs = net.layer_outputs(x, fused_outputs=True)
+        self.assertListEqual(list(outputs.keys()),
+                             ["ip#1", "tanh#1", "ip#2", "softmax#1"])
+        fused = theano.function([x], list(outputs.values()))
+        for got, exp in zip(fused(input), unfused(input)):
+            np.testing.assert_almost_equal(got, exp)
+
+    def test_fuse_activations_field(self):
+        net = FeedForwardNet(
+            name="conv_net", input_shape=(1, 3, 8, 8), fuse_activations=True,
+            layers=[
+                ConvLayer(name="conv", num_feature_maps=4, kernel_h=3,
+                          kernel_w=3, weight=Parameter(name="w"),
+                          bias=Parameter(name="b"),
+                          input_shape=(1, 3, 8, 8)),
+                TanHLayer(name="tanh", source="conv"),
+                SoftmaxLayer(name="softmax", source="tanh"),
+            ])
+        self.assertDictEqual(net.fused, {"tanh": "conv"})
+        self.assertIs(net.get_layer("conv").activation,
+                      net.get_layer("tanh"))
+
+    def test_float32_policy(self):
+        floatX = theano.config.floatX
+        theano.config.floatX = 'float32'
+        try:
+            net = FeedForwardNet(
+                name="float32_net", input_shape=(1, 3, 8, 8),
+                layers=[
+                    ConvLayer(name="conv", num_feature_maps=4, kernel_h=3,
+                              kernel_w=3, weight=Parameter(name="w"),
+                              bias=Parameter(name="b"),
+                              input_shape=(1, 3, 8, 8)),
+                    TanHLayer(name="tanh", source="conv"),
+                    InnerProductLayer(name="ip", n_units=10, source="tanh",
+                                      input_shape=(1, 144)),
+                    SoftmaxLayer(name="softmax", source="ip"),
+                ])
+            for p in net.parameters():
+                self.assertEqual(p.shared.dtype, 'float32')
+            self.assertListEqual(net.float64_variables(), [])
+            input = np.random.sample((1, 3, 8, 8)).astype('float32')
+            self.assertEqual(net.forward(input).dtype, 'float32')
+            self.assertEqual(net.forward(input, engine="numpy").dtype,
+                             'float32')
+        finally:
+            theano.config.floatX = floatX
+
+    def test_predict_iter(self):
+        net = self.innerprod_net
+        input = np.random.sample((5, 3, 16, 16))
+        expected = np.concatenate([net.forward(input[i:i+1])
+                                   for i in range(5)])
+        outs = list(net.predict_iter(input, batch_size=2))
+        self.assertListEqual([len(o) for o in outs], [2, 2, 1])
+        np.testing.assert_almost_equal(np.concatenate(outs), expected)
+
+        outs = list(net.predict_iter(iter(input), batch_size=2))
+        np.testing.assert_almost_equal(np.concatenate(outs), expected)
+
+    def test_predict_batches(self):
+        net = self.innerprod_net
+        input = np.random.sample((5, 3, 16, 16))
+        expected = np.concatenate([net.forward(input[i:i+1])
+                                   for i in range(5)])
+        np.testing.assert_almost_equal(net.predict_batches(input),
+                                       expected)
+        out = np.zeros((5, 10))
+        ret = net.predict_batches(input, out=out, batch_size=3)
+        self.assertIs(ret, out)
+        np.testing.assert_almost_equal(out, expected)
+        np.testing.assert_almost_equal(
+            net.predict_batches(iter(input), batch_size=4), expected)
+        for empty in [input[:0], iter([])]:
+            out = net.predict_batches(empty)
+            self.assertTupleEqual(out.shape, (0, 10))
+            self.assertEqual(out.dtype, expected.dtype)
+
     def test_minibatch_func(self):
         net = self.one_layer_net
         epoch_shape = (32,) + net.input_shape[1:]
@@ -89,6 +196,102 @@ class TestFeedForwardNet(TestCase):
         forward(2, 4)
         self.assertEqual(g.eval(), 8)
 
+    def test_forward_function_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            input = np.random.sample((1, 3, 16, 16))
+            net = self.innerprod_net
+            net.function_cache = FunctionCache(cache_dir)
+            out = net.forward(input)
+            self.assertEqual(net.function_cache.misses, 1)
+
+            net.__dict__.pop('_forward_func')
+            net.function_cache = FunctionCache(cache_dir)
+            np.testing.assert_almost_equal(net.forward(input), out)
+            self.assertEqual(net.function_cache.hits, 1)
+            self.assertEqual(net.function_cache.misses, 0)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_function_cache_sparse_structure(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        input = np.random.sample((1, 3, 16, 16))
+        net = self.innerprod_net
+        weight = net.get_layer("ip#2").weight
+        dense = np.random.sample((10, 256))
+        for keep in [np.arange(256) % 2 == 0, np.arange(256) % 2 == 1]:
+            # the same number of nonzero entries at other positions
+            weight.tensor = scipy.sparse.csr_matrix(dense * keep)
+            net.__dict__.pop('_forward_func', None)
+            net.function_cache = FunctionCache(cache_dir)
+            np.testing.assert_almost_equal(net.forward(input),
+                                           net.forward(input, "numpy"))
+            self.assertEqual(net.function_cache.misses, 1)
+
+    def test_function_cache_mean_file(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        mean_file = os.path.join(cache_dir, "mean.npy")
+        input = np.zeros((1, 3, 4))
+        for mean in [1., 2.]:
+            # the mean file changes in place
+            np.save(mean_file, np.full((3, 4), mean))
+            net = FeedForwardNet(
+                name="mean_net", input_shape=(1, 3, 4),
+                layers=[SubtractMeanLayer(name="mean", mean_file=mean_file)])
+            net.function_cache = FunctionCache(cache_dir)
+            np.testing.assert_almost_equal(net.forward(input), -mean)
+            self.assertEqual(net.function_cache.misses, 1)
+
+    def test_extract(self):
+        net = self.innerprod_net
+        input = np.random.sample((10, 3, 16, 16))
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        features = net.extract(["ip#1", "tanh#1"], input, out_dir=out_dir,
+                               batch_size=4)
+        self.assertListEqual(list(features.keys()), ["ip#1", "tanh#1"])
+
+        ip = net.get_layer("ip#1").np_output(input)
+        saved = np.load(os.path.join(out_dir, "ip#1.npy"), mmap_mode='r')
+        self.assertTupleEqual(saved.shape, (10, 256))
+        np.testing.assert_almost_equal(saved, ip)
+        np.testing.assert_almost_equal(features["tanh#1"], np.tanh(ip))
+
+        net.fuse_layers()
+        features = net.extract(["ip#1", "tanh#1"], input, batch_size=4)
+        np.testing.assert_almost_equal(features["ip#1"], ip)
+        np.testing.assert_almost_equal(features["tanh#1"], np.tanh(ip))
+
+    def test_any_batch_size(self):
+        net = FeedForwardNet(
+            name="conv_net", input_shape=(10, 2, 6, 6),
+            layers=[
+                ConvLayer(name="conv", num_feature_maps=4, kernel_h=3,
+                          kernel_w=3, group=2, input_shape=(10, 2, 6, 6),
+                          weight=Parameter(name="conv_w"),
+                          bias=Parameter(name="conv_b")),
+                TanHLayer(name="tanh", source="conv"),
+                InnerProductLayer(name="ip", source="tanh", n_units=3,
+                                  input_shape=(10, 4*4*4)),
+            ])
+        for batch_size in [1, 3, 12]:
+            input = np.random.sample((batch_size, 2, 6, 6))
+            out = net.forward(input)
+            self.assertTupleEqual(out.shape, (batch_size, 3))
+            np.testing.assert_almost_equal(
+                out, net.forward(input, engine="numpy"))
+            if batch_size == 1:
+                forward_func = net._forward_func
+            self.assertIs(net._forward_func, forward_func)
+
+        input = np.random.sample((7, 2, 6, 6))
+        np.testing.assert_almost_equal(
+            net.predict_batches(input, batch_size=4),
+            net.forward(input, engine="numpy"))
+        self.assertEqual(len(net._predict_funcs), 1)
+
     def test_get_layer(self):
         net = self.innerprod_net
         self.assertEqual(net.get_layer("ip#1").name, "ip#1")
@@ -101,6 +304,16 @@ class TestFeedForwardNet(TestCase):
         self.assertEqual(net.get_parameter("ip#2_weight").name, "ip#2_weight")
         self.assertRaises(KeyError, net.get_parameter, 'does not exist')
 
+    def test_parameters(self):
+        net = self.innerprod_net
+        self.assertIs(net.parameters(), net.parameters())
+        self.assertListEqual(
+            [p.name for p in net.parameters()],
+            [p.name for l in net.layers if hasattr(l, 'parameters')
+             for p in l.parameters])
+        self.assertListEqual(net.parameters_as_shared(),
+                             [p.shared for p in net.parameters()])
+
     def test_constructor(self):
         self.assertEqual(type(self.one_layer_net), FeedForwardNet)
         self.assertEqual(type(self.two_layer_net), FeedForwardNet)
@@ -120,18 +333,24 @@ class TestFeedForwardNet(TestCase):
         self.assert_(not net.is_connected("softmax#1", "ip#2"))
 
     def test_shape_info(self):
-        info = self.innerprod_net.shape_info()
+        info = self.innerprod_net.shape_info(dtype='float32')
         self.assertDictEqual(info['ip#1'], {
             'input_shape': (1, 3, 16, 16),
             'output_shape': (1, 256),
             'params': {
                 'ip#1_weight': (256, 768)
-            }
+            },
+            'macs': 256*768,
+            'activation_bytes': 256*4,
+            'parameter_bytes': 256*768*4,
+            'optimizer_state_bytes': 0,
         })
 
         self.assertDictEqual(info['tanh#1'], {
             'input_shape': (1, 256),
-            'output_shape': (1, 256)
+            'output_shape': (1, 256),
+            'macs': 256,
+            'activation_bytes': 256*4,
         })
 
         self.assertDictEqual(info['ip#2'], {
@@ -139,9 +358,97 @@ class TestFeedForwardNet(TestCase):
             'output_shape': (1, 10),
             'params': {
                 'ip#2_weight': (10, 256)
-            }
+            },
+            'macs': 10*256,
+            'activation_bytes': 10*4,
+            'parameter_bytes': 10*256*4,
+            'optimizer_state_bytes': 0,
+        })
+
+        info = self.innerprod_net.shape_info(batch_size=8, dtype='float64',
+                                             optimizer=Rprop())
+        self.assertTupleEqual(info['ip#2']['output_shape'], (8, 10))
+        self.assertEqual(info['ip#2']['macs'], 8*10*256)
+        self.assertEqual(info['ip#2']['activation_bytes'], 8*10*8)
+        self.assertEqual(info['ip#2']['optimizer_state_bytes'],
+                         2*10*256*8)
+
+    def test_cost_summary(self):
+        net = self.innerprod_net
+        summary = net.cost_summary(batch_size=4, dtype='float32',
+                                   optimizer=Rprop())
+        param_bytes = (256*768 + 10*256) * 4
+        input_bytes = 4*768*4
+        self.assertDictEqual(summary, {
+            'macs': 4*(256*768 + 256 + 10*256 + 10),
+            'activation_bytes': 4*(256 + 256 + 10 + 10)*4,
+            'parameter_bytes': param_bytes,
+            'optimizer_state_bytes': 2*param_bytes,
+            # the input and the output of ip#1
+            'peak_activation_bytes': input_bytes + 4*256*4,
+            'inference_bytes': param_bytes + input_bytes + 4*256*4,
+            'training_macs': 3*4*(256*768 + 256 + 10*256 + 10),
+            'training_bytes': input_bytes + 4*(256 + 256 + 10 + 10)*4 +
+            4*param_bytes,
         })
 
+        net.fuse_layers()
+        summary = net.cost_summary(batch_size=4, dtype='float32')
+        self.assertEqual(summary['activation_bytes'], 4*(256 + 10)*4)
+        self.assertEqual(summary['peak_activation_bytes'],
+                         input_bytes + 4*256*4)
+
+    def test_seeded_lazy_init(self):
+        def create(**kwargs):
+            return FeedForwardNet(
+                name="net", input_shape=(1, 3, 4, 4),
+                layers=[InnerProductLayer(name="ip#1", n_units=8,
+                                          input_shape=(1, 48)),
+                        InnerProductLayer(name="ip#2", n_units=8,
+                                          source="ip#1",
+                                          input_shape=(1, 8))],
+                **kwargs)
+
+        eager = create(seed=1)
+        lazy = create(seed=1, lazy_init=True)
+        self.assertTrue(all(p.is_deferred for p in lazy.parameters()))
+        lazy.forward(np.random.sample((2, 3, 4, 4)))
+        self.assertFalse(any(p.is_deferred for p in lazy.parameters()))
+        for name in ["ip#1_weight", "ip#2_weight"]:
+            np.testing.assert_array_equal(eager.get_parameter(name).value,
+                                          lazy.get_parameter(name).value)
+        # every parameter has its own stream
+        self.assertFalse(np.array_equal(
+            eager.get_parameter("ip#1_weight").value[:, :8],
+            eager.get_parameter("ip#2_weight").value))
+        self.assertFalse(np.array_equal(
+            eager.get_parameter("ip#1_weight").value,
+            create(seed=2).get_parameter("ip#1_weight").value))
+
+    def test_infer_shapes(self):
+        shapes = self.innerprod_net.infer_shapes((8, 3, 16, 16))
+        self.assertListEqual(list(shapes.keys()),
+                             ["ip#1", "tanh#1", "ip#2", "softmax#1"])
+        self.assertTupleEqual(shapes['ip#1'], ((8, 3, 16, 16), (8, 256)))
+        self.assertTupleEqual(shapes['softmax#1'], ((8, 10), (8, 10)))
+
+    def test_construction_does_not_compile(self):
+        with mock.patch.object(Layer, 'symbolic_output_shape',
+                               side_effect=AssertionError("compiled")):
+            net = FeedForwardNet(
+                name="conv_net", input_shape=(1, 3, 16, 16),
+                layers=[
+                    ConvLayer(name="conv", num_feature_maps=4, kernel_h=3,
+                              kernel_w=3, weight=Parameter(name="w"),
+                              bias=Parameter(name="b"),
+                              input_shape=(1, 3, 16, 16)),
+                    PoolingLayer(name="pool", source="conv",
+                                 poolsize=(2, 2), stride=(2, 2)),
+                    ArgMaxLayer(name="argmax", source="pool"),
+                ])
+            self.assertTupleEqual(net.shape_info()['argmax']['output_shape'],
+                                  (1,))
+
     def test_raise_error_on_shape_mismatch(self):
         self.assertRaisesRegex(
             ConfigError, "Shape mismatch", FeedForwardNet,
@@ -167,7 +474,10 @@ class TestFeedForwardNet(TestCase):
                           data_url="url")
 
     def test_sha256sum_mismatch_raises_error(self):
-        with tempfile.NamedTemporaryFile("w+b") as f:
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        with tempfile.NamedTemporaryFile("w+b") as f, \
+                mock.patch.object(FeedForwardNet, 'MODELS_DIR', models_dir):
             random = np.random.sample((20, 20))
             np.savez(f, rand=random)
             f.seek(0)
@@ -186,7 +496,10 @@ class TestFeedForwardNet(TestCase):
         # generate data and save it to a npz file
         params_data = {p: np.random.sample(shape)
                        for p, shape in params.items()}
-        with tempfile.NamedTemporaryFile("w+b") as f:
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        with tempfile.NamedTemporaryFile("w+b") as f, \
+                mock.patch.object(FeedForwardNet, 'MODELS_DIR', models_dir):
             np.savez_compressed(f, **params_data)
             f.flush()
             sha256sum = sha256_of_file(f)
@@ -229,3 +542,136 @@ class TestFeedForwardNet(TestCase):
             for param_name, data in params_data.items():
                 param = net.get_parameter(param_name)
                 self.assert_(np.all(param.tensor == data))
+
+    def test_parameter_cache(self):
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        weight = np.random.sample((5, 4))
+
+        def net():
+            return FeedForwardNet(
+                name="net_test_cache", input_shape=(1, 4),
+                layers=[InnerProductLayer(
+                    name='ip', n_units=5, input_shape=(1, 4),
+                    weight=Parameter(name='ip_weight'))],
+                data_url='file://' + f.name, data_sha256=sha256sum)
+
+        with tempfile.NamedTemporaryFile("w+b") as f, \
+                mock.patch.object(FeedForwardNet, 'MODELS_DIR', models_dir):
+            np.savez_compressed(f, ip_weight=weight)
+            f.flush()
+            sha256sum = sha256_of_file(f)
+            param = net().get_parameter('ip_weight')
+            self.assertIsInstance(param.tensor, np.memmap)
+            self.assertTrue(np.may_share_memory(param.value, param.tensor))
+            np.testing.assert_almost_equal(param.value, weight)
+
+            with mock.patch('bernet.utils.download') as download:
+                net()
+                self.assertFalse(download.called)
+                shutil.rmtree(os.path.join(
+                    models_dir, sha256sum + "_" + theano.config.floatX))
+                np.testing.assert_almost_equal(
+                    net().get_parameter('ip_weight').value, weight)
+                self.assertFalse(download.called)
+
+
+class TestGraphNet(TestCase):
+    def net(self, **kwargs):
+        return GraphNet(
+            name="two_heads", input_shape=(4, 10),
+            layers=[
+                InnerProductLayer(name="trunk", n_units=8,
+                                  input_shape=(4, 10)),
+                TanHLayer(name="tanh", source="trunk"),
+                InnerProductLayer(name="ip_a", source="tanh", n_units=3,
+                                  input_shape=(4, 8)),
+                SoftmaxLayer(name="softmax_a", source="ip_a"),
+                InnerProductLayer(name="ip_b", source="tanh", n_units=5,
+                                  input_shape=(4, 8)),
+                SoftmaxLayer(name="softmax_b", source="ip_b"),
+            ], **kwargs)
+
+    def test_outputs(self):
+        net = self.net()
+        self.assertListEqual(net.output_names(), ["softmax_a", "softmax_b"])
+        self.assertEqual(net.output_layer.name, "softmax_a")
+        layer_names = [l.name for l in net.layer_iter()]
+        self.assertEqual(layer_names[:2], ["trunk", "tanh"])
+        self.assertLess(layer_names.index("ip_a"),
+                        layer_names.index("softmax_a"))
+
+        input = np.random.sample((4, 10))
+        trunk = net.get_layer("trunk")
+        with mock.patch.object(trunk, 'np_output',
+                               wraps=trunk.np_output) as trunk_output:
+            np_out = net.forward(input, engine="numpy")
+            self.assertEqual(trunk_output.call_count, 1)
+        self.assertListEqual(list(np_out.keys()), ["softmax_a", "softmax_b"])
+        self.assertTupleEqual(np_out["softmax_a"].shape, (4, 3))
+        self.assertTupleEqual(np_out["softmax_b"].shape, (4, 5))
+
+        hidden = np.tanh(trunk.np_output(input))
+        np.testing.assert_almost_equal(
+            np_out["softmax_b"],
+            net.get_layer("softmax_b").np_output(
+                net.get_layer("ip_b").np_output(hidden)))
+
+        out = net.forward(input)
+        for name in net.output_names():
+            np.testing.assert_almost_equal(out[name], np_out[name])
+
+        predicted = net.predict_batches(np.random.sample((10, 10)))
+        self.assertTupleEqual(predicted["softmax_b"].shape, (10, 5))
+        predicted = net.predict_batches(iter([]))
+        self.assertListEqual(list(predicted.keys()), net.output_names())
+        self.assertTupleEqual(predicted["softmax_b"].shape, (0, 5))
+
+    def test_explicit_outputs(self):
+        net = self.net(outputs=["tanh", "softmax_b"])
+        out = net.forward(np.random.sample((4, 10)), engine="numpy")
+        self.assertListEqual(list(out.keys()), ["tanh", "softmax_b"])
+        self.assertRaises(ConfigError, self.net, outputs=["unknown"])
+
+    def test_fuse_layers_keeps_branches(self):
+        net = self.net(fuse_activations=True)
+        self.assertListEqual(list(net.fused.keys()),
+                             ["tanh", "softmax_a", "softmax_b"])
+        input = np.random.sample((4, 10))
+        out = net.forward(input, engine="numpy")
+        self.assertAlmostEqual(float(out["softmax_a"].sum()), 4.)
+
+        net = GraphNet(
+            name="branch", input_shape=(4, 10), fuse_activations=True,
+            layers=[InnerProductLayer(name="ip", n_units=3,
+                                      input_shape=(4, 10)),
+                    TanHLayer(name="tanh", source="ip"),
+                    SoftmaxLayer(name="softmax", source="ip")])
+        self.assertDictEqual(net.fused, {})
+
+    def test_cycle(self):
+        self.assertRaises(
+            ConfigError, GraphNet, name="cycle", input_shape=(1, 4),
+            layers=[TanHLayer(name="a"),
+                    TanHLayer(name="b", source="c"),
+                    TanHLayer(name="c", source="b")])
+
+    def test_unreachable_layers(self):
+        with self.assertRaisesRegex(ConfigError, "^The layers b, c form a "
+                                                 "cycle. The layers d are "
+                                                 "not connected to the "
+                                                 "input layer `a`.$"):
+            GraphNet(name="cycle", input_shape=(1, 4),
+                     layers=[TanHLayer(name="a"),
+                             TanHLayer(name="e", source="a"),
+                             TanHLayer(name="b", source="c"),
+                             TanHLayer(name="c", source="b"),
+                             TanHLayer(name="d", source="b")])
+
+    def test_feed_forward_net_has_one_output(self):
+        self.assertRaises(
+            AssertionError, FeedForwardNet, name="branch",
+            input_shape=(1, 4),
+            layers=[TanHLayer(name="a"),
+                    TanHLayer(name="b", source="a"),
+                    TanHLayer(name="c", source="a")])
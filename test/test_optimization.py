@@ -11,13 +11,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 import random
+import shutil
+import tempfile
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
+import numpy as np
 import theano
 import theano.tensor as T
 
+from bernet.checkpoint import CheckpointWriter, load_checkpoint
 from bernet.dataset import LineDataset
 from bernet.optimization import Rprop, SupervisedTrainer
 
@@ -63,6 +68,7 @@ class TestSupervisedTrainer(TestCase):
         expected_c = 3
 
         network = MagicMock()
+        network.batch_size = 64
         network.parameters_as_shared.return_value = [m, c]
         network.output = lambda x: T.reshape(m*x + c, (-1,))
         network.get_loss = lambda o, y: T.sum(T.sqr(o - y)**2)
@@ -73,3 +79,65 @@ class TestSupervisedTrainer(TestCase):
         trainer.train(network, dataset)
         self.assertAlmostEqual(m.get_value(), expected_m, places=1)
         self.assertAlmostEqual(c.get_value(), expected_c, places=1)
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "checkpoint.npz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_writer(self):
+        writer = CheckpointWriter(self.path)
+        for i in range(5):
+            writer.write({'i': np.asarray(i), 'x': np.arange(i)})
+        writer.close()
+        checkpoint = load_checkpoint(self.path)
+        self.assertEqual(int(checkpoint['i']), 4)
+        np.testing.assert_array_equal(checkpoint['x'], np.arange(4))
+        self.assertGreaterEqual(writer.n_written, 1)
+        self.assertListEqual(os.listdir(self.tmp_dir), ["checkpoint.npz"])
+
+    def test_writer_error(self):
+        writer = CheckpointWriter(os.path.join(self.path, "not_a_dir.npz"))
+        open(self.path, "w").close()
+        writer.write({'i': np.asarray(0)})
+        self.assertRaises(OSError, writer.close)
+
+    def _train(self, m, c, **kwargs):
+        network = MagicMock()
+        network.batch_size = 64
+        network.parameters_as_shared.return_value = [m, c]
+        network.output = lambda x: T.reshape(m*x + c, (-1,))
+        network.get_loss = lambda o, y: T.sum(T.sqr(o - y)**2)
+        network.get_accuracy = lambda o, y: T.sum(T.eq(o, y))
+        resume = kwargs.pop('resume', False)
+        trainer = SupervisedTrainer(patience=100, **kwargs)
+        trainer.train(network, LineDataset(shape=(300, 1), m=5, c=3),
+                      resume=resume)
+
+    def test_resume_bit_exact(self):
+        m = theano.shared(0.1, 'm')
+        c = theano.shared(0.1, 'c')
+        np.random.seed(0)
+        self._train(m, c, max_epochs=5)
+        expected = m.get_value(), c.get_value()
+
+        m.set_value(0.1)
+        c.set_value(0.1)
+        np.random.seed(0)
+        self._train(m, c, max_epochs=2, checkpoint_file=self.path)
+        self.assertEqual(int(load_checkpoint(self.path)['epoch']), 3)
+        self.assertNotEqual(m.get_value(), expected[0])
+
+        # a new process starts with other values
+        m.set_value(-1.)
+        c.set_value(-1.)
+        np.random.seed(1)
+        self._train(m, c, max_epochs=5, checkpoint_file=self.path,
+                    resume=True)
+        self.assertEqual(m.get_value(), expected[0])
+        self.assertEqual(c.get_value(), expected[1])
+        self.assertEqual(int(load_checkpoint(self.path)['epoch']), 6)
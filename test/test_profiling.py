@@ -0,0 +1,64 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import TestCase
+
+import numpy as np
+
+from bernet.layer import InnerProductLayer, TanHLayer, SoftmaxLayer
+from bernet.net import FeedForwardNet
+from bernet.profiling import format_profile
+
+
+class TestProfile(TestCase):
+    def setUp(self):
+        self.net = FeedForwardNet(
+            name="innerprod_net", input_shape=(1, 3, 16, 16),
+            layers=[
+                InnerProductLayer(name="ip#1", n_units=256,
+                                  input_shape=(1, 3*16*16)),
+                TanHLayer(name="tanh#1", source="ip#1"),
+                InnerProductLayer(name="ip#2", n_units=10, source="tanh#1",
+                                  input_shape=(1, 256)),
+                SoftmaxLayer(name="softmax#1", source="ip#2"),
+            ])
+        self.input = np.random.sample((8, 3, 16, 16))
+
+    def test_forward(self):
+        profile = self.net.profile(self.input, n_runs=2)
+        self.assertListEqual(list(profile.keys()),
+                             ["ip#1", "tanh#1", "ip#2", "softmax#1"])
+        info = profile["ip#1"]
+        self.assertEqual(info['input_shape'], (8, 3, 16, 16))
+        self.assertEqual(info['output_shape'], (8, 256))
+        self.assertEqual(info['forward']['flops'], 2 * 8 * 256 * 768)
+        self.assertGreaterEqual(info['forward']['output_bytes'],
+                                8 * 256 * self.input.dtype.itemsize // 2)
+        self.assertGreater(info['forward']['seconds'], 0)
+        self.assertAlmostEqual(sum(info['forward']['ops'].values()),
+                               info['forward']['seconds'])
+        self.assertNotIn('backward', info)
+        self.assertEqual(profile["softmax#1"]['output_shape'], (8, 10))
+
+    def test_backward_and_fused(self):
+        self.net.fuse_layers()
+        profile = self.net.profile(self.input, backward=True, n_runs=1)
+        self.assertEqual(profile["tanh#1"]['fused_into'], "ip#1")
+        self.assertEqual(profile["softmax#1"]['fused_into'], "ip#2")
+        self.assertIn('backward', profile["ip#1"])
+        # the gradient of the weights and of the input are matrix products
+        self.assertGreaterEqual(profile["ip#2"]['backward']['flops'],
+                                2 * 2 * 8 * 256 * 10)
+        table = format_profile(profile)
+        self.assertIn("fused into ip#1", table)
+        self.assertEqual(len(table.splitlines()), 1 + 2 + 2 * 2)
@@ -0,0 +1,130 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from bernet.dataset import Epoche
+from bernet.layer import ConvLayer, ReLULayer, InnerProductLayer, \
+    SoftmaxLayer, Parameter, PoolingLayer, GaussianFiller
+from bernet.conv import grouped_conv2d
+from bernet.net import FeedForwardNet, GraphNet
+from bernet.quantization import Quantization, int_matmul, \
+    int_grouped_conv2d, quantize, accuracy_report, format_accuracy_report
+
+
+class TestQuantization(TestCase):
+    def setUp(self):
+        filler = GaussianFiller(std=0.1)
+        self.net = FeedForwardNet(
+            name="quant_net", input_shape=(4, 3, 8, 8), fuse_activations=True,
+            layers=[
+                ConvLayer(name="conv", num_feature_maps=6, kernel_h=3,
+                          kernel_w=3, border_mode="same", group=3,
+                          weight=Parameter(name="conv_w", filler=filler),
+                          bias=Parameter(name="conv_b", filler=filler),
+                          input_shape=(4, 3, 8, 8)),
+                ReLULayer(name="relu", source="conv"),
+                PoolingLayer(name="pool", source="relu", poolsize=(2, 2),
+                             stride=(2, 2)),
+                InnerProductLayer(name="ip", source="pool", n_units=10,
+                                  weight=Parameter(name="ip_w",
+                                                   filler=filler),
+                                  input_shape=(4, 96)),
+                SoftmaxLayer(name="softmax", source="ip"),
+            ])
+        data = np.random.sample((10, 3, 8, 8))
+        self.epoche = Epoche(data, labels=np.random.randint(0, 10, 10))
+
+    def test_int_matmul(self):
+        a = np.random.randint(-127, 128, (5, 3000)).astype(np.int8)
+        b = np.random.randint(-127, 128, (3000, 7)).astype(np.int8)
+        expected = np.dot(a.astype(np.int64), b.astype(np.int64))
+        out = int_matmul(a, b)
+        self.assertEqual(out.dtype, np.int32)
+        np.testing.assert_equal(out, expected)
+
+    def test_int_grouped_conv2d(self):
+        # 2 * 200 * 3 * 3 products per output exceed a single float32 chunk
+        x = np.random.randint(-127, 128, (2, 400, 5, 5)).astype(np.int8)
+        w = np.random.randint(-127, 128, (4, 200, 3, 3)).astype(np.int8)
+        padding = ((1, 1), (1, 1))
+        expected = grouped_conv2d(x.astype(np.int64), w.astype(np.int64),
+                                  2, (1, 1), padding)
+        out = int_grouped_conv2d(x, w, 2, (1, 1), padding)
+        self.assertEqual(out.dtype, np.int32)
+        np.testing.assert_equal(out, expected)
+
+    def test_quantize(self):
+        q = quantize(np.array([-2., -0.01, 0.5, 1., 3.]), 1. / 127)
+        self.assertEqual(q.dtype, np.int8)
+        np.testing.assert_equal(q, [-127, -1, 64, 127, 127])
+
+    def test_calibrate(self):
+        quant = Quantization.calibrate(self.net, self.epoche)
+        self.assertSetEqual(set(quant.weights.keys()), {"conv", "ip"})
+        self.assertEqual(quant.weights["conv"].dtype, np.int8)
+        self.assertTupleEqual(quant.weight_scales["conv"].shape, (6,))
+        self.assertTupleEqual(quant.weight_scales["ip"].shape, (10,))
+        self.assertAlmostEqual(float(quant.input_scales["conv"]),
+                               self.epoche.data().max() / 127, places=5)
+
+    def test_int8_engine(self):
+        input = self.epoche.data()[:4]
+        self.assertRaises(ValueError, self.net.forward, input, engine="int8")
+        self.net.quantization = Quantization.calibrate(self.net, self.epoche)
+        float_out = self.net.forward(input, engine="numpy")
+        int8_out = self.net.forward(input, engine="int8")
+        np.testing.assert_allclose(int8_out, float_out, atol=0.02)
+
+    def test_save_load(self):
+        quant = Quantization.calibrate(self.net, self.epoche)
+        with tempfile.TemporaryFile() as f:
+            quant.save(f)
+            f.seek(0)
+            loaded = Quantization.load(f)
+        for attr in ['weights', 'weight_scales', 'input_scales', 'biases']:
+            self.assertSetEqual(set(getattr(loaded, attr).keys()),
+                                set(getattr(quant, attr).keys()))
+            for name, value in getattr(quant, attr).items():
+                np.testing.assert_equal(getattr(loaded, attr)[name], value)
+
+    def test_accuracy_report(self):
+        quant = Quantization.calibrate(self.net, self.epoche)
+        report = accuracy_report(self.net, quant, self.epoche)
+        for key in ['agreement', 'max_abs_diff', 'float_bytes',
+                    'int8_bytes', 'float_accuracy', 'int8_accuracy']:
+            self.assertIn(key, report)
+        self.assertGreater(report['agreement'], 0.5)
+        self.assertLess(report['int8_bytes'], report['float_bytes'])
+        self.assertIn("agreement", format_accuracy_report(report))
+
+    def test_accuracy_report_graph_net(self):
+        net = GraphNet(
+            name="two_heads", input_shape=(4, 3, 8, 8),
+            layers=[
+                InnerProductLayer(name="trunk", n_units=16,
+                                  input_shape=(4, 192)),
+                InnerProductLayer(name="ip_a", source="trunk", n_units=10,
+                                  input_shape=(4, 16)),
+                InnerProductLayer(name="ip_b", source="trunk", n_units=5,
+                                  input_shape=(4, 16)),
+            ])
+        quant = Quantization.calibrate(net, self.epoche)
+        self.assertRaises(ValueError, accuracy_report, net, quant,
+                          self.epoche)
+        report = accuracy_report(net, quant, self.epoche, output="ip_a")
+        self.assertIn('float_accuracy', report)
+        self.assertGreater(report['agreement'], 0.5)
@@ -0,0 +1,157 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+import numpy as np
+import theano
+
+from bernet.layer import InnerProductLayer, SoftmaxLayer
+from bernet.net import FeedForwardNet
+from bernet.server import MicroBatcher, InferenceServer, InferenceClient, \
+    main
+
+
+class TestMicroBatcher(TestCase):
+    def test_batching(self):
+        batch_sizes = []
+
+        def predict(x):
+            batch_sizes.append(len(x))
+            time.sleep(0.01)
+            return 2 * x
+
+        batcher = MicroBatcher(predict, max_batch_size=4, max_wait=0.05)
+        outputs = {}
+
+        def submit(i):
+            outputs[i] = batcher.submit(np.full((1, 3), i))
+
+        threads = [threading.Thread(target=submit, args=(i,))
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        batcher.close()
+
+        for i in range(10):
+            np.testing.assert_equal(outputs[i], np.full((1, 3), 2 * i))
+        self.assertEqual(sum(batch_sizes), 10)
+        self.assertLessEqual(max(batch_sizes), 4)
+        self.assertLess(len(batch_sizes), 10)
+
+        stats = batcher.stats()
+        self.assertEqual(stats['requests'], 10)
+        self.assertEqual(stats['batches'], len(batch_sizes))
+        self.assertAlmostEqual(stats['batch_fill_rate'],
+                               10 / (4 * len(batch_sizes)))
+        self.assertLessEqual(stats['p50_latency_ms'],
+                             stats['p99_latency_ms'])
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_error(self):
+        def predict(x):
+            raise ValueError("broken")
+
+        batcher = MicroBatcher(predict, max_batch_size=4, max_wait=0.)
+        self.assertRaisesRegex(ValueError, "broken", batcher.submit,
+                               np.zeros((1, 3)))
+        batcher.close()
+
+    def test_oversized_request_fill_rate(self):
+        batcher = MicroBatcher(lambda x: x, max_batch_size=4, max_wait=0.)
+        batcher.submit(np.zeros((10, 3)))
+        batcher.submit(np.zeros((2, 3)))
+        batcher.close()
+        # the capacities are 10 and 4
+        self.assertAlmostEqual(batcher.stats()['batch_fill_rate'], 12 / 14)
+
+
+class TestInferenceServer(TestCase):
+    def setUp(self):
+        self.net = FeedForwardNet(
+            name="served", input_shape=(8, 6),
+            layers=[InnerProductLayer(name="ip", n_units=3,
+                                      input_shape=(8, 6)),
+                    SoftmaxLayer(name="softmax", source="ip")])
+
+    def serve(self, **kwargs):
+        server = InferenceServer(self.net, engine="numpy", max_wait=0.01,
+                                 **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def check_client(self, client):
+        input = np.random.sample((2, 6))
+        np.testing.assert_almost_equal(
+            client.predict(input), self.net.forward(input, engine="numpy"))
+        self.assertTupleEqual(client.predict(input[0]).shape, (1, 3))
+        self.assertRaises(IOError, client.predict, np.zeros((1, 5)))
+        self.assertListEqual(client.info()['input_shape'], [8, 6])
+        self.assertEqual(client.stats()['requests'], 2)
+        client.close()
+
+    def test_http(self):
+        server = self.serve(port=0)
+        host, port = server.address
+        self.check_client(InferenceClient(host, port))
+
+    def test_content_length(self):
+        host, port = self.serve(port=0).address
+        for length, status in [(None, 411), ("abc", 400)]:
+            conn = http.client.HTTPConnection(host, port)
+            self.addCleanup(conn.close)
+            conn.putrequest("POST", "/predict")
+            if length is not None:
+                conn.putheader("Content-Length", length)
+            conn.endheaders()
+            self.assertEqual(conn.getresponse().status, status)
+
+    def test_float32_theano_engine(self):
+        floatX = theano.config.floatX
+        theano.config.floatX = 'float32'
+        try:
+            self.net = FeedForwardNet(
+                name="served", input_shape=(8, 6),
+                layers=[InnerProductLayer(name="ip", n_units=3,
+                                          input_shape=(8, 6))])
+            server = InferenceServer(self.net, port=0)
+            self.addCleanup(server.close)
+            output = server.batcher.submit(
+                server.prepare_input(np.random.sample(6)))
+            self.assertEqual(output.dtype, 'float32')
+        finally:
+            theano.config.floatX = floatX
+
+    def test_int8_requires_quantization(self):
+        with open(os.devnull, 'w') as devnull, \
+                mock.patch('sys.stderr', devnull):
+            self.assertRaises(SystemExit, main,
+                              ["served.yaml", "--engine", "int8"])
+
+    def test_unix_socket(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "socket")
+        self.serve(unix_socket=path)
+        self.check_client(InferenceClient(unix_socket=path))
@@ -0,0 +1,82 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+
+from bernet import trace
+from bernet.config import load
+from bernet.net import FeedForwardNet
+from bernet.trace import tracing, stage
+
+
+class TestTrace(TestCase):
+    def test_load_stages(self):
+        _dir = os.path.dirname(os.path.realpath(__file__))
+        with tracing() as t:
+            with open(_dir + "/../models/shallow-net.yaml") as f:
+                net = load(FeedForwardNet, f)
+            net.forward(np.random.sample((64, 1, 28, 28)))
+
+        names = [e['name'] for e in t.events]
+        for name in ["load", "net.config", "net.setup_connections",
+                     "net.setup_parameters", "layer_parameters",
+                     "net.check_shapes", "compile"]:
+            self.assertIn(name, names)
+        events = {e['name']: e for e in t.events}
+        self.assertEqual(events['load']['depth'], 0)
+        self.assertEqual(events['net.setup_parameters']['depth'], 1)
+        self.assertEqual(events['compile']['depth'], 0)
+        self.assertGreater(events['net.setup_parameters']['allocated_bytes'],
+                           0)
+        self.assertGreaterEqual(events['load']['seconds'],
+                                events['net.setup_parameters']['seconds'])
+        self.assertAlmostEqual(
+            t.summary()['layer_parameters'],
+            sum(e['seconds'] for e in t.events
+                if e['name'] == 'layer_parameters'))
+
+        out = io.StringIO()
+        t.write(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), len(t.events))
+        self.assertEqual(json.loads(lines[0])['name'], 'load')
+
+    def test_stage_without_trace(self):
+        with stage("nothing") as event:
+            self.assertIsNone(event)
+
+    def test_without_tracemalloc(self):
+        with mock.patch('bernet.trace.tracemalloc', None), tracing() as t:
+            with stage("stage"):
+                pass
+        self.assertEqual(t.events[0]['name'], "stage")
+        self.assertIn('seconds', t.events[0])
+        self.assertNotIn('allocated_bytes', t.events[0])
+
+    def test_environment(self):
+        with tempfile.NamedTemporaryFile("r") as f, \
+                mock.patch.dict(os.environ, {"BERNET_TRACE": f.name}), \
+                mock.patch('atexit.register') as register:
+            trace._trace_from_environment()
+            with stage("stage", info=1):
+                pass
+            register.call_args[0][0]()
+            event = json.loads(f.read())
+            self.assertEqual(event['name'], "stage")
+            self.assertEqual(event['info'], 1)
@@ -0,0 +1,78 @@
+# Copyright 2015 Leon Sixt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import TestCase
+
+import numpy as np
+
+from bernet.config import dump
+from bernet.layer import InnerProductLayer, TanHLayer, SoftmaxLayer
+from bernet.net import FeedForwardNet
+from bernet.tuning import tune_batch_size, format_tuning_report
+
+
+class TestTuneBatchSize(TestCase):
+    def setUp(self):
+        self.net = FeedForwardNet(
+            name="innerprod_net", input_shape=(1, 3, 4, 4),
+            layers=[
+                InnerProductLayer(name="ip#1", n_units=16,
+                                  input_shape=(1, 48)),
+                TanHLayer(name="tanh#1", source="ip#1"),
+                InnerProductLayer(name="ip#2", n_units=4, source="tanh#1",
+                                  input_shape=(1, 16)),
+                SoftmaxLayer(name="softmax#1", source="ip#2"),
+            ])
+
+    def test_inference(self):
+        budget = self.net.cost_summary(4)['inference_bytes']
+        report = tune_batch_size(self.net, [8, 1, 2, 4], n_runs=2,
+                                 memory_budget=budget)
+        self.assertListEqual([r['batch_size'] for r in report['results']],
+                             [1, 2, 4])
+        for r in report['results']:
+            self.assertAlmostEqual(r['examples_per_second'],
+                                   r['batch_size'] / r['latency'])
+        self.assertIn(report['best'], [1, 2, 4])
+        self.assertTupleEqual(tuple(self.net.input_shape),
+                              (report['best'], 3, 4, 4))
+        self.assertIn("input_shape: [{}, 3, 4, 4]".format(report['best']),
+                      dump(self.net))
+        self.assertEqual(len(format_tuning_report(report).splitlines()), 4)
+
+        self.assertRaises(ValueError, tune_batch_size, self.net, [2, 4],
+                          memory_budget=1)
+
+    def test_inference_write_back_rebuilds(self):
+        report = tune_batch_size(self.net, [8], n_runs=1)
+        self.assertEqual(report['best'], 8)
+        net = FeedForwardNet(name="tuned", input_shape=self.net.input_shape,
+                             layers=self.net.layers)
+        self.assertTupleEqual(tuple(net.input_shape), (8, 3, 4, 4))
+        self.assertTupleEqual(tuple(net.get_layer("ip#2").input_shape),
+                              (8, 16))
+
+    def test_training(self):
+        weight = self.net.get_parameter("ip#1_weight").value.copy()
+        report = tune_batch_size(self.net, [1, 4], training=True,
+                                 n_runs=2, max_latency=float('inf'))
+        self.assertEqual(self.net.batch_size, report['best'])
+        self.assertEqual(tuple(self.net.input_shape), (1, 3, 4, 4))
+        np.testing.assert_array_equal(
+            self.net.get_parameter("ip#1_weight").value, weight)
+
+    def test_max_latency(self):
+        report = tune_batch_size(self.net, [1, 2], n_runs=1,
+                                 max_latency=0., write_back=False)
+        self.assertIsNone(report['best'])
+        self.assertTupleEqual(tuple(self.net.input_shape), (1, 3, 4, 4))
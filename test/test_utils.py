@@ -13,11 +13,14 @@
 # limitations under the License.
 
 import hashlib
+import http.server
 import os
 import shutil
 import tempfile
+import threading
 from unittest import TestCase
 
+import scipy.sparse
 import theano.tensor as T
 from bernet.utils import *
 
@@ -66,6 +69,23 @@ class TestUtils(TestCase):
         array = theano.shared(np.ones((10, 10)), "array")
         t = shared_like(array, "t")
         self.assertTupleEqual(t.get_value().shape, array.get_value().shape)
+        float32_array = theano.shared(np.ones((2, 3), dtype='float32'))
+        t = shared_like(float32_array, "t", init=1.)
+        self.assertEqual(t.dtype, 'float32')
+        np.testing.assert_equal(t.get_value(), np.ones((2, 3)))
+
+    def test_shared_tensor_from_dims(self):
+        t = shared_tensor_from_dims("t", 3)
+        self.assertEqual(t.ndim, 3)
+        self.assertEqual(t.dtype, floatX())
+
+    def test_float64_variables(self):
+        x = T.fvector('x')
+        double = theano.shared(np.ones(3, dtype='float64'))
+        fn = theano.function([x], x * double)
+        self.assertGreater(len(float64_variables(fn)), 0)
+        fn = theano.function([x], 2 * x)
+        self.assertListEqual(float64_variables(fn), [])
 
     def test_print_confusion_matrix(self):
         matrix = np.asarray([
@@ -125,3 +145,90 @@ class TestUtils(TestCase):
         img = tile_image(arr, tile_spacing=(3, 3), name="Hello World!")
         self.assertEqual(type(img), Image.Image)
         # img.show()
+
+    def test_parameters_npz(self):
+        dense = np.random.sample((3, 4))
+        sparse = scipy.sparse.random(5, 6, density=0.2, format='csr')
+        arrays = parameters_to_npz({"dense": dense, "sparse": sparse})
+        self.assertIn("sparse__csr_indptr", arrays)
+        with tempfile.TemporaryFile() as f:
+            np.savez(f, **arrays)
+            f.seek(0)
+            loaded = parameters_from_npz(np.load(f))
+        self.assertEqual(loaded["dense"].dtype, floatX())
+        np.testing.assert_almost_equal(loaded["dense"], dense)
+        self.assertTrue(scipy.sparse.isspmatrix_csr(loaded["sparse"]))
+        np.testing.assert_almost_equal(loaded["sparse"].toarray(),
+                                       sparse.toarray())
+
+    def test_fetch_verified(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        src = os.path.join(tmp_dir, "src")
+        with open(src, "wb") as f:
+            f.write(b"parameters")
+        sha256 = hashlib.sha256(b"parameters").hexdigest()
+        dst = os.path.join(tmp_dir, "cache", sha256)
+        self.assertRaises(ValueError, fetch_verified, "file://" + src, dst,
+                          "wrong")
+        self.assertListEqual(os.listdir(os.path.join(tmp_dir, "cache")), [])
+        self.assertTrue(fetch_verified("file://" + src, dst, sha256))
+        self.assertFalse(fetch_verified("file://" + src, dst, sha256))
+
+    def test_npy_dir(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        directory = os.path.join(tmp_dir, "arrays")
+        arr = np.random.sample((3, 4))
+        save_npy_dir(directory, {"a": arr})
+        loaded = load_npy_dir(directory)
+        self.assertIsInstance(loaded["a"], np.memmap)
+        np.testing.assert_equal(loaded["a"], arr)
+        loaded["a"][0, 0] = -1.
+        np.testing.assert_equal(load_npy_dir(directory)["a"], arr)
+
+    def test_download_resume_parallel(self):
+        content = os.urandom(100000)
+        requests = []
+
+        class RangeHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.headers.get("Range"))
+                begin, end = self.headers["Range"][6:].split("-")
+                begin = int(begin)
+                end = int(end) + 1 if end else len(content)
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                    begin, end - 1, len(content)))
+                self.send_header("Content-Length", str(end - begin))
+                self.end_headers()
+                self.wfile.write(content[begin:end])
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:{}/params.npz".format(server.server_port)
+
+        with tempfile.TemporaryFile() as f:
+            f.write(content[:30000])
+            sha256 = download(url, f, n_connections=3, block_size=4096)
+            self.assertEqual(sha256, hashlib.sha256(content).hexdigest())
+            f.seek(0)
+            self.assertEqual(f.read(), content)
+        self.assertEqual(requests[0], "bytes=30000-")
+        self.assertEqual(len(requests), 3)
+
+    def test_download_mirror(self):
+        mirror = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, mirror)
+        with open(os.path.join(mirror, "params.npz"), "wb") as f:
+            f.write(b"parameters")
+        with tempfile.TemporaryFile() as f:
+            sha256 = download("http://unreachable.invalid/params.npz", f,
+                              mirror=mirror)
+            self.assertEqual(sha256,
+                             hashlib.sha256(b"parameters").hexdigest())